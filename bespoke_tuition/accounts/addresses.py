@@ -0,0 +1,77 @@
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Address, TuitionAddress
+
+
+def _asDate(value):
+    if isinstance(value, datetime):
+        return timezone.localdate(value) if timezone.is_aware(value) else value.date()
+    return value
+
+
+# Work out which address was in effect for each (owner id, date) pair with one query.
+# Every address for the owners that could cover any of the dates is read in effective from
+# order, then each date is looked up with a binary search on the owners addresses. If two
+# ranges overlap the one that started latest wins, rather than failing like .get() did.
+def addressesAsOf(model, owner_field, pairs):
+    pairs = [(owner_id, _asDate(day)) for owner_id, day in pairs]
+    if not pairs:
+        return {}
+
+    days = [day for owner_id, day in pairs]
+    addresses = model.objects.filter(Q(effective_to_date__gte=min(days)) | Q(effective_to_date__isnull=True),
+                                     **{owner_field + '__in': set(owner_id for owner_id, day in pairs),
+                                        'effective_from_date__lte': max(days)}) \
+                             .order_by(owner_field, 'effective_from_date', 'pk')
+
+    by_owner = defaultdict(list)
+    for address in addresses:
+        by_owner[getattr(address, owner_field + '_id')].append(address)
+
+    starts = {owner_id: [address.effective_from_date for address in owned] for owner_id, owned in by_owner.items()}
+
+    resolved = {}
+    for owner_id, day in pairs:
+        owned = by_owner.get(owner_id, [])
+        # Step back from the latest address starting on or before the day until one covers it
+        for address in reversed(owned[:bisect_right(starts.get(owner_id, []), day)]):
+            if address.effective_to_date is None or address.effective_to_date >= day:
+                resolved[(owner_id, day)] = address
+                break
+
+    return resolved
+
+
+# Billing addresses for many (client id, date) pairs, keyed on the pair with the date part
+def clientAddresses(pairs):
+    return addressesAsOf(Address, 'client', pairs)
+
+
+# Tuition addresses for many (student id, date) pairs
+def tuitionAddresses(pairs):
+    return addressesAsOf(TuitionAddress, 'student', pairs)
+
+
+# An address on one line for calendars and lists, blank if there isn't one
+def addressLine(address):
+    if address is None:
+        return ''
+    return ', '.join(part for part in (address.line_one, address.line_two, address.line_three,
+                                       address.town, address.postcode) if part)
+
+
+# Billing address for a client on one date, or None if none was in effect
+def clientAddressAsOf(client_id, day):
+    return clientAddresses([(client_id, day)]).get((client_id, _asDate(day)))
+
+
+# The billing address in effect when each invoice was created, keyed on invoice id
+def invoiceAddresses(invoices):
+    pairs = {invoice.pk: (invoice.client_id, _asDate(invoice.date_created)) for invoice in invoices}
+    resolved = clientAddresses(pairs.values())
+    return {invoice_id: resolved.get(pair) for invoice_id, pair in pairs.items()}
@@ -1,6 +1,7 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
-from .models import Client, Address, ContactDetails, Student, TuitionAddress, Products, Lesson, Invoices, Term
+from .jobs import enqueue
+from .models import Client, Address, ContactDetails, Student, TuitionAddress, Products, Lesson, Invoices, Term, Job, Payment
 
 class AddressInline(admin.StackedInline):
     model = Address
@@ -10,8 +11,17 @@ class ContactDetailsInline(admin.StackedInline):
     model = ContactDetails
     extra = 1
 
+# Admin action to queue the batch invoicing for just the selected clients, the runjobs
+# worker does the work so the request returns straight away
+def invoiceClients(modeladmin, request, queryset):
+    job = enqueue('invoices', client_ids=list(queryset.values_list('pk', flat=True)))
+    modeladmin.message_user(request, 'Queued invoicing as job %d' % job.pk, messages.SUCCESS)
+
+invoiceClients.short_description = 'Create invoices for uninvoiced lessons'
+
 class ClientAdmin(admin.ModelAdmin):
     inlines = [ContactDetailsInline, AddressInline]
+    actions = [invoiceClients]
 
 class TuitionAddressInline(admin.StackedInline):
     model = TuitionAddress
@@ -25,4 +35,6 @@ admin.site.register(Student, StudentAdmin)
 admin.site.register(Products)
 admin.site.register(Lesson)
 admin.site.register(Invoices)
-admin.site.register(Term)
\ No newline at end of file
+admin.site.register(Term)
+admin.site.register(Job)
+admin.site.register(Payment)
\ No newline at end of file
@@ -0,0 +1,81 @@
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import DecimalField, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import AgedDebtSnapshot, Invoices
+
+# Invoices still owing money, paid ones are left out using the status index so the
+# report reads only the unpaid invoices however many have been paid over the years
+UNPAID = [Invoices.DRAFT, Invoices.ISSUED, Invoices.UNPAID, Invoices.PART_PAID]
+
+# Age buckets in days since the invoice was created, the last has no upper limit
+BUCKETS = [('days_0_30', 0, 30), ('days_31_60', 31, 60), ('days_61_90', 61, 90), ('days_over_90', 91, None)]
+BUCKET_FIELDS = [name for name, first, last in BUCKETS] + ['total']
+
+
+def _dayStart(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+# Condition on the invoice creation time for each bucket. An invoice made on the day 30
+# days ago is 30 days old so is still in the first bucket. Days are the local day.
+def _bucketConditions(now):
+    today = timezone.localdate(now)
+    conditions = {}
+    for name, first, last in BUCKETS:
+        condition = Q()
+        if last is not None:
+            condition &= Q(date_created__gte=_dayStart(today - timedelta(days=last)))
+        if first:
+            condition &= Q(date_created__lt=_dayStart(today - timedelta(days=first - 1)))
+        conditions[name] = condition
+    return conditions
+
+
+def _sum(field, condition):
+    return Coalesce(Sum(field, filter=condition), Value(Decimal('0.00')), output_field=DecimalField())
+
+
+# Sums of the invoices for each bucket and the total, for aggregate or annotate on the
+# unpaid invoices
+def bucketSums(now=None):
+    now = now or timezone.now()
+    sums = {name: _sum('amount_outstanding', condition) for name, condition in _bucketConditions(now).items()}
+    sums['total'] = _sum('amount_outstanding', None)
+    return sums
+
+
+# Aged debt across every client, one aggregate query
+def agedDebtTotals(now=None):
+    return Invoices.objects.filter(status__in=UNPAID).aggregate(**bucketSums(now=now))
+
+
+# Aged debt for each client owing money, one aggregate query over the unpaid invoices
+# grouped by client. Rows are dicts with the client id and name and the buckets.
+def clientAgedDebt(now=None):
+    return Invoices.objects.filter(status__in=UNPAID) \
+                           .values('client', 'client__forename', 'client__surname') \
+                           .annotate(**bucketSums(now)).filter(total__gt=0)
+
+
+# Store today's aged debt. Taking it again the same day replaces the earlier one. Run
+# daily from cron with the snapshotageddebt command or queued as a job.
+def takeSnapshot(now=None):
+    now = now or timezone.now()
+    day = timezone.localdate(now)
+    totals = agedDebtTotals(now)
+
+    rows = [AgedDebtSnapshot(date=day, client_id=client['client'],
+                             **{field: client[field] for field in BUCKET_FIELDS})
+            for client in clientAgedDebt(now).order_by('client')]
+    rows.append(AgedDebtSnapshot(date=day, **totals))
+
+    with transaction.atomic():
+        AgedDebtSnapshot.objects.filter(date=day).delete()
+        AgedDebtSnapshot.objects.bulk_create(rows, batch_size=1000)
+
+    return {'date': str(day), 'clients': len(rows) - 1, 'total': str(totals['total'])}
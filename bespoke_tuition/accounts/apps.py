@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class AccountsConfig(AppConfig):
     name = 'accounts'
+
+    # Connect the signal receivers
+    def ready(self):
+        from . import roles, balances, refdata, rollups
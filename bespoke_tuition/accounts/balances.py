@@ -0,0 +1,153 @@
+from decimal import Decimal
+
+from django.db.models import F, Sum
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .lessonchanges import lessonBefore, lessonReceiversPaused
+from .models import ClientBalance, Invoices, Lesson, Student
+from .pricing import pricedTotals, productOn
+
+BALANCE_FIELDS = ['total_invoiced', 'total_paid', 'total_outstanding', 'uninvoiced_value']
+
+# Make sure each client has a balance row before it is updated
+def _ensureBalances(client_ids):
+    existing = set(ClientBalance.objects.filter(client_id__in=client_ids).values_list('client_id', flat=True))
+    missing = [ClientBalance(client_id=client_id) for client_id in set(client_ids) - existing]
+    ClientBalance.objects.bulk_create(missing)
+
+
+# Add the amounts given onto the clients balances in one update. Using F() means the
+# database does the adding so two requests at the same time can't lose an update.
+def adjustBalances(client_ids, **amounts):
+    amounts = {field: amount for field, amount in amounts.items() if amount}
+    client_ids = [client_id for client_id in client_ids if client_id is not None]
+
+    if not amounts or not client_ids:
+        return
+
+    _ensureBalances(client_ids)
+    ClientBalance.objects.filter(client_id__in=client_ids) \
+                         .update(date_updated=timezone.now(),
+                                 **{field: F(field) + amount for field, amount in amounts.items()})
+
+
+# Parents of a student, lessons count towards every parent as they appear on each of
+# their invoicing pages until one of them is invoiced
+def studentParents(student_ids):
+    return list(Student.parent.through.objects.filter(student_id__in=student_ids)
+                                              .values_list('client_id', flat=True).distinct())
+
+
+# Value of each client's uninvoiced lessons, every lesson at the price on its day the same
+# as the invoice lines will charge
+def uninvoicedTotals(client_ids):
+    return pricedTotals(Lesson.objects.filter(invoiced=False, student__parent__in=client_ids)
+                                      .values_list('student__parent', 'lesson_type_id', 'lesson_start')
+                                      .iterator(chunk_size=2000))
+
+
+# Work out the uninvoiced lesson value again for just these clients. Used after lessons
+# are changed with a queryset update which doesn't send signals.
+def refreshUninvoiced(client_ids):
+    client_ids = list(set(client_ids))
+    if not client_ids:
+        return
+
+    totals = uninvoicedTotals(client_ids)
+
+    _ensureBalances(client_ids)
+    for client_id in client_ids:
+        ClientBalance.objects.filter(client_id=client_id) \
+                             .update(uninvoiced_value=totals.get(client_id) or 0, date_updated=timezone.now())
+
+
+# Rebuild the balances for the given clients (or everyone) from the invoices and lessons
+def rebuildBalances(client_ids):
+    client_ids = list(client_ids)
+
+    invoiced = {row['client']: row for row in
+                Invoices.objects.filter(client__in=client_ids).values('client')
+                                .annotate(invoiced=Sum('total_amount'), paid=Sum('amount_paid'),
+                                          outstanding=Sum('amount_outstanding')).order_by()}
+    uninvoiced = uninvoicedTotals(client_ids)
+
+    balances = []
+    for client_id in client_ids:
+        row = invoiced.get(client_id, {})
+        balances.append(ClientBalance(client_id=client_id,
+                                      total_invoiced=row.get('invoiced') or 0,
+                                      total_paid=row.get('paid') or 0,
+                                      total_outstanding=row.get('outstanding') or 0,
+                                      uninvoiced_value=uninvoiced.get(client_id) or 0))
+
+    ClientBalance.objects.filter(client_id__in=client_ids).delete()
+    ClientBalance.objects.bulk_create(balances)
+
+    return len(balances)
+
+
+# Keep the old amounts on the instance so the change can be worked out after saving
+@receiver(pre_save, sender=Invoices)
+def invoiceBeforeSave(sender, instance, **kwargs):
+    instance._balance_before = None
+    if instance.pk:
+        instance._balance_before = Invoices.objects.filter(pk=instance.pk) \
+            .values('client_id', 'total_amount', 'amount_paid', 'amount_outstanding').first()
+
+
+@receiver(post_save, sender=Invoices)
+def invoiceSaved(sender, instance, created, **kwargs):
+    before = getattr(instance, '_balance_before', None)
+
+    if before:
+        adjustBalances([before['client_id']], total_invoiced=-before['total_amount'],
+                       total_paid=-before['amount_paid'], total_outstanding=-before['amount_outstanding'])
+
+    adjustBalances([instance.client_id], total_invoiced=Decimal(instance.total_amount),
+                   total_paid=Decimal(instance.amount_paid),
+                   total_outstanding=Decimal(instance.amount_outstanding))
+
+
+@receiver(post_delete, sender=Invoices)
+def invoiceDeleted(sender, instance, **kwargs):
+    adjustBalances([instance.client_id], total_invoiced=-Decimal(instance.total_amount),
+                   total_paid=-Decimal(instance.amount_paid),
+                   total_outstanding=-Decimal(instance.amount_outstanding))
+
+
+def _uninvoicedValue(lesson):
+    if lesson is None or lesson['invoiced'] or lesson['student_id'] is None:
+        return None
+    return lesson['student_id'], productOn(lesson['lesson_type_id'], lesson['lesson_start']).price
+
+
+# Take off the lessons old value and add on the new one for the parents of the student
+@receiver(post_save, sender=Lesson)
+def lessonSaved(sender, instance, **kwargs):
+    if lessonReceiversPaused():
+        return
+
+    before = _uninvoicedValue(lessonBefore(instance))
+    after = None
+    if not instance.invoiced and instance.student_id is not None:
+        after = instance.student_id, productOn(instance.lesson_type_id, instance.lesson_start).price
+
+    if before == after:
+        return
+
+    if before:
+        adjustBalances(studentParents([before[0]]), uninvoiced_value=-before[1])
+    if after:
+        adjustBalances(studentParents([after[0]]), uninvoiced_value=after[1])
+
+
+@receiver(post_delete, sender=Lesson)
+def lessonDeleted(sender, instance, **kwargs):
+    if lessonReceiversPaused():
+        return
+
+    if not instance.invoiced and instance.student_id is not None:
+        price = productOn(instance.lesson_type_id, instance.lesson_start).price
+        adjustBalances(studentParents([instance.student_id]), uninvoiced_value=-price)
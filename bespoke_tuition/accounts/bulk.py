@@ -0,0 +1,34 @@
+from django.db import connection, transaction
+
+
+# bulk_create that also sets the primary keys on the new objects. Postgres hands them back
+# from the insert, sqlite doesn't so they are read back from after the previous highest
+# key inside the same transaction.
+def bulkCreate(model, objects, batch_size=1000):
+    objects = list(objects)
+
+    if connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(objects, batch_size=batch_size)
+        return [obj.pk for obj in objects]
+
+    with transaction.atomic():
+        last_pk = model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        model.objects.bulk_create(objects, batch_size=batch_size)
+        pks = list(model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True))
+
+    for obj, pk in zip(objects, pks):
+        obj.pk = pk
+
+    return pks
+
+
+# Lists of up to size rows at a time from any iterable, the last one may be shorter
+def chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
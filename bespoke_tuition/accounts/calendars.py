@@ -0,0 +1,154 @@
+import hashlib
+from datetime import datetime, time, timedelta
+
+from django.core import signing
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from .addresses import addressLine, tuitionAddresses
+from .models import Client, Lesson, Student, TuitionAddress, newCalendarKey
+from .refdata import productMap, tableVersion
+
+# Salt for the feed tokens. A token is the only thing needed to read a feed, calendar
+# apps can't log in, so it is signed rather than guessable. It also holds the student's
+# or client's calendar key, so a link that has been shared can be stopped with a new key.
+FEED_SALT = 'accounts.calendars.feed'
+
+# Feeds hold lessons from this many days ago onwards
+FEED_DAYS = 365
+
+# How long calendar apps are told they can keep a feed before asking again, and how long
+# a rendered feed is kept in the cache
+POLL_SECONDS = 5 * 60
+CACHE_SECONDS = 24 * 60 * 60
+
+STUDENT = 'student'
+CLIENT = 'client'
+
+PRODID = '-//LW Bespoke Tuition//Lessons//EN'
+
+
+def feedToken(kind, owner):
+    return signing.dumps([kind, owner.pk, owner.calendar_key], salt=FEED_SALT)
+
+
+# The kind of feed, the student or client id and the calendar key in the token, raises
+# BadSignature if the token wasn't made here
+def feedOwner(token):
+    owner = signing.loads(token, salt=FEED_SALT)
+    if len(owner) != 3 or owner[0] not in (STUDENT, CLIENT):
+        raise signing.BadSignature('Unknown feed')
+    return tuple(owner)
+
+
+# Give the student or client a new calendar key, every feed link made before stops working
+def revokeFeeds(owner):
+    owner.calendar_key = newCalendarKey()
+    owner.save(update_fields=['calendar_key'])
+
+
+def _dayStart(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+# What goes into a feed, worked out from a few small queries that don't read the lessons
+# themselves: the students, a count and the latest change of their lessons, their tuition
+# addresses and the products version. Any edit, new lesson or deleted lesson changes the
+# fingerprint, which is used as the ETag and to find the rendered feed in the cache. There
+# is no Last-Modified as no single date covers deleted lessons or changed names, addresses
+# and products. Returns None if the student or client has gone or the key is out of date.
+def feedState(kind, pk, key, now=None):
+    since = _dayStart(timezone.localdate(now or timezone.now()) - timedelta(days=FEED_DAYS))
+    if kind == STUDENT:
+        students = Student.objects.filter(pk=pk, calendar_key=key)
+    else:
+        students = Student.objects.filter(parent=pk, parent__calendar_key=key)
+    students = list(students.order_by('pk').values_list('pk', 'forename', 'surname'))
+
+    if not students and (kind == STUDENT or not Client.objects.filter(pk=pk, calendar_key=key).exists()):
+        return None
+
+    student_ids = [student[0] for student in students]
+    lessons = Lesson.objects.filter(student__in=student_ids, lesson_start__gte=since) \
+                            .aggregate(count=Count('pk'), last_pk=Max('pk'), last_updated=Max('date_updated'))
+    addresses = list(TuitionAddress.objects.filter(student__in=student_ids).order_by('pk')
+                                   .values_list('pk', 'line_one', 'line_two', 'line_three', 'town', 'postcode',
+                                                'effective_from_date', 'effective_to_date'))
+
+    fingerprint = hashlib.sha1(repr((kind, pk, since, students, lessons['count'], lessons['last_pk'],
+                                     lessons['last_updated'], addresses, tableVersion('products'))).encode())
+
+    return {'kind': kind, 'pk': pk, 'since': since, 'students': students, 'etag': fingerprint.hexdigest()}
+
+
+# Text values have backslashes, semicolons, commas and new lines escaped
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+# Lines longer than 75 octets are folded, carrying on after a new line and a space
+def _fold(line):
+    folded = []
+    current, size = '', 0
+    for character in line:
+        width = len(character.encode())
+        if size + width > 75:
+            folded.append(current)
+            current, size = ' ', 1
+        current += character
+        size += width
+    folded.append(current)
+    return '\r\n'.join(folded)
+
+
+def _utc(value):
+    return value.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+# Write the calendar for a feed. The lessons are read in one query and their tuition
+# address on the day of each lesson in another.
+def renderFeed(state):
+    names = {pk: ' '.join(filter(None, (forename, surname))) for pk, forename, surname in state['students']}
+    products = productMap()
+    lessons = list(Lesson.objects.filter(student__in=list(names), lesson_start__gte=state['since'])
+                                 .order_by('lesson_start', 'pk')
+                                 .values_list('pk', 'student_id', 'lesson_type_id', 'lesson_start', 'lesson_end',
+                                              'date_updated'))
+    addresses = tuitionAddresses({(lesson[1], lesson[3]) for lesson in lessons})
+
+    if state['kind'] == STUDENT:
+        calendar_name = names[state['pk']] + ' lessons'
+    else:
+        calendar_name = 'Family lessons'
+
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:' + PRODID, 'CALSCALE:GREGORIAN', 'METHOD:PUBLISH',
+             'X-WR-CALNAME:' + _escape(calendar_name)]
+
+    for pk, student_id, lesson_type_id, lesson_start, lesson_end, date_updated in lessons:
+        product = products.get(lesson_type_id)
+        summary = (product.product_name if product else 'Lesson') + ' - ' + names[student_id]
+        lines += ['BEGIN:VEVENT',
+                  'UID:lesson-%d@bespoke-tuition' % pk,
+                  'DTSTAMP:' + _utc(date_updated),
+                  'DTSTART:' + _utc(lesson_start),
+                  'DTEND:' + _utc(lesson_end),
+                  'SUMMARY:' + _escape(summary)]
+        location = addressLine(addresses.get((student_id, timezone.localdate(lesson_start))))
+        if location:
+            lines.append('LOCATION:' + _escape(location))
+        lines.append('END:VEVENT')
+
+    lines.append('END:VCALENDAR')
+
+    return '\r\n'.join(_fold(line) for line in lines) + '\r\n'
+
+
+# The feed for the state, from the cache if it has been rendered since it last changed
+def feedBody(state):
+    key = 'accounts.calendar.' + state['etag']
+    body = cache.get(key)
+    if body is None:
+        body = renderFeed(state)
+        cache.set(key, body, CACHE_SECONDS)
+    return body
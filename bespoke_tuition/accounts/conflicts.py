@@ -0,0 +1,95 @@
+import heapq
+from datetime import timedelta
+from itertools import islice
+
+from django.utils import timezone
+
+from .models import Lesson
+
+# Longest a lesson can run. The lesson forms keep the start and end on the same day so a
+# day is plenty. It turns "starts before my end and ends after my start" into a bounded
+# range on lesson_start which the (lesson_start, lesson_end) index can scan, rather than
+# reading every lesson that started before this one.
+MAX_LESSON_LENGTH = timedelta(days=1)
+
+CONFLICT_FIELDS = ('pk', 'student_id', 'lesson_start', 'lesson_end')
+
+# Most clashes shown on the report page. A badly booked term can have a huge number of
+# pairs so the page stops after this many rather than building them all.
+REPORT_LIMIT = 500
+
+
+# Lessons that overlap the time given. With a single tutor any overlap is a clash, not
+# just ones for the same student. Lessons that finish as another starts don't overlap.
+def overlappingLessons(start, end, exclude=()):
+    return Lesson.objects.filter(lesson_start__gte=start - MAX_LESSON_LENGTH, lesson_start__lt=end,
+                                 lesson_end__gt=start) \
+                         .exclude(pk__in=[pk for pk in exclude if pk is not None]) \
+                         .order_by('lesson_start')
+
+
+# Message for a form when the lesson clashes with one already booked, or None if it doesn't
+def conflictMessage(start, end, exclude=()):
+    clash = overlappingLessons(start, end, exclude).select_related('student').first()
+    if clash is None:
+        return None
+
+    return "This clashes with a lesson for %s %s at %s" % (
+        clash.student.forename if clash.student else '', clash.student.surname if clash.student else '',
+        timezone.localtime(clash.lesson_start).strftime("%d/%m/%Y %H:%M"))
+
+
+# Sweep over intervals sorted by start, keeping a heap of the ones still running. Each
+# interval conflicts with everything still on the heap when it starts, so a term of lessons
+# is checked in one pass rather than comparing every lesson with every other one.
+def _sweep(intervals):
+    running = []
+    for interval in intervals:
+        start = interval['lesson_start']
+        while running and running[0][0] <= start:
+            heapq.heappop(running)
+        for end, key, other in running:
+            yield other, interval
+        heapq.heappush(running, (interval['lesson_end'], id(interval), interval))
+
+
+def _pair(first, second):
+    same_student = first['student_id'] is not None and first['student_id'] == second['student_id']
+    kind = 'student' if same_student else 'tutor'
+    return {'first': first, 'second': second, 'kind': kind}
+
+
+# Conflicts between new unsaved lessons, and between them and lessons already booked.
+# Used before a bulk insert. One query reads the booked lessons over the whole span of
+# the new ones, ignoring any in exclude (such as lessons about to be replaced).
+def findConflicts(lessons, exclude_series=None):
+    new = [{'pk': None, 'student_id': lesson.student_id, 'lesson_start': lesson.lesson_start,
+            'lesson_end': lesson.lesson_end, 'new': True} for lesson in lessons]
+    if not new:
+        return []
+
+    booked = Lesson.objects.filter(lesson_start__gte=min(row['lesson_start'] for row in new) - MAX_LESSON_LENGTH,
+                                   lesson_start__lt=max(row['lesson_end'] for row in new))
+    if exclude_series is not None:
+        booked = booked.exclude(series=exclude_series)
+
+    intervals = new + list(booked.values(*CONFLICT_FIELDS))
+    intervals.sort(key=lambda row: row['lesson_start'])
+
+    return [_pair(first, second) for first, second in _sweep(intervals)
+            if first.get('new') or second.get('new')]
+
+
+# Every pair of overlapping lessons in a term, read in start order a chunk at a time and
+# handed back as they are found
+def iterTermConflicts(term):
+    lessons = Lesson.objects.filter(term=term).order_by('lesson_start', 'pk') \
+                            .values(*CONFLICT_FIELDS, 'student__forename', 'student__surname',
+                                    'lesson_type__product_name')
+
+    for first, second in _sweep(lessons.iterator(chunk_size=2000)):
+        yield _pair(first, second)
+
+
+def termConflicts(term, limit=None):
+    return list(islice(iterTermConflicts(term), limit))
@@ -1,6 +1,8 @@
 from django.http import HttpResponse
 from django.shortcuts import redirect
 
+from .roles import hasRole
+
 # Simple decorator to ensure the user is authenticated. If they are they should not
 # be able to access the login or register pages this is used on.
 def authenticatedUser(view_func):
@@ -12,21 +14,16 @@ def authenticatedUser(view_func):
 
     return wrapper_func
 
-# Simple decorator to ensure the user has the permissions to view a page.
+# Simple decorator to ensure the user has the permissions to view a page. The users
+# groups come from the role cache so they aren't queried on every page.
 def allowedUsers(allowed_roles=[]):
     def decorator(view_func):
         def wrapper_func(request, *args, **kwargs):
 
-            denied = False
+            if hasRole(request.user, allowed_roles):
+                return view_func(request, *args, **kwargs)
 
-            for roles in allowed_roles:
-                if request.user.groups.filter(name = roles).exists():
-                    return view_func(request, *args, **kwargs)
-                else:
-                    denied = True
-           
-            if denied == True:
-                return redirect('accounts:home')
+            return redirect('accounts:home')
 
         return wrapper_func
     return decorator
@@ -0,0 +1,193 @@
+import csv
+import json
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.utils import timezone
+
+from .addresses import clientAddresses
+from .bulk import chunks
+from .models import Client, Invoices, Lesson
+from .pricing import productOn
+
+# Rows read from the database at a time. On Postgres iterator() uses a server side cursor,
+# on sqlite it fetches this many rows at a time, either way memory stays flat.
+CHUNK_SIZE = 2000
+
+# Columns for each export, as (heading, field). Everything comes from values_list with the
+# joins done in the same query so there are no queries per row.
+LESSON_COLUMNS = [('lesson_id', 'pk'),
+                  ('lesson_start', 'lesson_start'),
+                  ('lesson_end', 'lesson_end'),
+                  ('student_forename', 'student__forename'),
+                  ('student_surname', 'student__surname'),
+                  ('product', 'lesson_type__product_name'),
+                  # Read as the lesson type, then set to the price on the day by addLessonPrices
+                  ('price', 'lesson_type_id'),
+                  ('term', 'term__term_name'),
+                  ('invoiced', 'invoiced'),
+                  ('invoice_number', 'invoice_number__invoice_number'),
+                  ('client_forename', 'invoice_number__client__forename'),
+                  ('client_surname', 'invoice_number__client__surname')]
+
+INVOICE_COLUMNS = [('invoice_number', 'invoice_number'),
+                   ('client_id', 'client_id'),
+                   ('client_forename', 'client__forename'),
+                   ('client_surname', 'client__surname'),
+                   ('status', 'status'),
+                   ('total_amount', 'total_amount'),
+                   ('amount_paid', 'amount_paid'),
+                   ('amount_outstanding', 'amount_outstanding'),
+                   ('date_created', 'date_created')]
+
+CLIENT_COLUMNS = [('client_id', 'pk'),
+                  ('forename', 'forename'),
+                  ('surname', 'surname'),
+                  ('active', 'active'),
+                  ('contract_signed', 'contract_signed'),
+                  ('date_inserted', 'date_inserted'),
+                  ('total_invoiced', 'balance__total_invoiced'),
+                  ('total_paid', 'balance__total_paid'),
+                  ('total_outstanding', 'balance__total_outstanding'),
+                  ('uninvoiced_value', 'balance__uninvoiced_value')]
+
+STATUS_NAMES = dict(Invoices.STATUS_CHOICES)
+
+
+# Dates are turned into a range on the datetime so an index on the column can be used
+def _dayStart(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def lessonQueryset(date_from=None, date_to=None, term=None, status=None):
+    lessons = Lesson.objects.all()
+    if date_from:
+        lessons = lessons.filter(lesson_start__gte=_dayStart(date_from))
+    if date_to:
+        lessons = lessons.filter(lesson_start__lt=_dayStart(date_to + timedelta(days=1)))
+    if term:
+        lessons = lessons.filter(term=term)
+    if status == 'invoiced':
+        lessons = lessons.filter(invoiced=True)
+    elif status == 'uninvoiced':
+        lessons = lessons.filter(invoiced=False)
+    return lessons.order_by('lesson_start', 'pk')
+
+
+def invoiceQueryset(date_from=None, date_to=None, term=None, status=None):
+    invoices = Invoices.objects.all()
+    if date_from:
+        invoices = invoices.filter(date_created__gte=_dayStart(date_from))
+    if date_to:
+        invoices = invoices.filter(date_created__lt=_dayStart(date_to + timedelta(days=1)))
+    if term:
+        invoices = invoices.filter(invoice_no__term=term).distinct()
+    names = {name.lower(): value for value, name in Invoices.STATUS_CHOICES}
+    if status and status.lower() in names:
+        invoices = invoices.filter(status=names[status.lower()])
+    return invoices.order_by('date_created', 'pk')
+
+
+def clientQueryset(date_from=None, date_to=None, term=None, status=None):
+    clients = Client.objects.all()
+    if date_from:
+        clients = clients.filter(date_inserted__gte=_dayStart(date_from))
+    if date_to:
+        clients = clients.filter(date_inserted__lt=_dayStart(date_to + timedelta(days=1)))
+    if term:
+        clients = clients.filter(student__lesson_student__term=term).distinct()
+    if status == 'active':
+        clients = clients.filter(active=True)
+    elif status == 'inactive':
+        clients = clients.filter(active=False)
+    return clients.order_by('pk')
+
+
+# Billing address when each invoice was created. Worked out for a whole chunk of rows
+# with one query, as a join can't pick the address in effect on the invoice date.
+BILLING_COLUMNS = [('billing_line_one', 'line_one'),
+                   ('billing_town', 'town'),
+                   ('billing_postcode', 'postcode')]
+
+
+def addBillingAddresses(rows):
+    addresses = clientAddresses([(row['client_id'], row['date_created']) for row in rows])
+    for row in rows:
+        address = addresses.get((row['client_id'], timezone.localdate(row['date_created'])))
+        for heading, field in BILLING_COLUMNS:
+            row[heading] = getattr(address, field) if address else None
+
+
+# Lessons are valued at the price on the day they took place, the same as the invoice
+# lines and revenue rollups, rather than the lesson type's current price
+def addLessonPrices(rows):
+    for row in rows:
+        row['price'] = productOn(row['price'], row['lesson_start']).price
+
+
+EXPORTS = {'lessons': (lessonQueryset, LESSON_COLUMNS),
+           'invoices': (invoiceQueryset, INVOICE_COLUMNS),
+           'clients': (clientQueryset, CLIENT_COLUMNS)}
+
+# Columns added to an export after each chunk is read, and the function that fills them in
+EXTRA_COLUMNS = {'invoices': (BILLING_COLUMNS, addBillingAddresses),
+                 'lessons': ([], addLessonPrices)}
+
+
+def exportHeadings(name):
+    columns = EXPORTS[name][1] + EXTRA_COLUMNS.get(name, ([], None))[0]
+    return [heading for heading, field in columns]
+
+
+def _value(heading, value):
+    if isinstance(value, datetime):
+        return timezone.localtime(value).isoformat()
+    if heading == 'status':
+        return STATUS_NAMES.get(value, value)
+    return value
+
+
+# Rows as dictionaries of heading to value, read from the database in chunks
+def exportRows(name, **filters):
+    queryset, columns = EXPORTS[name]
+    extra_columns, add_extra = EXTRA_COLUMNS.get(name, ([], None))
+    headings = [heading for heading, field in columns]
+    rows = queryset(**filters).values_list(*[field for heading, field in columns])
+
+    for chunk in chunks(rows.iterator(chunk_size=CHUNK_SIZE), CHUNK_SIZE):
+        chunk = [dict(zip(headings, row)) for row in chunk]
+        if add_extra:
+            add_extra(chunk)
+        for row in chunk:
+            yield {heading: _value(heading, value) for heading, value in row.items()}
+
+
+# Pretend file for csv.writer that just hands back each line so it can be streamed
+class Echo:
+    def write(self, value):
+        return value
+
+
+def csvLines(name, **filters):
+    headings = exportHeadings(name)
+    writer = csv.writer(Echo())
+
+    yield writer.writerow(headings)
+    for row in exportRows(name, **filters):
+        yield writer.writerow([row[heading] for heading in headings])
+
+
+class _ExportEncoder(json.JSONEncoder):
+    def default(self, value):
+        if isinstance(value, Decimal):
+            return str(value)
+        return super().default(value)
+
+
+def jsonLines(name, **filters):
+    for row in exportRows(name, **filters):
+        yield json.dumps(row, cls=_ExportEncoder) + '\n'
+
+
+FORMATS = {'csv': (csvLines, 'text/csv'),
+           'jsonl': (jsonLines, 'application/x-ndjson')}
@@ -5,9 +5,13 @@ from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 from datetime import datetime
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 # Imported all models as all required
 from .models import *
+from .conflicts import MAX_LESSON_LENGTH, conflictMessage, findConflicts
+from .series import seriesLessons
+from . import refdata
 
 # Class to display calendar for datetime fields
 class DateTimeInput(forms.DateTimeInput):
@@ -17,6 +21,52 @@ class DateTimeInput(forms.DateTimeInput):
 class DateInput(forms.DateInput):
     input_type = 'date'
 
+# Class to display time picker for time fields
+class TimeInput(forms.TimeInput):
+    input_type = 'time'
+
+# Choices for a ModelChoiceField read from the reference data cache instead of the queryset
+class CachedChoiceIterator(forms.models.ModelChoiceIterator):
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        for obj in self.field.cached_rows():
+            yield self.choice(obj)
+
+    def __len__(self):
+        return len(self.field.cached_rows()) + (1 if self.field.empty_label is not None else 0)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(self.field.cached_rows())
+
+# Drop down for products or terms served from the reference data cache, so showing and
+# checking the field doesn't query the table on every form
+class CachedModelChoiceField(forms.ModelChoiceField):
+    iterator = CachedChoiceIterator
+    rows = None
+    lookup = None
+
+    def cached_rows(self):
+        return self.rows()
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            return self.lookup()[int(value)]
+        except (KeyError, ValueError, TypeError):
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+
+class CachedProductField(CachedModelChoiceField):
+    rows = staticmethod(refdata.products)
+    lookup = staticmethod(refdata.productMap)
+
+class CachedTermField(CachedModelChoiceField):
+    rows = staticmethod(refdata.terms)
+    lookup = staticmethod(refdata.termMap)
+
+REFERENCE_FIELDS = {'lesson_type': CachedProductField, 'term': CachedTermField}
+
 # Class to add new clients, excluded fields not required at point on client creation
 class AddClientForm(ModelForm):
     class Meta:
@@ -53,12 +103,31 @@ class AddStudentForm(ModelForm):
 # the foreign key. This meant I didn't need 2 pages to populate the students information
 AddStudentAddressSet = inlineformset_factory(Student, TuitionAddress, exclude=('effective_from_date','effective_to_date'), extra=1, can_delete=False)
 
+# Errors for a lessons start and end. The end must be after the start on the same local
+# day, and no longer than MAX_LESSON_LENGTH which the clash checks rely on to bound their
+# search.
+def lessonTimesErrors(lesson_start, lesson_end):
+    errors={}
+
+    if lesson_start is None or lesson_end is None:
+        return errors
+
+    if lesson_start >= lesson_end:
+        errors['lesson_start'] = ValidationError("The lesson start should be before the lesson end")
+    elif timezone.localdate(lesson_start) != timezone.localdate(lesson_end):
+        errors['lesson_start'] = ValidationError("The lesson start should be same day as lesson end")
+    elif lesson_end - lesson_start > MAX_LESSON_LENGTH:
+        errors['lesson_end'] = ValidationError("The lesson should be no longer than %s" % MAX_LESSON_LENGTH)
+
+    return errors
+
 # Class to add lessons for the students, at this point not invoice is generated so these
 # fields could be hidden using HiddenInput(). Also used DateTimeInput to bring up calendar
 class AddLessonForm(ModelForm):
     class Meta:
         model = Lesson
-        exclude = ()
+        exclude = ('series',)
+        field_classes = REFERENCE_FIELDS
         widgets = {'lesson_start': DateTimeInput(), 
                    'lesson_end':DateTimeInput(),
                    'invoiced': forms.HiddenInput(), 
@@ -71,30 +140,27 @@ class AddLessonForm(ModelForm):
     # "TypeError: can't compare offset-naive and offset-aware datetimes"
     def clean(self):
         cleaned_data = super().clean()
+        errors = lessonTimesErrors(cleaned_data.get("lesson_start"), cleaned_data.get("lesson_end"))
+
+        if errors:
+            raise ValidationError(errors)
+
+        # The fields own errors are shown already if any of them are missing
+        term = cleaned_data.get("term")
+        if term is None or self.errors:
+            return cleaned_data
+
         lesson_start_str = datetime.strftime(cleaned_data.get("lesson_start"),"%Y-%m-%d %H:%M:%S")
-        lesson_start_day = datetime.strftime(cleaned_data.get("lesson_start"),"%d")
         lesson_start_date = datetime.strptime(lesson_start_str,"%Y-%m-%d %H:%M:%S")
         lesson_end_str = datetime.strftime(cleaned_data.get("lesson_end"),"%Y-%m-%d %H:%M:%S")
-        lesson_end_day = datetime.strftime(cleaned_data.get("lesson_end"),"%d")
         lesson_end_date = datetime.strptime(lesson_end_str,"%Y-%m-%d %H:%M:%S")
 
-        form_term = cleaned_data.get("term")
-        term = Term.objects.get(pk=form_term.pk)
-
         term_start_str = datetime.strftime(term.term_start_date, "%Y-%m-%d %H:%M:%S")
         term_start_mes = datetime.strftime(term.term_start_date, "%d/%m/%Y")
         term_start_date = datetime.strptime(term_start_str, "%Y-%m-%d %H:%M:%S")
         term_end_str = datetime.strftime(term.term_end_date, "%Y-%m-%d %H:%M:%S")
         term_end_mes = datetime.strftime(term.term_end_date, "%d/%m/%Y")
         term_end_date = datetime.strptime(term_end_str, "%Y-%m-%d %H:%M:%S")
-        
-        errors={}
-
-        if lesson_start_date > lesson_end_date:
-            errors['lesson_start'] = ValidationError("The lesson start should be before the lesson end")
-
-        if lesson_start_day != lesson_end_day:
-            errors['lesson_start'] = ValidationError("The lesson start should be same day as lesson end")
 
         if lesson_start_date < term_start_date:
             errors['lesson_start'] = ValidationError("The lesson start should on or after term start " +
@@ -104,6 +170,56 @@ class AddLessonForm(ModelForm):
             errors['lesson_end'] = ValidationError("The lesson start should on or before term end " +
                                                      term_end_mes)
 
+        # Only worth checking for clashes once the times themselves are right
+        if not errors:
+            clash = conflictMessage(cleaned_data.get("lesson_start"), cleaned_data.get("lesson_end"),
+                                    exclude=[self.instance.pk])
+            if clash:
+                errors['lesson_start'] = ValidationError(clash)
+
+        if errors:
+            raise ValidationError(errors)
+
+# Class to add or change a weekly series of lessons for a student over a term. The whole
+# series is checked here once rather than each lesson, every date is worked out from the
+# term so they are always inside it and half term is skipped.
+class LessonSeriesForm(ModelForm):
+    class Meta:
+        model = LessonSeries
+        exclude = ()
+        field_classes = REFERENCE_FIELDS
+        widgets = {'student': forms.HiddenInput(),
+                   'start_time': TimeInput(),
+                   'end_time': TimeInput()}
+
+    # Validation required to start can't be after end time
+    def clean(self):
+        cleaned_data = super().clean()
+        start_time = cleaned_data.get("start_time")
+        end_time = cleaned_data.get("end_time")
+        errors={}
+
+        if start_time and end_time and start_time >= end_time:
+            errors['start_time'] = ValidationError("The lesson start should be before the lesson end")
+
+        # Work out every lesson in the series, check their times as a single lesson's are
+        # and then against the booked lessons in one go. The series own lessons are left
+        # out as they are made again on an update.
+        if not errors and not self.errors:
+            series = LessonSeries(**{field: cleaned_data.get(field) for field in
+                                     ('student', 'lesson_type', 'term', 'weekday', 'start_time', 'end_time')})
+            lessons = seriesLessons(series)
+            for lesson in lessons:
+                times = lessonTimesErrors(lesson.lesson_start, lesson.lesson_end)
+                if times:
+                    raise ValidationError({'start_time': list(times.values())})
+
+            conflicts = findConflicts(lessons, exclude_series=self.instance.pk)
+            if conflicts:
+                clash = conflicts[0]['second'] if conflicts[0]['first'].get('new') else conflicts[0]['first']
+                errors['weekday'] = ValidationError("%d lessons in this series clash with other lessons, the first on %s" %
+                                                    (len(conflicts), timezone.localtime(clash['lesson_start']).strftime("%d/%m/%Y %H:%M")))
+
         if errors:
             raise ValidationError(errors)
 
@@ -112,18 +228,27 @@ class AddLessonForm(ModelForm):
 class UpdateLessonForm(ModelForm):
     class Meta:
         model = Lesson
-        exclude = ()
+        exclude = ('series',)
+        field_classes = REFERENCE_FIELDS
         widgets = {'student': forms.HiddenInput()}
 
+    # Only the invoices of the students parents can be picked, not every invoice there is
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['invoice_number'].queryset = Invoices.objects.filter(client__student=self.instance.student_id) \
+                                                                 .order_by('-date_created')
+
     # Validation required to start can't be after end datetime    
     def clean(self):
         cleaned_data = super().clean()
         lesson_start = cleaned_data.get("lesson_start")
         lesson_end = cleaned_data.get("lesson_end")
-        errors={}
+        errors = lessonTimesErrors(lesson_start, lesson_end)
 
-        if lesson_start > lesson_end:
-            errors['lesson_start'] = ValidationError("The lesson start should be before the lesson end")
+        if not errors and not self.errors:
+            clash = conflictMessage(lesson_start, lesson_end, exclude=[self.instance.pk])
+            if clash:
+                errors['lesson_start'] = ValidationError(clash)
 
         if errors:
             raise ValidationError(errors)
@@ -236,9 +361,12 @@ class UpdateTermForm(ModelForm):
 
 # Class to create new invoices
 class CreateInvoiceForm(ModelForm):
+    # Signed list of the lessons shown, so only those can be put on the invoice
+    claim_token = forms.CharField(widget=forms.HiddenInput())
+
     class Meta:
         model = Invoices
-        exclude = ()
+        exclude = ('invoice_number',)
         widgets = {'client': forms.HiddenInput(),
                    'amount_paid': forms.HiddenInput(),
                    'amount_outstanding': forms.HiddenInput()}
@@ -267,9 +395,9 @@ class CreateUserForm(UserCreationForm):
     def clean(self):
         cleaned_data = super().clean()
         email = cleaned_data.get("email")
-        check_reg_email = ContactDetails.objects.filter(email_address=email).exists()
+        check_reg_email = ContactDetails.objects.filter(email_address=normaliseEmail(email)).exists()
 
-        check_user_email = User.objects.filter(email=email).exists()
+        check_user_email = User.objects.filter(email__iexact=email).exists()
 
         errors={}
 
@@ -319,3 +447,55 @@ class UpdateInvoiceForm(ModelForm):
 
         if errors:
             raise ValidationError(errors)
+
+# Filters for the lesson, invoice and client exports. Not every filter applies to every
+# export, lessons use invoiced/uninvoiced, invoices use their status and clients use
+# active/inactive.
+class ExportFilterForm(forms.Form):
+    STATUS_CHOICES = [('', 'Any'), ('invoiced', 'Invoiced'), ('uninvoiced', 'Uninvoiced'),
+                      ('active', 'Active'), ('inactive', 'Inactive')] + \
+                     [(name.lower(), name) for value, name in Invoices.STATUS_CHOICES]
+
+    date_from = forms.DateField(required=False, widget=DateInput())
+    date_to = forms.DateField(required=False, widget=DateInput())
+    term = CachedTermField(queryset=Term.objects.all(), required=False)
+    status = forms.ChoiceField(choices=STATUS_CHOICES, required=False)
+
+    # Validation required to start can't be after end date
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from = cleaned_data.get("date_from")
+        date_to = cleaned_data.get("date_to")
+        errors={}
+
+        if date_from and date_to and date_from > date_to:
+            errors['date_from'] = ValidationError("Date from should be before date to")
+
+        if errors:
+            raise ValidationError(errors)
+
+# Bank statement to match payments against invoices, see reconcile.py. Check only reports
+# what would be matched without recording anything.
+class StatementForm(forms.Form):
+    statement = forms.FileField(help_text='CSV with date, amount, reference and name columns')
+    check_only = forms.BooleanField(required=False)
+
+# Day to show on the aged debt page, empty for today
+class AgedDebtForm(forms.Form):
+    date = forms.DateField(required=False, widget=DateInput())
+
+# Term to show on the revenue page, empty for every term, and how to add it up
+class RevenueForm(forms.Form):
+    GROUP_CHOICES = [('product', 'Product'), ('month', 'Month'), ('term', 'Term')]
+
+    term = CachedTermField(queryset=Term.objects.all(), required=False)
+    group = forms.ChoiceField(choices=GROUP_CHOICES, required=False)
+
+# Day, week or term of lessons to show on the timetable and a day in it, empty for today.
+# Adjacent asks for the windows either side as well, for the page to keep ready.
+class TimetableForm(forms.Form):
+    VIEW_CHOICES = [('day', 'Day'), ('week', 'Week'), ('term', 'Term')]
+
+    view = forms.ChoiceField(choices=VIEW_CHOICES, required=False)
+    date = forms.DateField(required=False, widget=DateInput())
+    adjacent = forms.BooleanField(required=False)
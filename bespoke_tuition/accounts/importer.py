@@ -0,0 +1,176 @@
+import csv
+import json
+import time
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils.dateparse import parse_date
+
+from .bulk import bulkCreate, chunks
+from .models import Client, Address, ContactDetails, Student, TuitionAddress, normaliseEmail
+
+# Rows validated and written in each transaction
+CHUNK_SIZE = 1000
+
+# Columns read from each row. A family is keyed on the email address so further rows
+# with the same email add more children to the same client. The student and tuition
+# address columns can be left empty for a client with no children yet.
+CLIENT_FIELDS = {'forename': 'forename', 'surname': 'surname'}
+ADDRESS_FIELDS = {'line_one': 'line_one', 'line_two': 'line_two', 'line_three': 'line_three',
+                  'town': 'town', 'postcode': 'postcode'}
+CONTACT_FIELDS = {'contact_number': 'contact_number', 'email_address': 'email_address'}
+STUDENT_FIELDS = {'student_forename': 'forename', 'student_surname': 'surname',
+                  'student_date_of_birth': 'date_of_birth', 'student_school_year': 'school_year'}
+TUITION_FIELDS = {'tuition_line_one': 'line_one', 'tuition_line_two': 'line_two',
+                  'tuition_line_three': 'line_three', 'tuition_town': 'town', 'tuition_postcode': 'postcode'}
+
+
+def readRows(source, file_format):
+    if file_format == 'jsonl':
+        for line in source:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        yield from csv.DictReader(source)
+
+
+def _pick(row, fields):
+    values = {}
+    for column, field in fields.items():
+        value = row.get(column)
+        if isinstance(value, str):
+            value = value.strip()
+        values[field] = value if value not in ('', None) else None
+    return values
+
+
+# Build an unsaved model from the row and run the field validators on it, the same ones
+# the forms use (letters_only, numbers_only, validate_email...). Uniqueness is checked
+# for the whole chunk at once instead so it is skipped here.
+def _validated(model, values, exclude, errors, prefix=''):
+    obj = model(**{field: value for field, value in values.items() if value is not None})
+    try:
+        obj.full_clean(exclude=exclude, validate_unique=False)
+    except ValidationError as error:
+        for field, messages in error.message_dict.items():
+            errors[prefix + field] = ' '.join(messages)
+    return obj
+
+
+class ImportResult:
+
+    def __init__(self):
+        self.rows = 0
+        self.clients = 0
+        self.students = 0
+        self.errors = []
+        self.seconds = 0
+
+    @property
+    def rows_per_minute(self):
+        return self.rows / self.seconds * 60 if self.seconds else 0
+
+
+# Validate and write one chunk of rows. Rows with errors are added to the result and
+# nothing from them is written.
+def importChunk(rows, start_row, families, result):
+    parsed = []
+    emails = set()
+
+    for row_number, row in enumerate(rows, start_row):
+        errors = {}
+        contact_values = _pick(row, CONTACT_FIELDS)
+        email = normaliseEmail(contact_values['email_address'])
+        student_values = _pick(row, STUDENT_FIELDS)
+
+        if student_values['date_of_birth']:
+            try:
+                student_values['date_of_birth'] = parse_date(student_values['date_of_birth']) or student_values['date_of_birth']
+            except ValueError:
+                pass
+        if student_values['school_year'] is None:
+            student_values.pop('school_year')
+
+        entry = {'row': row_number, 'email': email, 'errors': errors}
+
+        # Only the first row for a family needs the client details
+        if email not in families and email not in emails:
+            entry['client'] = _validated(Client, _pick(row, CLIENT_FIELDS), ['user'], errors)
+            entry['address'] = _validated(Address, _pick(row, ADDRESS_FIELDS), ['client'], errors, 'address.')
+            entry['contact'] = _validated(ContactDetails, dict(contact_values, email_address=email), ['client'],
+                                          errors, 'contact.')
+
+        if student_values['forename']:
+            entry['student'] = _validated(Student, student_values, ['parent'], errors, 'student.')
+            tuition_values = _pick(row, TUITION_FIELDS)
+            if tuition_values['line_one']:
+                entry['tuition'] = _validated(TuitionAddress, tuition_values, ['student'], errors, 'tuition.')
+
+        if not email:
+            errors['contact.email_address'] = 'An email address is required to match the family.'
+
+        parsed.append(entry)
+        if 'client' in entry and email:
+            emails.add(email)
+
+    # One query for the whole chunk to find emails already registered to a client
+    existing = set(ContactDetails.objects.filter(email_address__in=emails).values_list('email_address', flat=True))
+    new_families = set(families)
+
+    for entry in parsed:
+        if 'client' in entry:
+            if entry['email'] in existing:
+                entry['errors']['contact.email_address'] = 'A client with this email address already exists.'
+            elif not entry['errors']:
+                new_families.add(entry['email'])
+        elif entry['email'] not in new_families and not entry['errors']:
+            entry['errors']['contact.email_address'] = 'The first row for this family could not be imported.'
+
+    good = [entry for entry in parsed if not entry['errors']]
+    result.errors.extend({'row': entry['row'], 'errors': entry['errors']} for entry in parsed if entry['errors'])
+
+    with transaction.atomic():
+        client_entries = [entry for entry in good if 'client' in entry]
+        bulkCreate(Client, [entry['client'] for entry in client_entries])
+
+        for entry in client_entries:
+            entry['address'].client_id = entry['client'].pk
+            entry['contact'].client_id = entry['client'].pk
+            families[entry['email']] = entry['client'].pk
+
+        Address.objects.bulk_create([entry['address'] for entry in client_entries])
+        ContactDetails.objects.bulk_create([entry['contact'] for entry in client_entries])
+
+        student_entries = [entry for entry in good if 'student' in entry]
+        bulkCreate(Student, [entry['student'] for entry in student_entries])
+
+        Student.parent.through.objects.bulk_create(
+            [Student.parent.through(student_id=entry['student'].pk, client_id=families[entry['email']])
+             for entry in student_entries])
+
+        tuition = []
+        for entry in student_entries:
+            if 'tuition' in entry:
+                entry['tuition'].student_id = entry['student'].pk
+                tuition.append(entry['tuition'])
+        TuitionAddress.objects.bulk_create(tuition)
+
+    result.clients += len(client_entries)
+    result.students += len(student_entries)
+
+
+# Import clients and students from an open CSV or JSON lines file. Later rows with the
+# same email address as a family earlier in the file add more children to it, an email
+# already held for a client in the database is reported as an error.
+def importClients(source, file_format='csv', chunk_size=CHUNK_SIZE):
+    result = ImportResult()
+    families = {}
+    start = time.perf_counter()
+
+    for chunk in chunks(readRows(source, file_format), chunk_size):
+        importChunk(chunk, result.rows + 1, families, result)
+        result.rows += len(chunk)
+
+    result.seconds = time.perf_counter() - start
+
+    return result
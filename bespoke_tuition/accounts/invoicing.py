@@ -0,0 +1,254 @@
+import hashlib
+import time
+import multiprocessing
+
+from django.core import signing
+from django.db import connection, connections, transaction
+from django.db.models import Sum, OuterRef, Subquery, DecimalField
+
+from .balances import rebuildBalances, refreshUninvoiced, studentParents, uninvoicedTotals
+from .models import Client, Invoices, InvoiceLine, Lesson, Student
+from .numbering import InvoiceNumberAllocator, invoiceNumber, invoiceYear
+from .pricing import productOn
+from .rollups import lessonsInvoiced
+
+# Salt and lifetime for the claim tokens handed out with an invoice preview
+CLAIM_SALT = 'accounts.invoicing.claim'
+CLAIM_MAX_AGE = 60 * 60 * 4
+
+# Number of clients invoiced inside a single transaction. If a run crashes part way
+# through only the chunk being worked on is rolled back, every chunk before it is
+# already committed and the re-run simply won't find those lessons as uninvoiced.
+CHUNK_SIZE = 200
+
+
+# All clients that currently have at least one lesson waiting to be invoiced
+def clientsToInvoice():
+    return list(Client.objects.filter(student__lesson_student__invoiced=False)
+                              .distinct().order_by('pk').values_list('pk', flat=True))
+
+
+# Split the client ids into shards, one for each worker process
+def shardClients(client_ids, workers):
+    workers = max(1, workers)
+    return [client_ids[i::workers] for i in range(workers) if client_ids[i::workers]]
+
+
+# Write the line snapshots for the given invoices, one line for each product and price
+# on the invoice. Each lesson is priced for the day it took place from the cached price
+# timelines, so all the invoices need just one query for their lessons and the lines are
+# bulk created. Invoices that already have lines are left alone so this can be run again.
+def createInvoiceLines(invoice_ids):
+    invoice_ids = list(Invoices.objects.filter(pk__in=invoice_ids, lines__isnull=True).values_list('pk', flat=True))
+
+    lessons = Lesson.objects.filter(invoice_number__in=invoice_ids) \
+                            .values_list('invoice_number', 'lesson_type', 'lesson_start') \
+                            .order_by('invoice_number', 'lesson_type', 'lesson_start')
+
+    grouped = {}
+    for invoice_id, lesson_type_id, lesson_start in lessons.iterator(chunk_size=2000):
+        product = productOn(lesson_type_id, lesson_start)
+        grouped.setdefault((invoice_id, lesson_type_id, product.price), [product, 0])[1] += 1
+
+    lines = [InvoiceLine(invoice_id=invoice_id,
+                         product_id=lesson_type_id,
+                         product_name=product.product_name,
+                         unit_price=price,
+                         quantity=quantity,
+                         line_total=price * quantity)
+             for (invoice_id, lesson_type_id, price), (product, quantity) in grouped.items()]
+
+    InvoiceLine.objects.bulk_create(lines, batch_size=1000)
+
+    return len(lines)
+
+
+# Lines for the invoice detail pages. Invoices made before the snapshots existed get
+# theirs written the first time they are looked at.
+def invoiceLines(invoice):
+    lines = list(invoice.lines.all())
+
+    if not lines and createInvoiceLines([invoice.pk]):
+        lines = list(invoice.lines.all())
+
+    return lines
+
+
+class ClaimError(Exception):
+    pass
+
+
+# What an invoice preview showed for each lesson. If any of it changes before the invoice
+# is made the claim fails rather than billing something that wasn't shown.
+def _claimRows(lessons):
+    return sorted((lesson.pk, lesson.student_id, lesson.lesson_type_id, lesson.lesson_start.isoformat())
+                  for lesson in lessons)
+
+
+def _fingerprint(rows):
+    return hashlib.sha256(repr(rows).encode()).hexdigest()
+
+
+# Signed token for the lessons shown in an invoice preview, posted back with the form
+def claimToken(client, lessons):
+    rows = _claimRows(lessons)
+    return signing.dumps({'client': client.pk, 'lessons': [row[0] for row in rows], 'fingerprint': _fingerprint(rows)},
+                         salt=CLAIM_SALT, compress=True)
+
+
+# Save the invoice and link exactly the lessons in the claim token to it, all in one
+# transaction. Lessons are claimed with a conditional update on invoiced=False instead
+# of locking them while the admin looks at the preview. If another admin, a double click
+# or a batch worker got any of them first, or a lesson was changed since the preview,
+# the claim comes up short and everything is rolled back. Lessons added after the
+# preview was shown aren't in the token so are left for the next invoice. The total is
+# set from the invoice lines once they are written.
+def claimLessons(invoice, token):
+    try:
+        claim = signing.loads(token, salt=CLAIM_SALT, max_age=CLAIM_MAX_AGE)
+    except signing.BadSignature:
+        raise ClaimError('The invoice preview has expired, please check the lessons and try again')
+
+    if claim['client'] != invoice.client_id:
+        raise ClaimError('The invoice preview was for a different client')
+
+    with transaction.atomic():
+        invoice.save()
+        claimed = Lesson.objects.filter(pk__in=claim['lessons'], invoiced=False) \
+                                .update(invoiced=True, invoice_number=invoice)
+        rows = _claimRows(Lesson.objects.filter(invoice_number=invoice))
+
+        if claimed != len(claim['lessons']) or _fingerprint(rows) != claim['fingerprint']:
+            raise ClaimError('Some of these lessons have been invoiced or changed since they were shown, '
+                             'please check them again')
+
+        # The totals come from the lines just written rather than the posted form, so an
+        # edited or stale preview can't make an invoice that disagrees with its lines
+        createInvoiceLines([invoice.pk])
+        total = invoice.lines.aggregate(total=Sum('line_total'))['total'] or 0
+        invoice.total_amount = total
+        invoice.amount_outstanding = total - (invoice.amount_paid or 0)
+        invoice.save(update_fields=['total_amount', 'amount_outstanding'])
+        # The update doesn't send signals so work out the uninvoiced balances again
+        refreshUninvoiced(studentParents(set(row[1] for row in rows)))
+        lessonsInvoiced(Lesson.objects.filter(invoice_number=invoice))
+
+    return claimed
+
+
+# Invoice one chunk of clients in a single transaction. Totals are worked out by the
+# database, the invoices are bulk created and then each clients lessons are linked with
+# one update. Once the lessons are linked the lines are written, priced for the day of
+# each lesson, and the totals set again from them. That way a student shared by two
+# parents is only billed once and old lessons are charged at the price at the time.
+# Invoice numbers are taken before the transaction starts so the sequence row isn't
+# locked while the chunk runs, any not needed are handed back to the allocator.
+def invoiceChunk(client_ids, now=None, allocator=None):
+    year = invoiceYear(now)
+    allocator = allocator or InvoiceNumberAllocator(block_size=len(client_ids))
+    numbers = allocator.take(len(client_ids), year)
+    invoice_count = 0
+    lesson_count = 0
+
+    with transaction.atomic():
+        totals = uninvoicedTotals(client_ids)
+
+        clients = Client.objects.filter(pk__in=[pk for pk, total in totals.items() if total and total > 0]) \
+                                .order_by('pk')
+
+        new_invoices = [Invoices(invoice_number=invoiceNumber(client.surname, year, number),
+                                 client=client,
+                                 status=Invoices.DRAFT,
+                                 total_amount=totals[client.pk],
+                                 amount_paid=0,
+                                 amount_outstanding=totals[client.pk]) for client, number in zip(clients, numbers)]
+        allocator.giveBack(numbers[len(new_invoices):], year)
+
+        if not new_invoices:
+            return invoice_count, lesson_count
+
+        Invoices.objects.bulk_create(new_invoices)
+
+        # bulk_create doesn't return primary keys on sqlite so fetch them back again
+        created = Invoices.objects.filter(invoice_number__in=[i.invoice_number for i in new_invoices])
+
+        for invoice in created:
+            lesson_count += Lesson.objects.filter(invoiced=False, student__parent=invoice.client_id) \
+                                          .update(invoiced=True, invoice_number=invoice)
+
+        createInvoiceLines(created.values_list('pk', flat=True))
+
+        # Another parent may have claimed every lesson first, no point keeping an empty
+        # invoice. They go before the totals are set as they have no lines to total.
+        Invoices.objects.filter(pk__in=created, lines__isnull=True).delete()
+
+        claimed = InvoiceLine.objects.filter(invoice=OuterRef('pk')).values('invoice') \
+                                     .annotate(total=Sum('line_total')).values('total')
+        claimed_total = Subquery(claimed, output_field=DecimalField(max_digits=8, decimal_places=2))
+        created.update(total_amount=claimed_total, amount_outstanding=claimed_total)
+        invoice_count = Invoices.objects.filter(pk__in=created).count()
+
+        # Bulk creates and updates don't send signals so update the balances here. Other
+        # parents of the same students have had lessons taken off their uninvoiced total.
+        rebuildBalances(client_ids)
+        refreshUninvoiced(set(studentParents(Student.objects.filter(parent__in=client_ids))) - set(client_ids))
+        lessonsInvoiced(Lesson.objects.filter(invoice_number__in=created))
+
+    return invoice_count, lesson_count
+
+
+# Invoice every client in a shard, chunk by chunk, and time how long it takes
+def invoiceShard(shard_no, client_ids, chunk_size=CHUNK_SIZE):
+    start = time.perf_counter()
+    allocator = InvoiceNumberAllocator()
+    invoice_count = 0
+    lesson_count = 0
+
+    for i in range(0, len(client_ids), chunk_size):
+        invoices, lessons = invoiceChunk(client_ids[i:i + chunk_size], allocator=allocator)
+        invoice_count += invoices
+        lesson_count += lessons
+
+    seconds = time.perf_counter() - start
+
+    return {'shard': shard_no,
+            'clients': len(client_ids),
+            'invoices': invoice_count,
+            'lessons': lesson_count,
+            'seconds': seconds,
+            'invoices_per_second': invoice_count / seconds if seconds else 0}
+
+
+# Entry point for the worker processes. Each one opens its own connection so it needs
+# closing once the shard is finished.
+def _invoiceShardWorker(args):
+    try:
+        return invoiceShard(*args)
+    finally:
+        connections.close_all()
+
+
+# Run the end of month invoicing for every client with uninvoiced lessons. With one
+# worker everything runs in this process, otherwise the clients are sharded over a
+# pool of worker processes and the results for each shard are returned. sqlite only
+# takes writes from one connection at a time, the other workers would fail part way
+# through with "database is locked", so more than one worker is refused there.
+def runInvoices(client_ids=None, workers=1, chunk_size=CHUNK_SIZE):
+    if workers > 1 and connection.vendor == 'sqlite':
+        raise ValueError('Invoicing with more than one worker needs a database that takes writes from '
+                         'several connections at once, sqlite only takes one. Run it with one worker.')
+
+    if client_ids is None:
+        client_ids = clientsToInvoice()
+
+    shards = shardClients(list(client_ids), workers)
+
+    if workers <= 1 or len(shards) <= 1:
+        return [invoiceShard(shard_no, shard, chunk_size) for shard_no, shard in enumerate(shards)]
+
+    # Connections can't be shared with the forked processes so close them first
+    connections.close_all()
+
+    with multiprocessing.Pool(processes=len(shards)) as pool:
+        return pool.map(_invoiceShardWorker,
+                        [(shard_no, shard, chunk_size) for shard_no, shard in enumerate(shards)])
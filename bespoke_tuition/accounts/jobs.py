@@ -0,0 +1,225 @@
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .ageddebt import takeSnapshot
+from .invoicing import runInvoices
+from .models import Job
+from .refdata import recheckVersions
+
+# First retry waits this many seconds, doubling after every failed attempt
+BACKOFF_SECONDS = 30
+
+# How long a worker waits before looking for new jobs when the queue is empty
+POLL_SECONDS = 2
+
+# A worker marks the job it is running as alive this often
+HEARTBEAT_SECONDS = 30
+
+# A running job with no heartbeat for this long is assumed to have lost its worker (the
+# process was killed part way through). It is queued again, or failed if it has used up
+# its attempts.
+STALE_SECONDS = 5 * 60
+
+# How often each worker looks for jobs that have lost their worker
+STALE_CHECK_SECONDS = 60
+
+LOST_WORKER = 'The worker running this job stopped before it finished'
+
+# Functions that can be run as jobs, by task name
+TASKS = {}
+
+
+# Register a function as a job task. It is called with the job arguments as keyword
+# arguments and whatever it returns (which must be JSON friendly) is saved as the result.
+def task(name):
+    def register(function):
+        TASKS[name] = function
+        return function
+    return register
+
+
+def enqueue(task_name, delay=0, max_attempts=3, **arguments):
+    if task_name not in TASKS:
+        raise KeyError('No job task called %s' % task_name)
+
+    return Job.objects.create(task=task_name, arguments=arguments, max_attempts=max_attempts,
+                              run_after=timezone.now() + timedelta(seconds=delay))
+
+
+def workerName():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+# Claim the next job that is due. The oldest due job is read then claimed with an update
+# that only matches while it is still queued, if another worker got there first it
+# simply moves on to the next one. No rows are locked while a job runs.
+def claimJob(worker):
+    while True:
+        now = timezone.now()
+        job_id = Job.objects.filter(status=Job.QUEUED, run_after__lte=now) \
+                            .order_by('run_after', 'pk').values_list('pk', flat=True).first()
+        if job_id is None:
+            return None
+
+        if Job.objects.filter(pk=job_id, status=Job.QUEUED) \
+                      .update(status=Job.RUNNING, worker=worker, started_at=now, heartbeat_at=now,
+                              attempts=F('attempts') + 1):
+            return Job.objects.get(pk=job_id)
+
+
+# The job as long as it is still on the claim given. Once a job has been queued again
+# and claimed by another worker its attempts have moved on, so the old worker can't
+# change it any more.
+def _claimed(job):
+    return Job.objects.filter(pk=job.pk, status=Job.RUNNING, worker=job.worker, attempts=job.attempts)
+
+
+# Mark the job as still being run by the worker that claimed it
+def heartbeat(job):
+    return _claimed(job).update(heartbeat_at=timezone.now())
+
+
+# Thread sending the heartbeats for a job while it runs, so a long job isn't mistaken for
+# one that has lost its worker. A heartbeat that can't be written (the database is busy)
+# is tried again next time.
+class Heartbeat:
+
+    def __init__(self, job, interval=HEARTBEAT_SECONDS):
+        self.job = job
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._beat, name='job-heartbeat', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+    def _beat(self):
+        try:
+            while not self._stopped.wait(self.interval):
+                try:
+                    heartbeat(self.job)
+                except DatabaseError:
+                    pass
+        finally:
+            connection.close()
+
+
+# Run a claimed job and record how it went. A failed job is queued again after a back off
+# until it runs out of attempts. Nothing is recorded if the job was taken off this worker
+# while it ran.
+def runJob(job):
+    start = time.perf_counter()
+    wait = (job.started_at - job.run_after).total_seconds()
+
+    # Like a request, each job sees products and terms changed since the last one
+    recheckVersions()
+
+    try:
+        with Heartbeat(job):
+            result = TASKS[job.task](**job.arguments)
+    except Exception:
+        run_seconds = time.perf_counter() - start
+        error = traceback.format_exc()
+        if job.attempts < job.max_attempts:
+            retry_at = timezone.now() + timedelta(seconds=BACKOFF_SECONDS * 2 ** (job.attempts - 1))
+            _claimed(job).update(status=Job.QUEUED, run_after=retry_at, error=error,
+                                 wait_seconds=wait, run_seconds=run_seconds)
+        else:
+            _claimed(job).update(status=Job.FAILED, error=error, finished_at=timezone.now(),
+                                 wait_seconds=wait, run_seconds=run_seconds)
+        return False
+
+    return bool(_claimed(job).update(status=Job.DONE, result=result, error='', finished_at=timezone.now(),
+                                     wait_seconds=wait, run_seconds=time.perf_counter() - start))
+
+
+# Put running jobs whose worker has gone back on the queue, or fail them if they have had
+# all their attempts. Jobs from before heartbeats were sent go by when they started.
+# Returns the number queued again and the number failed.
+def requeueStale(stale_seconds=STALE_SECONDS):
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=stale_seconds)
+    stale = Job.objects.filter(Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff),
+                               status=Job.RUNNING)
+
+    failed = stale.filter(attempts__gte=F('max_attempts')) \
+                  .update(status=Job.FAILED, error=LOST_WORKER, finished_at=now)
+    requeued = stale.update(status=Job.QUEUED, run_after=now, worker='', error=LOST_WORKER)
+    return requeued, failed
+
+
+# Worker loop. With once set it stops as soon as the queue is empty, otherwise it keeps
+# polling. Jobs that have lost their worker are looked for when it starts and then every
+# STALE_CHECK_SECONDS. Returns the number of jobs run.
+def work(worker=None, once=False, poll_seconds=POLL_SECONDS, max_jobs=None):
+    worker = worker or workerName()
+    count = 0
+    last_check = None
+
+    while max_jobs is None or count < max_jobs:
+        if last_check is None or time.monotonic() - last_check >= STALE_CHECK_SECONDS:
+            requeueStale()
+            last_check = time.monotonic()
+
+        job = claimJob(worker)
+        if job is None:
+            if once:
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        runJob(job)
+        count += 1
+
+    return count
+
+
+# Entry point for each worker process started by the runjobs command
+def _workProcess(args):
+    worker, once, poll_seconds = args
+    try:
+        return work(worker, once, poll_seconds)
+    finally:
+        connections.close_all()
+
+
+# The job workers are daemon processes which can't start a pool of their own, run more
+# job workers instead
+@task('invoices')
+def invoicesTask(client_ids=None, workers=1):
+    if workers > 1:
+        raise ValueError('An invoices job runs with one worker, start more job workers to run more at once')
+    return runInvoices(client_ids)
+
+
+@task('ageddebtsnapshot')
+def agedDebtTask():
+    return takeSnapshot()
+
+
+# Management commands that can be queued, the output is kept as the result
+def _commandTask(name):
+    def run():
+        output = StringIO()
+        call_command(name, stdout=output)
+        return {'output': output.getvalue()}
+    return run
+
+
+for command in ('reconcilebalances', 'backfillinvoicelines', 'rebuildrollups'):
+    task(command)(_commandTask(command))
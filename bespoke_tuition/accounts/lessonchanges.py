@@ -0,0 +1,42 @@
+import threading
+from contextlib import contextmanager
+
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+
+from .models import Lesson
+
+# Everything the lesson receivers in balances and rollups need from a lesson's row as it
+# was before a save
+SNAPSHOT_FIELDS = ['student_id', 'invoiced', 'lesson_type_id', 'lesson_start', 'term_id']
+
+_paused = threading.local()
+
+
+# Stop the lesson receivers adjusting the balances and rollups one row at a time. Used
+# around bulk lesson changes which bring both up to date once at the end instead.
+@contextmanager
+def pauseLessonReceivers():
+    previous = getattr(_paused, 'lessons', False)
+    _paused.lessons = True
+    try:
+        yield
+    finally:
+        _paused.lessons = previous
+
+
+def lessonReceiversPaused():
+    return getattr(_paused, 'lessons', False)
+
+
+# The lesson's row before it was saved, None for a new lesson
+def lessonBefore(instance):
+    return getattr(instance, '_lesson_before', None)
+
+
+# Read the old row once for every receiver, so the change can be worked out after saving
+@receiver(pre_save, sender=Lesson)
+def lessonBeforeSave(sender, instance, **kwargs):
+    instance._lesson_before = None
+    if instance.pk and not lessonReceiversPaused():
+        instance._lesson_before = Lesson.objects.filter(pk=instance.pk).values(*SNAPSHOT_FIELDS).first()
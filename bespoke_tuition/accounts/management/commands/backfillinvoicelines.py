@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from accounts.invoicing import createInvoiceLines
+from accounts.models import Invoices
+
+
+# Writes the invoice line snapshots for invoices created before they existed. Invoices
+# that already have lines are skipped so it can be run more than once.
+class Command(BaseCommand):
+    help = 'Create invoice line snapshots for existing invoices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        missing = Invoices.objects.filter(lines__isnull=True).order_by('pk')
+        last_pk = 0
+        invoice_count = 0
+        line_count = 0
+
+        while True:
+            batch = list(missing.filter(pk__gt=last_pk).values_list('pk', flat=True)[:options['batch_size']])
+            if not batch:
+                break
+
+            with transaction.atomic():
+                line_count += createInvoiceLines(batch)
+
+            invoice_count += len(batch)
+            last_pk = batch[-1]
+            self.stdout.write('Checked %d invoices' % invoice_count)
+
+        self.stdout.write(self.style.SUCCESS('Created %d invoice lines' % line_count))
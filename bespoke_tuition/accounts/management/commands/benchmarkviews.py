@@ -0,0 +1,166 @@
+import json
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client as TestClient
+from django.urls import reverse, NoReverseMatch
+from django.utils import timezone
+
+from accounts.calendars import feedToken, CLIENT
+from accounts.models import Client, Student, Lesson, LessonSeries, Invoices, Products, Term, Job
+from accounts.querycount import QueryRecorder
+from accounts.urls import QUERY_BUDGETS
+
+# Logging out would end the session part way through the run
+SKIPPED_URLS = ['logout']
+
+# Customer pages that need the user to be linked to a client
+CLIENT_URLS = ['clientview', 'clientinvoices', 'clientdetailedinvoice']
+
+
+# Use the first row of each table to fill in the url arguments
+def sampleUrlArgs(user):
+    client = getattr(user, 'client', None) or Client.objects.order_by('pk').first()
+    student = Student.objects.order_by('pk').first()
+    lesson = Lesson.objects.order_by('pk').first()
+    invoice = Invoices.objects.filter(client=client).order_by('pk').first() or Invoices.objects.order_by('pk').first()
+    product = Products.objects.order_by('pk').first()
+    term = Term.objects.order_by('pk').first()
+    series = LessonSeries.objects.order_by('pk').first()
+    job = Job.objects.order_by('pk').first()
+
+    args = {'export': ['lessons'], 'queuejob': ['invoices']}
+    if client is not None:
+        args['calendarfeed'] = [feedToken(CLIENT, client)]
+    for names, row in ((['client', 'accountsdetailed'], client),
+                       (['student', 'addlessons', 'addseries'], student),
+                       (['updatelesson', 'deletelesson'], lesson),
+                       (['invoicesdetailed', 'updateinvoice', 'clientdetailedinvoice'], invoice),
+                       (['updateproduct'], product),
+                       (['updateterm', 'lessonconflicts'], term),
+                       (['updateseries', 'cancelseries'], series),
+                       (['jobdetail'], job)):
+        if row is not None:
+            for name in names:
+                args[name] = [row.pk]
+
+    return args
+
+
+# Get a page and read all of its body. A streaming response (the exports) only runs its
+# queries and builds its body as the content is read.
+def fetch(browser, url):
+    response = browser.get(url)
+    if response.streaming:
+        b''.join(response.streaming_content)
+    return response
+
+
+# Value at the given percentile from an already sorted list
+def percentile(values, percent):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+# Calls every accounts page through the Django test client against the current database
+# and reports latency percentiles, query count and peak memory for each one. Results are
+# saved as JSON so they can be compared with a previous run using --compare.
+class Command(BaseCommand):
+    help = 'Benchmark every accounts view and save the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--username', help='Admin user to run as, defaults to the first superuser')
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--output', default='benchmark.json')
+        parser.add_argument('--compare', help='Previous results file to compare against')
+        parser.add_argument('--url', action='append', dest='urls', help='Only benchmark these url names')
+
+    def handle(self, *args, **options):
+        if options['username']:
+            user = User.objects.filter(username=options['username']).first()
+        else:
+            user = User.objects.filter(is_superuser=True).order_by('pk').first()
+
+        if user is None:
+            raise CommandError('No user found to run the benchmark as')
+
+        browser = TestClient(HTTP_HOST='localhost', raise_request_exception=False)
+        browser.force_login(user)
+
+        url_args = sampleUrlArgs(user)
+        names = options['urls'] or [name for name in QUERY_BUDGETS if name not in SKIPPED_URLS]
+        if not Client.objects.filter(user=user).exists():
+            self.stderr.write('%s is not linked to a client, skipping the customer pages' % user)
+            names = [name for name in names if name not in CLIENT_URLS]
+        results = {}
+
+        for name in names:
+            try:
+                url = reverse('accounts:' + name, args=url_args.get(name, []))
+            except NoReverseMatch:
+                self.stderr.write('Skipping %s, no data to build the url' % name)
+                continue
+
+            results[name] = self.benchmarkUrl(browser, url, options['iterations'])
+            self.stdout.write('%-22s p50 %7.1fms  p95 %7.1fms  p99 %7.1fms  %4d queries  %8.1fKiB  %s' % (
+                name, results[name]['p50_ms'], results[name]['p95_ms'], results[name]['p99_ms'],
+                results[name]['queries'], results[name]['peak_memory_kib'], results[name]['status']))
+
+        output = {'date': timezone.now().isoformat(),
+                  'iterations': options['iterations'],
+                  'rows': {'clients': Client.objects.count(),
+                           'students': Student.objects.count(),
+                           'lessons': Lesson.objects.count(),
+                           'invoices': Invoices.objects.count()},
+                  'views': results}
+
+        with open(options['output'], 'w') as results_file:
+            json.dump(output, results_file, indent=2)
+
+        self.stdout.write(self.style.SUCCESS('Results saved to %s' % options['output']))
+
+        if options['compare']:
+            self.compare(options['compare'], results)
+
+    def benchmarkUrl(self, browser, url, iterations):
+        timings = []
+
+        for i in range(iterations):
+            start = time.perf_counter()
+            response = fetch(browser, url)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        # Query count and memory are measured on one extra request as tracing slows it down
+        tracemalloc.start()
+        with QueryRecorder() as recorder:
+            fetch(browser, url)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        timings.sort()
+
+        return {'url': url,
+                'status': response.status_code,
+                'p50_ms': percentile(timings, 50),
+                'p95_ms': percentile(timings, 95),
+                'p99_ms': percentile(timings, 99),
+                'queries': recorder.count,
+                'query_ms': recorder.total_time * 1000,
+                'peak_memory_kib': peak / 1024}
+
+    def compare(self, filename, results):
+        with open(filename) as previous_file:
+            previous = json.load(previous_file)['views']
+
+        self.stdout.write('Compared with %s:' % filename)
+        for name, result in results.items():
+            if name not in previous:
+                continue
+            before = previous[name]
+            change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0
+            self.stdout.write('%-22s p95 %7.1fms -> %7.1fms (%+.0f%%)  queries %d -> %d' % (
+                name, before['p95_ms'], result['p95_ms'], change, before['queries'], result['queries']))
@@ -0,0 +1,76 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client as TestClient
+from django.urls import reverse, NoReverseMatch
+
+from accounts.management.commands.benchmarkviews import sampleUrlArgs, SKIPPED_URLS, CLIENT_URLS
+from accounts.models import Client
+from accounts.querycount import QueryRecorder
+from accounts.queryplans import checkQueries
+from accounts.urls import QUERY_BUDGETS
+
+# Pages that read a whole table on purpose, and the tables they are allowed to scan. The
+# add student page has a tick box for every client to choose the parents from.
+ALLOWED_SCANS = {'export': ['accounts_lesson', 'accounts_invoices', 'accounts_client'],
+                 'addstudent': ['accounts_client']}
+
+
+# Calls every accounts page and runs EXPLAIN QUERY PLAN (EXPLAIN on postgres) on each
+# SELECT it issues. Fails if any of them reads one of the large tables with a full scan,
+# which usually means a filter or ordering has no index behind it. Run against a
+# database with realistic data in it (see seeddata) as planners ignore indexes on
+# tables with only a few rows.
+class Command(BaseCommand):
+    help = 'Fail if any accounts page reads a large table with a full table scan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--username', help='Admin user to run as, defaults to the first superuser')
+        parser.add_argument('--url', action='append', dest='urls', help='Only check these url names')
+
+    def handle(self, *args, **options):
+        if options['username']:
+            user = User.objects.filter(username=options['username']).first()
+        else:
+            user = User.objects.filter(is_superuser=True).order_by('pk').first()
+
+        if user is None:
+            raise CommandError('No user found to run the checks as')
+
+        browser = TestClient(HTTP_HOST='localhost', raise_request_exception=False)
+        browser.force_login(user)
+
+        url_args = sampleUrlArgs(user)
+        names = options['urls'] or [name for name in QUERY_BUDGETS if name not in SKIPPED_URLS]
+        if not Client.objects.filter(user=user).exists():
+            names = [name for name in names if name not in CLIENT_URLS]
+        failed = 0
+
+        for name in names:
+            try:
+                url = reverse('accounts:' + name, args=url_args.get(name, []))
+            except NoReverseMatch:
+                self.stderr.write('Skipping %s, no data to build the url' % name)
+                continue
+
+            with QueryRecorder() as recorder:
+                response = browser.get(url)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+
+            problems = [problem for problem in checkQueries(recorder.queries)
+                        if set(problem['tables']) - set(ALLOWED_SCANS.get(name, []))]
+            if not problems:
+                self.stdout.write('%-22s ok, %d queries' % (name, recorder.count))
+                continue
+
+            failed += 1
+            for problem in problems:
+                self.stdout.write(self.style.ERROR('%-22s full scan of %s' % (name, ', '.join(problem['tables']))))
+                self.stdout.write('    ' + problem['sql'])
+                for line in problem['plan']:
+                    self.stdout.write('      ' + line)
+
+        if failed:
+            raise CommandError('%d pages read a large table with a full scan' % failed)
+
+        self.stdout.write(self.style.SUCCESS('No full scans of large tables'))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.exports import EXPORTS, FORMATS
+from accounts.forms import ExportFilterForm
+
+
+# Command line version of the export pages, writes lessons, invoices or clients as CSV or
+# JSON lines to a file or stdout. Rows are streamed in chunks so memory stays flat.
+class Command(BaseCommand):
+    help = 'Export lessons, invoices or clients as CSV or JSON lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('export', choices=list(EXPORTS))
+        parser.add_argument('--format', choices=list(FORMATS), default='csv')
+        parser.add_argument('--from', dest='date_from', help='YYYY-MM-DD')
+        parser.add_argument('--to', dest='date_to', help='YYYY-MM-DD')
+        parser.add_argument('--term', help='Term id')
+        parser.add_argument('--status')
+        parser.add_argument('--output', help='File to write to, defaults to stdout')
+
+    def handle(self, *args, **options):
+        filter_form = ExportFilterForm({'date_from': options['date_from'], 'date_to': options['date_to'],
+                                        'term': options['term'], 'status': options['status']})
+        if not filter_form.is_valid():
+            raise CommandError(filter_form.errors.as_text())
+
+        lines, content_type = FORMATS[options['format']]
+        rows = lines(options['export'], **filter_form.cleaned_data)
+
+        if not options['output']:
+            for line in rows:
+                self.stdout.write(line, ending='')
+            return
+
+        with open(options['output'], 'w', newline='') as output:
+            for line in rows:
+                output.write(line)
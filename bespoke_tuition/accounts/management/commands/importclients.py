@@ -0,0 +1,46 @@
+import csv
+
+from django.core.management.base import BaseCommand
+
+from accounts.importer import importClients, CHUNK_SIZE
+
+
+# Bulk import of clients, their address and contact details and their children from a
+# CSV or JSON lines file. Rows with errors are skipped and listed in the error report.
+class Command(BaseCommand):
+    help = 'Import clients and students from a CSV or JSON lines file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], default=None,
+                            help='Defaults to the file extension')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+        parser.add_argument('--errors', help='CSV file to write the rows with errors to')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or ('jsonl' if options['file'].endswith('.jsonl') else 'csv')
+
+        with open(options['file'], newline='') as source:
+            result = importClients(source, file_format, options['chunk_size'])
+
+        self.stdout.write('Read %d rows in %.1fs (%.0f rows/minute)' % (result.rows, result.seconds,
+                                                                      result.rows_per_minute))
+        self.stdout.write(self.style.SUCCESS('Imported %d clients and %d students' % (result.clients,
+                                                                                       result.students)))
+
+        if not result.errors:
+            return
+
+        self.stdout.write(self.style.WARNING('%d rows had errors' % len(result.errors)))
+
+        if options['errors']:
+            with open(options['errors'], 'w', newline='') as report:
+                writer = csv.writer(report)
+                writer.writerow(['row', 'field', 'error'])
+                for error in result.errors:
+                    for field, message in error['errors'].items():
+                        writer.writerow([error['row'], field, message])
+        else:
+            for error in result.errors:
+                for field, message in error['errors'].items():
+                    self.stdout.write('Row %d %s: %s' % (error['row'], field, message))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.conflicts import iterTermConflicts
+from accounts.models import Term
+
+
+# Lists every pair of lessons that clash in a term. The lessons are read once in start
+# order so this is fine to run against a term with a very large number of lessons.
+class Command(BaseCommand):
+    help = 'List lessons in a term that overlap each other'
+
+    def add_arguments(self, parser):
+        parser.add_argument('term', help='Term id or name')
+
+    def handle(self, *args, **options):
+        term = Term.objects.filter(term_name=options['term']).first()
+        if term is None and options['term'].isdigit():
+            term = Term.objects.filter(pk=options['term']).first()
+        if term is None:
+            raise CommandError('No term called %s' % options['term'])
+
+        count = 0
+        for conflict in iterTermConflicts(term):
+            count += 1
+            first, second = conflict['first'], conflict['second']
+            self.stdout.write('%s lesson %d %s - %s clashes with lesson %d %s - %s' % (
+                conflict['kind'], first['pk'], first['lesson_start'], first['lesson_end'],
+                second['pk'], second['lesson_start'], second['lesson_end']))
+
+        self.stdout.write(self.style.SUCCESS('%d clashes in %s' % (count, term.term_name)))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from accounts.rollups import rebuildRollups
+
+
+# Rebuilds the revenue rollups from the lessons. Use after loading lessons outside the
+# app, or after a price change that reaches back to lessons already counted.
+class Command(BaseCommand):
+    help = 'Rebuild the revenue rollups from scratch'
+
+    def handle(self, *args, **options):
+        rows = rebuildRollups()
+        self.stdout.write(self.style.SUCCESS('Revenue rollups rebuilt, %d rows' % rows))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from accounts.balances import rebuildBalances
+from accounts.models import Client
+
+
+# Rebuilds every client balance from their invoices and lessons. Use after loading data
+# outside the app or if the running balances are ever thought to be wrong.
+class Command(BaseCommand):
+    help = 'Rebuild the client balance ledger from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        client_ids = list(Client.objects.order_by('pk').values_list('pk', flat=True))
+        rebuilt = 0
+
+        for i in range(0, len(client_ids), options['batch_size']):
+            with transaction.atomic():
+                rebuilt += rebuildBalances(client_ids[i:i + options['batch_size']])
+            self.stdout.write('Rebuilt %d of %d balances' % (rebuilt, len(client_ids)))
+
+        self.stdout.write(self.style.SUCCESS('Balances rebuilt for %d clients' % rebuilt))
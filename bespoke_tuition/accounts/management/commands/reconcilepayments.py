@@ -0,0 +1,46 @@
+import csv
+
+from django.core.management.base import BaseCommand
+
+from accounts.reconcile import reconcileStatement, MATCHED, CHUNK_SIZE
+
+
+# Match the payments on a bank statement CSV to invoices and record them. Lines that
+# don't match exactly one open invoice are listed, or written to the report file.
+class Command(BaseCommand):
+    help = 'Reconcile payments on a bank statement CSV against the invoices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+        parser.add_argument('--check-only', action='store_true',
+                            help='Report the matches without recording any payments')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+        parser.add_argument('--report', help='CSV file to write the lines not matched to')
+
+    def handle(self, *args, **options):
+        with open(options['file'], newline='', encoding='utf-8-sig') as source:
+            result = reconcileStatement(source, apply=not options['check_only'],
+                                        chunk_size=options['chunk_size'])
+
+        self.stdout.write('Read %d payments in %.1fs, %d lines of money out ignored' % (len(result.lines),
+                                                                                        result.seconds,
+                                                                                        result.ignored))
+        self.stdout.write(self.style.SUCCESS('Matched %d, recorded %s' % (len(result.matched), result.applied)))
+
+        problems = [line for line in result.lines if line['result'] != MATCHED]
+        if not problems:
+            return
+
+        self.stdout.write(self.style.WARNING('%d unmatched, %d ambiguous, %d already recorded' % (
+            len(result.unmatched), len(result.ambiguous), len(result.duplicates))))
+
+        if options['report']:
+            with open(options['report'], 'w', newline='') as report:
+                writer = csv.writer(report)
+                writer.writerow(['line', 'date', 'amount', 'reference', 'name', 'result', 'invoice', 'reason'])
+                for line in problems:
+                    writer.writerow([line['line'], line['date'], line['amount'], line['reference'], line['name'],
+                                     line['result'], line.get('invoice_number', ''), line['reason']])
+        else:
+            for line in problems:
+                self.stdout.write('Line %d %s: %s' % (line['line'], line['result'], line['reason']))
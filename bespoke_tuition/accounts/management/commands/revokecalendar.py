@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.calendars import CLIENT, STUDENT, revokeFeeds
+from accounts.models import Client, Student
+
+
+# Stops the calendar feed links of a student or client working, such as when one has been
+# shared by mistake. They get new links the next time they open their page.
+class Command(BaseCommand):
+    help = 'Give a student or client a new calendar key so their old feed links stop working'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=[STUDENT, CLIENT])
+        parser.add_argument('id', type=int)
+
+    def handle(self, *args, **options):
+        model = Student if options['kind'] == STUDENT else Client
+        owner = model.objects.filter(pk=options['id']).first()
+        if owner is None:
+            raise CommandError('No %s with id %d' % (options['kind'], options['id']))
+
+        revokeFeeds(owner)
+        self.stdout.write(self.style.SUCCESS('New calendar key for %s %s' % (options['kind'], owner)))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.invoicing import runInvoices, clientsToInvoice, CHUNK_SIZE
+
+
+# End of month invoice run. Creates an invoice for every client that has lessons not yet
+# invoiced. Safe to run again if it stops part way through as each chunk of clients is
+# committed on its own.
+class Command(BaseCommand):
+    help = 'Create invoices for every client with uninvoiced lessons'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of worker processes to shard the clients over')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Number of clients invoiced in each transaction')
+
+    def handle(self, *args, **options):
+        client_ids = clientsToInvoice()
+
+        if not client_ids:
+            self.stdout.write('No clients with uninvoiced lessons')
+            return
+
+        self.stdout.write('Invoicing %d clients over %d worker(s)' % (len(client_ids), options['workers']))
+
+        try:
+            results = runInvoices(client_ids, workers=options['workers'], chunk_size=options['chunk_size'])
+        except ValueError as error:
+            raise CommandError(error)
+
+        for result in results:
+            self.stdout.write('Shard %(shard)d: %(clients)d clients, %(invoices)d invoices, '
+                              '%(lessons)d lessons in %(seconds).2fs '
+                              '(%(invoices_per_second).1f invoices/s)' % result)
+
+        self.stdout.write(self.style.SUCCESS('Created %d invoices' % sum(r['invoices'] for r in results)))
@@ -0,0 +1,32 @@
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from accounts.jobs import POLL_SECONDS, _workProcess, work, workerName
+
+
+# Runs queued background jobs. Each of the concurrency worker processes claims one job at
+# a time from the database, so more workers (on this machine or others) can be added at
+# any time. The workers also put back jobs whose worker has gone. With --once the workers
+# stop when the queue is empty.
+class Command(BaseCommand):
+    help = 'Run queued background jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=1)
+        parser.add_argument('--once', action='store_true', help='Stop once there are no jobs left')
+        parser.add_argument('--poll', type=float, default=POLL_SECONDS, help='Seconds between checks when idle')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] <= 1:
+            count = work(workerName(), options['once'], options['poll'])
+        else:
+            # Connections can't be shared with the forked processes so close them first
+            connections.close_all()
+            workers = [('%s-%d' % (workerName(), i), options['once'], options['poll'])
+                       for i in range(options['concurrency'])]
+            with multiprocessing.Pool(processes=options['concurrency']) as pool:
+                count = sum(pool.map(_workProcess, workers))
+
+        self.stdout.write(self.style.SUCCESS('Ran %d jobs' % count))
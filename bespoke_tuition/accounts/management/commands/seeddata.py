@@ -0,0 +1,208 @@
+import random
+from datetime import date, datetime, time, timedelta
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db.models import F, Sum, OuterRef, Subquery, DecimalField, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from accounts.bulk import bulkCreate
+from accounts.models import (Client, Address, ContactDetails, Student, TuitionAddress,
+                             Products, Term, Invoices, Lesson)
+
+FORENAMES = ['Oliver', 'Amelia', 'George', 'Isla', 'Harry', 'Ava', 'Noah', 'Mia', 'Jack',
+             'Ivy', 'Leo', 'Lily', 'Arthur', 'Grace', 'Muhammad', 'Sophia', 'Oscar', 'Ella']
+SURNAMES = ['Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson', 'Johnson', 'Davies',
+            'Patel', 'Robinson', 'Wright', 'Thompson', 'Evans', 'Walker', 'White', 'Roberts',
+            'Green', 'Hall', 'Wood', 'Jackson', 'Clarke', 'Khan', 'Lewis', 'Hughes']
+TOWNS = ['Sunderland', 'Durham', 'Newcastle', 'Gateshead', 'Washington', 'Houghton']
+
+# Lesson types and how often they are booked, most lessons are the standard hour
+PRODUCTS = [('One hour lesson', 30, 60), ('Half hour lesson', 18, 20),
+            ('Exam prep lesson', 35, 12), ('Split cost lesson', 15, 8)]
+
+# Lessons are after school, weekdays only
+LESSON_TIMES = [time(15, 30), time(16, 30), time(17, 30), time(18, 30)]
+
+
+# Seeds the database with made up data at production volumes so the views can be
+# benchmarked. Everything is inserted with bulk_create in batches so memory stays flat
+# even for millions of lessons.
+class Command(BaseCommand):
+    help = 'Seed the database with synthetic clients, students, lessons and invoices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50000)
+        parser.add_argument('--students', type=int, default=80000)
+        parser.add_argument('--lessons', type=int, default=2000000)
+        parser.add_argument('--invoices', type=int, default=300000)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=None, help='Random seed so runs can be repeated')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+
+        terms = self.seedTerms()
+        products = self.seedProducts()
+        client_ids = self.seedClients(options['clients'])
+        student_parents = self.seedStudents(options['students'], client_ids)
+        invoice_ids = self.seedInvoices(options['invoices'], client_ids)
+        self.seedLessons(options['lessons'], student_parents, invoice_ids, products, terms)
+        self.setInvoiceTotals()
+        call_command('backfillinvoicelines', stdout=self.stdout)
+        call_command('reconcilebalances', stdout=self.stdout)
+        call_command('rebuildrollups', stdout=self.stdout)
+
+        self.stdout.write(self.style.SUCCESS('Seeding complete'))
+
+    # Insert objects in batches, returning the new primary keys
+    def bulkInsert(self, model, objects):
+        return bulkCreate(model, objects, batch_size=self.batch_size)
+
+    def log(self, message):
+        self.stdout.write(message)
+
+    # Three terms a year for the last two school years
+    def seedTerms(self):
+        terms = []
+        year = timezone.now().year - 2
+        for offset in range(2):
+            start = year + offset
+            for name, start_date, half_start, end_date in (
+                    ('Autumn', date(start, 9, 1), date(start, 10, 25), date(start, 12, 17)),
+                    ('Spring', date(start + 1, 1, 4), date(start + 1, 2, 14), date(start + 1, 3, 31)),
+                    ('Summer', date(start + 1, 4, 19), date(start + 1, 5, 30), date(start + 1, 7, 21))):
+                terms.append(Term(term_name='%s %d' % (name, start_date.year), term_start_date=start_date,
+                                  term_end_date=end_date, half_term_start_date=half_start,
+                                  half_term_end_date=half_start + timedelta(days=6)))
+
+        ids = self.bulkInsert(Term, terms)
+        self.log('Created %d terms' % len(ids))
+        return list(Term.objects.filter(pk__in=ids))
+
+    def seedProducts(self):
+        ids = self.bulkInsert(Products, [Products(product_name=name, price=price, effective_from_date=date(2020, 1, 1))
+                                         for name, price, weight in PRODUCTS])
+        self.log('Created %d products' % len(ids))
+        return list(zip(ids, [weight for name, price, weight in PRODUCTS]))
+
+    def seedClients(self, count):
+        rand = self.random
+        client_ids = self.bulkInsert(Client, [Client(forename=rand.choice(FORENAMES), surname=rand.choice(SURNAMES),
+                                                     contract_signed=rand.random() < 0.9,
+                                                     active=rand.random() < 0.95) for i in range(count)])
+
+        addresses = []
+        contacts = []
+        for client_id in client_ids:
+            addresses.append(Address(client_id=client_id, line_one='%d %s Street' % (rand.randint(1, 200), rand.choice(SURNAMES)),
+                                     town=rand.choice(TOWNS), postcode='SR%d %dAB' % (rand.randint(1, 9), rand.randint(1, 9)),
+                                     effective_from_date=date(2019, 1, 1)))
+            contacts.append(ContactDetails(client_id=client_id, contact_number='07%09d' % rand.randint(0, 999999999),
+                                           email_address='client%d@example.com' % client_id))
+
+        self.bulkInsert(Address, addresses)
+        self.bulkInsert(ContactDetails, contacts)
+        self.log('Created %d clients' % len(client_ids))
+        return client_ids
+
+    # Every client gets at least one child where possible, the rest are spread over the
+    # clients at random. About 1 in 20 students have a second parent sharing the cost.
+    def seedStudents(self, count, client_ids):
+        rand = self.random
+        student_ids = self.bulkInsert(Student, [Student(forename=rand.choice(FORENAMES), surname=rand.choice(SURNAMES),
+                                                        school_year=rand.randint(1, 11)) for i in range(count)])
+
+        links = []
+        student_parents = {}
+        Parent = Student.parent.through
+        for i, student_id in enumerate(student_ids):
+            parents = [client_ids[i] if i < len(client_ids) else rand.choice(client_ids)]
+            if rand.random() < 0.05:
+                second = rand.choice(client_ids)
+                if second != parents[0]:
+                    parents.append(second)
+            student_parents[student_id] = parents
+            links.extend(Parent(student_id=student_id, client_id=client_id) for client_id in parents)
+
+        self.bulkInsert(Parent, links)
+        self.bulkInsert(TuitionAddress, [TuitionAddress(student_id=student_id, line_one='School Lane',
+                                                        town=rand.choice(TOWNS), postcode='SR1 1AA')
+                                         for student_id in student_ids])
+        self.log('Created %d students' % len(student_ids))
+        return student_parents
+
+    # Invoices are spread over the last year with most of them paid
+    def seedInvoices(self, count, client_ids):
+        rand = self.random
+        # Offset the numbers so seeding more than once doesn't clash
+        offset = Invoices.objects.count()
+        invoices = [Invoices(invoice_number='SEED%08d' % (offset + i), client_id=rand.choice(client_ids),
+                             total_amount=0, amount_paid=0, amount_outstanding=0) for i in range(count)]
+        ids = self.bulkInsert(Invoices, invoices)
+        if not ids:
+            return {}
+
+        # date_created is set to now on insert so move them back month by month
+        now = timezone.now()
+        invoice_ids = {}
+        for invoice_id, client_id in Invoices.objects.filter(pk__gte=ids[0]).values_list('pk', 'client_id').iterator():
+            invoice_ids.setdefault(client_id, []).append(invoice_id)
+        for month in range(12):
+            Invoices.objects.filter(pk__gte=ids[0]).annotate(month=F('pk') % 12).filter(month=month) \
+                            .update(date_created=now - timedelta(days=30 * month + 1))
+
+        self.log('Created %d invoices' % len(ids))
+        return invoice_ids
+
+    def seedLessons(self, count, student_parents, invoice_ids, products, terms):
+        rand = self.random
+        student_ids = list(student_parents)
+        product_ids = [product_id for product_id, weight in products]
+        product_weights = [weight for product_id, weight in products]
+        tz = timezone.get_current_timezone()
+        created = 0
+
+        while created < count:
+            batch = []
+            for i in range(min(self.batch_size, count - created)):
+                student_id = rand.choice(student_ids)
+                term = rand.choice(terms)
+                day = term.term_start_date + timedelta(days=rand.randint(0, (term.term_end_date - term.term_start_date).days))
+                if term.half_term_start_date <= day <= term.half_term_end_date:
+                    day = term.half_term_start_date - timedelta(days=3)
+                while day.weekday() > 4:
+                    day -= timedelta(days=1)
+                start = timezone.make_aware(datetime.combine(day, rand.choice(LESSON_TIMES)), tz)
+
+                # Older lessons are usually invoiced to one of the student's parents
+                invoice_id = None
+                parent_invoices = invoice_ids.get(student_parents[student_id][0])
+                if parent_invoices and rand.random() < 0.8:
+                    invoice_id = rand.choice(parent_invoices)
+
+                batch.append(Lesson(student_id=student_id, term_id=term.pk,
+                                    lesson_type_id=rand.choices(product_ids, product_weights)[0],
+                                    lesson_start=start, lesson_end=start + timedelta(hours=1),
+                                    invoiced=invoice_id is not None, invoice_number_id=invoice_id))
+            Lesson.objects.bulk_create(batch)
+            created += len(batch)
+            self.log('Created %d of %d lessons' % (created, count))
+
+    # Set the invoice totals from the lessons linked to them, then mark about two thirds
+    # as paid and a few as part paid.
+    def setInvoiceTotals(self):
+        lesson_total = Lesson.objects.filter(invoice_number=OuterRef('pk')).values('invoice_number') \
+                                     .annotate(total=Sum('lesson_type__price')).values('total')
+        total = Coalesce(Subquery(lesson_total, output_field=DecimalField(max_digits=8, decimal_places=2)),
+                         Value(0), output_field=DecimalField(max_digits=8, decimal_places=2))
+
+        seeded = Invoices.objects.filter(invoice_number__startswith='SEED')
+        seeded.update(total_amount=total, amount_outstanding=total, status=Invoices.UNPAID)
+        seeded.annotate(bucket=F('pk') % 3).exclude(bucket=0) \
+              .update(status=Invoices.PAID, amount_paid=F('total_amount'), amount_outstanding=0)
+        seeded.annotate(bucket=F('pk') % 10).filter(bucket=0, status=Invoices.UNPAID) \
+              .update(status=Invoices.PART_PAID, amount_paid=F('total_amount') / 2,
+                      amount_outstanding=F('total_amount') - F('total_amount') / 2)
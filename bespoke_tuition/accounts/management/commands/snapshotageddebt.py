@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from accounts.ageddebt import takeSnapshot
+
+
+# Stores the day's aged debt so the aged debt page can show it later without working it
+# out again. Run once a day from cron, running it again the same day replaces it.
+class Command(BaseCommand):
+    help = "Store today's aged debt snapshot"
+
+    def handle(self, *args, **options):
+        result = takeSnapshot()
+        self.stdout.write(self.style.SUCCESS('Aged debt for %s stored, %d clients owing %s' % (
+            result['date'], result['clients'], result['total'])))
@@ -0,0 +1,229 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+
+# Upper bounds of the latency histogram buckets in seconds, the Prometheus defaults. A
+# last +Inf bucket catches everything slower.
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# Label for requests that didn't match any url
+UNRESOLVED = 'unresolved'
+
+# Each process adds up its requests in memory and a background thread writes them to the
+# shared file this often, so requests never wait on the file
+FLUSH_SECONDS = 1.0
+
+# How long a flush waits for another process holding the file lock before giving up and
+# keeping its totals for the next try
+BUSY_SECONDS = 0.1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS view_metrics (
+    view TEXT PRIMARY KEY,
+    requests INTEGER NOT NULL DEFAULT 0,
+    duration REAL NOT NULL DEFAULT 0,
+    queries INTEGER NOT NULL DEFAULT 0,
+    db_time REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS latency_buckets (
+    view TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    requests INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (view, bucket)
+);
+'''
+
+
+def metricsFile():
+    return getattr(settings, 'METRICS_FILE', None)
+
+
+# Totals for the requests to one view since the last flush. Buckets are not cumulative
+# here, each request is counted once in the first bucket it fits.
+class ViewTotals:
+
+    def __init__(self):
+        self.requests = 0
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, duration, queries, db_time):
+        self.requests += 1
+        self.duration += duration
+        self.queries += queries
+        self.db_time += db_time
+        self.buckets[bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.duration += other.duration
+        self.queries += other.queries
+        self.db_time += other.db_time
+        self.buckets = [mine + theirs for mine, theirs in zip(self.buckets, other.buckets)]
+
+
+# The metrics shared by every worker process, kept in a SQLite file of their own so
+# writing them never waits on the application database. Each process holds its pending
+# totals in memory and a timer thread adds them to the file in one transaction with
+# upserts, so processes flushing at the same time can't lose each other's counts. A
+# request only ever adds to the totals in memory. If the file can't be written, the
+# totals are kept and tried again on the next flush.
+class MetricsStore:
+
+    def __init__(self, path, flush_seconds=FLUSH_SECONDS):
+        self.path = str(path)
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pending = defaultdict(ViewTotals)
+        self._connection = None
+        self._pid = None
+        self._timer_pid = None
+
+    # A connection per process, opened again after a fork as SQLite connections can't
+    # be shared between processes
+    def _connect(self):
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=BUSY_SECONDS, check_same_thread=False,
+                                               isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._connection
+
+    # Threads don't survive a fork so each process starts its own
+    def _startTimer(self):
+        if self._timer_pid != os.getpid():
+            self._timer_pid = os.getpid()
+            threading.Thread(target=self._flushEvery, name='metrics-flush', daemon=True).start()
+
+    def _flushEvery(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def record(self, view, duration, queries, db_time):
+        with self._lock:
+            self._pending[view].add(duration, queries, db_time)
+            self._startTimer()
+
+    # Write the pending totals to the file, False if it couldn't be written
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, defaultdict(ViewTotals)
+            if not pending:
+                return True
+
+            try:
+                self._write(pending)
+            except sqlite3.Error:
+                with self._lock:
+                    for view, totals in pending.items():
+                        self._pending[view].merge(totals)
+                return False
+            return True
+
+    def _write(self, pending):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('''
+                INSERT INTO view_metrics (view, requests, duration, queries, db_time) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (view) DO UPDATE SET requests = requests + excluded.requests,
+                    duration = duration + excluded.duration, queries = queries + excluded.queries,
+                    db_time = db_time + excluded.db_time
+            ''', [(view, totals.requests, totals.duration, totals.queries, totals.db_time)
+                  for view, totals in pending.items()])
+            connection.executemany('''
+                INSERT INTO latency_buckets (view, bucket, requests) VALUES (?, ?, ?)
+                ON CONFLICT (view, bucket) DO UPDATE SET requests = requests + excluded.requests
+            ''', [(view, bucket, count) for view, totals in pending.items()
+                  for bucket, count in enumerate(totals.buckets) if count])
+            connection.execute('COMMIT')
+        except Exception:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+
+    # Every view's totals from the file, with this process's pending requests flushed first
+    def read(self):
+        self.flush()
+        with self._write_lock:
+            connection = self._connect()
+            views = connection.execute('SELECT view, requests, duration, queries, db_time FROM view_metrics '
+                                       'ORDER BY view').fetchall()
+            buckets = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+            for view, bucket, count in connection.execute('SELECT view, bucket, requests FROM latency_buckets'):
+                buckets[view][bucket] = count
+        return [(view, requests, duration, queries, db_time, buckets[view])
+                for view, requests, duration, queries, db_time in views]
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+# The store for the METRICS_FILE setting, or None when metrics are turned off
+def metricsStore():
+    path = metricsFile()
+    if not path:
+        return None
+    with _stores_lock:
+        if str(path) not in _stores:
+            _stores[str(path)] = MetricsStore(path)
+        return _stores[str(path)]
+
+
+# Write whatever a process still has pending when it exits
+@atexit.register
+def _flushAll():
+    for store in list(_stores.values()):
+        store.flush()
+
+
+def _escapeLabel(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# The metrics in the Prometheus text exposition format
+def renderMetrics(rows):
+    lines = ['# HELP bespoke_requests_total Requests handled, by url name.',
+             '# TYPE bespoke_requests_total counter']
+    lines += ['bespoke_requests_total{view="%s"} %d' % (_escapeLabel(row[0]), row[1]) for row in rows]
+
+    lines += ['# HELP bespoke_request_duration_seconds Time taken to respond, by url name.',
+              '# TYPE bespoke_request_duration_seconds histogram']
+    for view, requests, duration, queries, db_time, buckets in rows:
+        label = _escapeLabel(view)
+        running = 0
+        for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], buckets):
+            running += count
+            lines.append('bespoke_request_duration_seconds_bucket{view="%s",le="%s"} %d'
+                         % (label, bound if bound == '+Inf' else _number(float(bound)), running))
+        lines.append('bespoke_request_duration_seconds_sum{view="%s"} %s' % (label, _number(duration)))
+        lines.append('bespoke_request_duration_seconds_count{view="%s"} %d' % (label, requests))
+
+    lines += ['# HELP bespoke_db_queries_total Database queries run, by url name.',
+              '# TYPE bespoke_db_queries_total counter']
+    lines += ['bespoke_db_queries_total{view="%s"} %d' % (_escapeLabel(row[0]), row[3]) for row in rows]
+
+    lines += ['# HELP bespoke_db_query_seconds_total Time spent in database queries, by url name.',
+              '# TYPE bespoke_db_query_seconds_total counter']
+    lines += ['bespoke_db_query_seconds_total{view="%s"} %s' % (_escapeLabel(row[0]), _number(row[4]))
+              for row in rows]
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,96 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.urls import resolve, Resolver404
+
+from .querycount import QueryRecorder
+from .metrics import metricsStore, UNRESOLVED
+from .slowqueries import SlowQueryRecorder, slowQueryLog
+
+logger = logging.getLogger('accounts.queries')
+
+
+# Records the SQL run for each request. Adds the count to the X-Query-Count header, logs
+# any query shapes repeated enough to be an N+1 and warns when a page goes over the
+# budget set for its url in accounts/urls.py. Turned on with QUERY_COUNT_LOGGING which
+# defaults to DEBUG.
+class QueryCountMiddleware:
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'QUERY_COUNT_LOGGING', settings.DEBUG):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+
+        response['X-Query-Count'] = str(recorder.count)
+
+        try:
+            url_name = resolve(request.path_info).view_name
+        except Resolver404:
+            return response
+
+        for shape, count in recorder.repeated():
+            logger.warning('Possible N+1 on %s, query run %d times: %s', url_name, count, shape)
+
+        budget = queryBudget(url_name)
+        if budget is not None and recorder.count > budget:
+            logger.warning('%s ran %d queries, budget is %d', url_name, recorder.count, budget)
+
+        return response
+
+
+# Records the count, time taken, number of queries and time spent in the database for
+# each request against the url name it resolved to, for the /metrics page. The totals are
+# shared between worker processes through METRICS_FILE, see metrics.py, and the
+# middleware is left out when that isn't set. Streamed responses are timed until the
+# response starts rather than until the last row is sent.
+class MetricsMiddleware:
+
+    def __init__(self, get_response):
+        if metricsStore() is None:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        metricsStore().record(match.view_name if match else UNRESOLVED, duration, recorder.count,
+                              recorder.total_time)
+
+        return response
+
+
+# Logs queries slower than SLOW_QUERY_SECONDS with the view and the line of app code that
+# ran them to the rotating SLOW_QUERY_LOG file, see slowqueries.py. Left out unless the
+# log file is set.
+class SlowQueryMiddleware:
+
+    def __init__(self, get_response):
+        if not slowQueryLog():
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with connection.execute_wrapper(SlowQueryRecorder(request)):
+            return self.get_response(request)
+
+
+# Look up the query budget for a url name such as accounts:invoices
+def queryBudget(url_name):
+    from .urls import QUERY_BUDGETS
+
+    app_name, _, name = url_name.rpartition(':')
+    if app_name != 'accounts':
+        return None
+
+    return QUERY_BUDGETS.get(name)
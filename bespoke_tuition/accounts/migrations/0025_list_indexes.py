@@ -0,0 +1,33 @@
+# Generated by Django 3.1.4 on 2026-10-17 21:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0024_auto_20210115_2058'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='client',
+            index=models.Index(fields=['surname'], name='accounts_cl_surname_37b0bd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='client',
+            index=models.Index(fields=['forename'], name='accounts_cl_forenam_897e9d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invoices',
+            index=models.Index(fields=['date_created', 'id'], name='accounts_in_date_cr_708034_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['surname'], name='accounts_st_surname_01ec51_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['forename'], name='accounts_st_forenam_f63344_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.4 on 2026-10-17 21:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0026_invoiceline'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClientBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_invoiced', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('total_paid', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('total_outstanding', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('uninvoiced_value', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('date_updated', models.DateTimeField(default=django.utils.timezone.now)),
+                ('client', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='balance', to='accounts.client')),
+            ],
+            options={
+                'verbose_name': 'Client Balance',
+                'verbose_name_plural': 'Client Balances',
+            },
+        ),
+    ]
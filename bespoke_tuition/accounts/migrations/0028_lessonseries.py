@@ -0,0 +1,36 @@
+# Generated by Django 3.1.4 on 2026-10-17 21:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0027_clientbalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LessonSeries',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weekday', models.IntegerField(choices=[(0, 'Monday'), (1, 'Tuesday'), (2, 'Wednesday'), (3, 'Thursday'), (4, 'Friday'), (5, 'Saturday'), (6, 'Sunday')], default=0)),
+                ('start_time', models.TimeField()),
+                ('end_time', models.TimeField()),
+                ('date_inserted', models.DateTimeField(auto_now_add=True)),
+                ('lesson_type', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='series_link', to='accounts.products')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lesson_series', to='accounts.student')),
+                ('term', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='series', to='accounts.term')),
+            ],
+            options={
+                'verbose_name': 'Lesson Series',
+                'verbose_name_plural': 'Lesson Series',
+            },
+        ),
+        migrations.AddField(
+            model_name='lesson',
+            name='series',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='lessons', to='accounts.lessonseries'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.4 on 2026-10-17 21:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0028_lessonseries'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['lesson_start', 'lesson_end'], name='accounts_le_lesson__112cf8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['term', 'lesson_start'], name='accounts_le_term_id_d7536a_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.4 on 2026-10-17 21:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0029_lesson_interval_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['client', 'effective_from_date', 'effective_to_date'], name='accounts_ad_client__86374b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tuitionaddress',
+            index=models.Index(fields=['student', 'effective_from_date', 'effective_to_date'], name='accounts_tu_student_4ea9cc_idx'),
+        ),
+    ]
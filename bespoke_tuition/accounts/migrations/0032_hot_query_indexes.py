@@ -0,0 +1,25 @@
+# Generated by Django 3.1.4 on 2026-10-17 21:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0031_referenceversion'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='invoices',
+            index=models.Index(fields=['client', 'date_created'], name='accounts_in_client__adaf51_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invoices',
+            index=models.Index(fields=['status'], name='accounts_in_status_e18d32_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['student', 'invoiced'], name='accounts_le_student_90cd5f_idx'),
+        ),
+    ]
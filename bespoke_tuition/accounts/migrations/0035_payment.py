@@ -0,0 +1,27 @@
+# Generated by Django 3.1.4 on 2026-10-17 21:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0034_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Payment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_paid', models.DateField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('reference', models.CharField(blank=True, max_length=200)),
+                ('payer', models.CharField(blank=True, max_length=100)),
+                ('fingerprint', models.CharField(max_length=40, unique=True)),
+                ('date_inserted', models.DateTimeField(auto_now_add=True)),
+                ('invoice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payments', to='accounts.invoices')),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.1.4 on 2026-10-17 21:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0035_payment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgedDebtSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('days_0_30', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('days_31_60', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('days_61_90', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('days_over_90', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('client', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='aged_debt', to='accounts.client')),
+            ],
+            options={
+                'verbose_name': 'Aged Debt Snapshot',
+                'verbose_name_plural': 'Aged Debt Snapshots',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='ageddebtsnapshot',
+            index=models.Index(fields=['date', 'client'], name='accounts_ag_date_200975_idx'),
+        ),
+    ]
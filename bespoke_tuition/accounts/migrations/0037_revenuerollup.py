@@ -0,0 +1,33 @@
+# Generated by Django 3.1.4 on 2026-10-17 21:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0036_ageddebtsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevenueRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('lesson_count', models.IntegerField(default=0)),
+                ('invoiced_value', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('uninvoiced_value', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('date_updated', models.DateTimeField(default=django.utils.timezone.now)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='accounts.products')),
+                ('term', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='accounts.term')),
+            ],
+            options={
+                'verbose_name': 'Revenue Rollup',
+                'verbose_name_plural': 'Revenue Rollups',
+                'unique_together': {('term', 'product', 'month')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-17 22:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0037_revenuerollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lesson',
+            name='date_updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.1.4 on 2026-10-17 22:24
+
+import accounts.models
+from django.db import migrations, models
+
+
+# The default is only worked out once for the rows already there, give each its own
+def newKeys(apps, schema_editor):
+    for name in ('Client', 'Student'):
+        model = apps.get_model('accounts', name)
+        for pk in model.objects.values_list('pk', flat=True):
+            model.objects.filter(pk=pk).update(calendar_key=accounts.models.newCalendarKey())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0038_lesson_date_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='calendar_key',
+            field=models.CharField(default=accounts.models.newCalendarKey, editable=False, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='student',
+            name='calendar_key',
+            field=models.CharField(default=accounts.models.newCalendarKey, editable=False, max_length=32),
+        ),
+        migrations.RunPython(newKeys, migrations.RunPython.noop),
+    ]
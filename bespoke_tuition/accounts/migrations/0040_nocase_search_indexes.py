@@ -0,0 +1,55 @@
+# Generated by Django 3.1.4 on 2026-10-17 22:28
+
+from django.db import migrations
+
+# The searches use istartswith, a LIKE on sqlite which only uses an index made with the
+# NOCASE collation. The plain indexes on the names couldn't be used for it so they go.
+# Django doesn't know about these, a later migration that has sqlite rebuild one of these
+# tables has to make them again (test_search_indexes checks they are used).
+SEARCH_INDEXES = [('accounts_client_surname_nocase', 'accounts_client', 'surname'),
+                  ('accounts_client_forename_nocase', 'accounts_client', 'forename'),
+                  ('accounts_student_surname_nocase', 'accounts_student', 'surname'),
+                  ('accounts_student_forename_nocase', 'accounts_student', 'forename'),
+                  ('accounts_invoices_number_nocase', 'accounts_invoices', 'invoice_number')]
+
+
+def createIndexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    quote = schema_editor.quote_name
+    for name, table, column in SEARCH_INDEXES:
+        schema_editor.execute('CREATE INDEX %s ON %s (%s COLLATE NOCASE)' % (quote(name), quote(table), quote(column)))
+
+
+def dropIndexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for name, table, column in SEARCH_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % schema_editor.quote_name(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0039_calendar_key'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='client',
+            name='accounts_cl_surname_37b0bd_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='client',
+            name='accounts_cl_forenam_897e9d_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='student',
+            name='accounts_st_surname_01ec51_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='student',
+            name='accounts_st_forenam_f63344_idx',
+        ),
+        migrations.RunPython(createIndexes, dropIndexes),
+    ]
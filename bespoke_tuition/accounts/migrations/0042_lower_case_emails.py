@@ -0,0 +1,25 @@
+from django.db import migrations
+
+
+# Email addresses are now kept in lower case. Any that would clash with another once
+# lowered are left as they are for someone to merge the two clients by hand.
+def lowerEmails(apps, schema_editor):
+    ContactDetails = apps.get_model('accounts', 'ContactDetails')
+    lowered = {}
+    for pk, email in ContactDetails.objects.values_list('pk', 'email_address'):
+        lowered.setdefault(email.strip().lower(), []).append((pk, email))
+
+    for email, contacts in lowered.items():
+        if len(contacts) == 1 and contacts[0][1] != email:
+            ContactDetails.objects.filter(pk=contacts[0][0]).update(email_address=email)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0041_job_heartbeat_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(lowerEmails, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,5 @@
+import secrets
+
 from django.db import models
 from django.utils import timezone
 from django.utils.timezone import now
@@ -7,6 +9,15 @@ from django.contrib.auth.models import User
 letters_only = RegexValidator(r'^[a-zA-Z]*$', 'Only letters are allowed.')
 numbers_only = RegexValidator(r'^[0-9]*$', 'Only numbers are allowed.')
 
+# Email addresses are stored in lower case so the unique constraint on them can't be
+# got round by changing the case, and so lookups can match them exactly
+def normaliseEmail(email):
+    return (email or '').strip().lower()
+
+# Secret put in the calendar feed links, a new one stops the old links working
+def newCalendarKey():
+    return secrets.token_hex(16)
+
 # Main client table, this is linked to the django users table for when customers
 # register.
 class Client(models.Model):
@@ -16,6 +27,10 @@ class Client(models.Model):
     date_inserted = models.DateTimeField(default=now)
     active = models.BooleanField(default=True)
     contract_signed = models.BooleanField(default=False)
+    calendar_key = models.CharField(max_length=32, default=newCalendarKey, editable=False)
+
+    # The name search on the client list is case insensitive, its indexes are made with
+    # the same collation in migration 0040 as Django can't declare one here
 
     def __str__(self):
         return str(self.forename + ' ' + self.surname)
@@ -37,6 +52,7 @@ class Address(models.Model):
     class Meta:
         verbose_name = 'Address Details'
         verbose_name_plural = 'Address Details'
+        indexes = [models.Index(fields=['client', 'effective_from_date', 'effective_to_date'])]
 
     def __str__(self):
         return str(self.client)
@@ -55,6 +71,14 @@ class ContactDetails(models.Model):
     def __str__(self):
         return str(self.client)
 
+    # Runs before the unique check in forms, so it checks the address as it will be saved
+    def clean(self):
+        self.email_address = normaliseEmail(self.email_address)
+
+    def save(self, *args, **kwargs):
+        self.email_address = normaliseEmail(self.email_address)
+        super().save(*args, **kwargs)
+
 # Student table to hold basic student details. Many to many field for the parents as children
 # can have multiple parents if they want to split the costs. And parents can have multiple children
 # being taught
@@ -91,6 +115,9 @@ class Student(models.Model):
     date_of_birth = models.DateField(null=True, blank=True)
     school_year = models.IntegerField(choices=SCHOOL_YEAR_CHOICES, default=1)
     date_inserted = models.DateTimeField(auto_now_add=True)
+    calendar_key = models.CharField(max_length=32, default=newCalendarKey, editable=False)
+
+    # The name search on the student list uses case insensitive indexes from migration 0040
 
     def __str__(self):
         return str(self.forename + ' ' + self.surname)
@@ -111,6 +138,7 @@ class TuitionAddress(models.Model):
     class Meta:
         verbose_name = 'Student Address'
         verbose_name_plural = 'Student Address'
+        indexes = [models.Index(fields=['student', 'effective_from_date', 'effective_to_date'])]
 
     def __str__(self):
         return str(self.student)
@@ -142,6 +170,25 @@ class Term(models.Model):
     def __str__(self):
         return str(self.term_name)
 
+# Version stamp for each reference table (products and terms). Bumped whenever a row is
+# saved or deleted so every process can tell its cached copy is out of date.
+class ReferenceVersion(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    version = models.PositiveIntegerField(default=1)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.name) + ' v' + str(self.version)
+
+# Next invoice number to hand out for each year. Numbers are taken in blocks by moving
+# next_number on with a single update, see numbering.py.
+class InvoiceSequence(models.Model):
+    year = models.PositiveIntegerField(unique=True)
+    next_number = models.PositiveIntegerField(default=1)
+
+    def __str__(self):
+        return str(self.year) + ' next ' + str(self.next_number)
+
 # Invoice table to show, total, amount paid and outstanding with status.
 # Linked to client
 class Invoices(models.Model):
@@ -165,9 +212,51 @@ class Invoices(models.Model):
     amount_outstanding = models.DecimalField(max_digits=8, decimal_places=2)
     date_created = models.DateTimeField(auto_now_add=True)
 
+    # The invoice list is paged through in date order, a clients invoices are listed in
+    # date order and the aged debt, reconciliation and exports filter on the status
+    class Meta:
+        indexes = [models.Index(fields=['date_created', 'id']),
+                   models.Index(fields=['client', 'date_created']),
+                   models.Index(fields=['status'])]
+
     def __str__(self):
         return str(self.invoice_number)
 
+# Weekly lessons for a student over a whole term. The lessons themselves are created
+# from this all at once, see series.py, and keep a link back so they can be changed or
+# cancelled together.
+class LessonSeries(models.Model):
+    MONDAY = 0
+    TUESDAY = 1
+    WEDNESDAY = 2
+    THURSDAY = 3
+    FRIDAY = 4
+    SATURDAY = 5
+    SUNDAY = 6
+    WEEKDAY_CHOICES = (
+        (MONDAY, 'Monday'),
+        (TUESDAY, 'Tuesday'),
+        (WEDNESDAY, 'Wednesday'),
+        (THURSDAY, 'Thursday'),
+        (FRIDAY, 'Friday'),
+        (SATURDAY, 'Saturday'),
+        (SUNDAY, 'Sunday'),
+    )
+    student = models.ForeignKey(Student, related_name='lesson_series', on_delete=models.CASCADE)
+    lesson_type = models.ForeignKey(Products, related_name='series_link', on_delete=models.PROTECT)
+    term = models.ForeignKey(Term, related_name='series', on_delete=models.CASCADE)
+    weekday = models.IntegerField(choices=WEEKDAY_CHOICES, default=MONDAY)
+    start_time = models.TimeField()
+    end_time = models.TimeField()
+    date_inserted = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Lesson Series'
+        verbose_name_plural = 'Lesson Series'
+
+    def __str__(self):
+        return str(self.student) + ' ' + self.get_weekday_display() + ' ' + str(self.lesson_type)
+
 # The main table that drives most functionality. Lessons need to be linked to students to show
 # when the lesson will take place. Linked to products to show cost of the lesson. Linked to term
 # to ensure the lesson is within that term and linked to invoice to be included in the invoice produced.
@@ -179,6 +268,146 @@ class Lesson(models.Model):
     lesson_end = models.DateTimeField()
     invoiced = models.BooleanField(default=False)
     invoice_number = models.ForeignKey(Invoices, null=True, blank=True, related_name='invoice_no', on_delete=models.SET_NULL)
+    series = models.ForeignKey(LessonSeries, null=True, blank=True, related_name='lessons', on_delete=models.SET_NULL)
+    # Set whenever the lesson is saved or bulk created, the calendar feeds use it to tell
+    # whether anything has changed since a calendar app last asked
+    date_updated = models.DateTimeField(auto_now=True)
+
+    # Indexes for the clash checks, which look up lessons by a range on lesson_start, for
+    # reading a terms lessons in start order and for a students uninvoiced lessons
+    class Meta:
+        indexes = [models.Index(fields=['lesson_start', 'lesson_end']),
+                   models.Index(fields=['term', 'lesson_start']),
+                   models.Index(fields=['student', 'invoiced'])]
 
     def __str__(self):
         return str(self.lesson_type)
+
+# Snapshot of the lines on an invoice, written once when the invoice is created. The
+# product name and price are copied so the invoice still shows what was charged if the
+# product is changed later, and the detail pages don't need to group the lessons again.
+class InvoiceLine(models.Model):
+    invoice = models.ForeignKey(Invoices, related_name='lines', on_delete=models.CASCADE)
+    product = models.ForeignKey(Products, null=True, related_name='invoice_lines', on_delete=models.SET_NULL)
+    product_name = models.CharField(max_length=100)
+    unit_price = models.DecimalField(max_digits=8, decimal_places=2)
+    quantity = models.IntegerField()
+    line_total = models.DecimalField(max_digits=8, decimal_places=2)
+
+    class Meta:
+        verbose_name = 'Invoice Line'
+        verbose_name_plural = 'Invoice Lines'
+
+    def __str__(self):
+        return str(self.invoice) + ' ' + str(self.product_name)
+
+# Running balance for each client so totals can be shown without adding up all their
+# invoices. Kept up to date as invoices and lessons change, see balances.py, and can be
+# rebuilt from scratch with the reconcilebalances command.
+class ClientBalance(models.Model):
+    client = models.OneToOneField(Client, related_name='balance', on_delete=models.CASCADE)
+    total_invoiced = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    total_paid = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    total_outstanding = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    uninvoiced_value = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    date_updated = models.DateTimeField(default=now)
+
+    class Meta:
+        verbose_name = 'Client Balance'
+        verbose_name_plural = 'Client Balances'
+
+    def __str__(self):
+        return str(self.client)
+
+# Background job run by the runjobs worker command rather than inside a request. The
+# database is the queue, workers claim a job by moving it from queued to running with a
+# conditional update so two workers can never run the same one. See jobs.py.
+class Job(models.Model):
+    QUEUED = 1
+    RUNNING = 2
+    DONE = 3
+    FAILED = 4
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+    task = models.CharField(max_length=50)
+    arguments = models.JSONField(default=dict, blank=True)
+    status = models.IntegerField(choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    run_after = models.DateTimeField(default=now)
+    worker = models.CharField(max_length=100, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    date_inserted = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    wait_seconds = models.FloatField(null=True, blank=True)
+    run_seconds = models.FloatField(null=True, blank=True)
+
+    # Workers look for the oldest queued job that is due
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_after'])]
+
+    def __str__(self):
+        return str(self.task) + ' #' + str(self.pk)
+
+# Payment read from a bank statement and applied to an invoice by the reconciliation, see
+# reconcile.py. The fingerprint identifies the statement line so the same statement
+# uploaded twice doesn't pay the invoices twice.
+class Payment(models.Model):
+    invoice = models.ForeignKey(Invoices, related_name='payments', on_delete=models.CASCADE)
+    date_paid = models.DateField()
+    amount = models.DecimalField(max_digits=8, decimal_places=2)
+    reference = models.CharField(max_length=200, blank=True)
+    payer = models.CharField(max_length=100, blank=True)
+    fingerprint = models.CharField(max_length=40, unique=True)
+    date_inserted = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return str(self.invoice) + ' ' + str(self.amount)
+
+# Outstanding invoice amounts by age for one day, stored by the daily snapshot so past
+# aged debt can be shown without working it out again, see ageddebt.py. There is a row
+# for each client owing money and a row with no client holding the totals for the day.
+class AgedDebtSnapshot(models.Model):
+    date = models.DateField()
+    client = models.ForeignKey(Client, null=True, blank=True, related_name='aged_debt', on_delete=models.CASCADE)
+    days_0_30 = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    days_31_60 = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    days_61_90 = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    days_over_90 = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+
+    # Rows for a day are read together
+    class Meta:
+        verbose_name = 'Aged Debt Snapshot'
+        verbose_name_plural = 'Aged Debt Snapshots'
+        indexes = [models.Index(fields=['date', 'client'])]
+
+    def __str__(self):
+        return str(self.date) + ' ' + str(self.client or 'Total')
+
+# Lesson counts and values for each term, product and month, kept up to date as lessons
+# change so the revenue page doesn't have to add up every lesson, see rollups.py. Can be
+# rebuilt from scratch with the rebuildrollups command.
+class RevenueRollup(models.Model):
+    term = models.ForeignKey(Term, null=True, related_name='rollups', on_delete=models.CASCADE)
+    product = models.ForeignKey(Products, related_name='rollups', on_delete=models.CASCADE)
+    month = models.DateField()
+    lesson_count = models.IntegerField(default=0)
+    invoiced_value = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    uninvoiced_value = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    date_updated = models.DateTimeField(default=now)
+
+    class Meta:
+        verbose_name = 'Revenue Rollup'
+        verbose_name_plural = 'Revenue Rollups'
+        unique_together = [('term', 'product', 'month')]
+
+    def __str__(self):
+        return str(self.term) + ' ' + str(self.product) + ' ' + str(self.month)
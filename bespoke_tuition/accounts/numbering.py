@@ -0,0 +1,75 @@
+import threading
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import InvoiceSequence
+
+# Numbers taken from the database at a time by a batch worker. Any left over when the
+# worker finishes are never used, so invoice numbers can have gaps but never repeat.
+BLOCK_SIZE = 500
+
+
+# Readable invoice number, the first 3 letters of the surname, the year and the number
+# for that year such as SMI-2026-000042. The number alone is unique within the year.
+def invoiceNumber(surname, year, number):
+    return '%s-%d-%06d' % (surname[0:3].upper(), year, number)
+
+
+def invoiceYear(now=None):
+    return timezone.localdate(now or timezone.now()).year
+
+
+# Take the next count numbers for the year. The update moves next_number on and holds the
+# row lock only until this short transaction commits, so two workers asking at the same
+# time get separate blocks one after the other.
+def allocateBlock(year, count):
+    with transaction.atomic():
+        if not InvoiceSequence.objects.filter(year=year).update(next_number=F('next_number') + count):
+            try:
+                with transaction.atomic():
+                    InvoiceSequence.objects.create(year=year, next_number=1 + count)
+                return list(range(1, 1 + count))
+            except IntegrityError:
+                # Another worker started the year first
+                InvoiceSequence.objects.filter(year=year).update(next_number=F('next_number') + count)
+
+        end = InvoiceSequence.objects.filter(year=year).values_list('next_number', flat=True).get()
+
+    return list(range(end - count, end))
+
+
+# Hands out invoice numbers from blocks taken from the database, so a batch worker goes to
+# the sequence row once per block rather than once per invoice. Numbers from one allocator
+# always go up, each worker having its own.
+class InvoiceNumberAllocator:
+
+    def __init__(self, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.year = None
+        self.numbers = []
+        self._lock = threading.Lock()
+
+    def take(self, count, year):
+        with self._lock:
+            if year != self.year:
+                self.year, self.numbers = year, []
+
+            if len(self.numbers) < count:
+                self.numbers.extend(allocateBlock(year, max(count - len(self.numbers), self.block_size)))
+
+            taken, self.numbers = self.numbers[:count], self.numbers[count:]
+            return taken
+
+    # Put back numbers taken but not used so the next invoices get them
+    def giveBack(self, numbers, year):
+        with self._lock:
+            if year == self.year:
+                self.numbers = sorted(list(numbers) + self.numbers)
+
+
+# Number for a single invoice made in a view, taken straight from the database
+def nextInvoiceNumber(client, now=None):
+    year = invoiceYear(now)
+    return invoiceNumber(client.surname, year, allocateBlock(year, 1)[0])
@@ -0,0 +1,124 @@
+import datetime
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+PAGE_SIZE = 50
+
+
+# One page of rows with the cursors for the pages either side of it. A cursor is the
+# sort values of the first or last row so new rows being added never shift a page.
+class KeysetPage:
+
+    def __init__(self, rows, next_cursor, previous_cursor):
+        self.rows = rows
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+# DjangoJSONEncoder cuts datetimes and times to milliseconds. A cursor has to be the exact
+# value or the next page starts just before the boundary row, and rows sharing the
+# millisecond (from a bulk_create) would be shown again forever, so they keep every digit.
+class CursorEncoder(DjangoJSONEncoder):
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+def encodeCursor(values):
+    return urlsafe_b64encode(json.dumps(values, cls=CursorEncoder).encode()).decode()
+
+
+# Turn the cursor back into field values, anything that doesn't decode is treated as
+# the first page rather than an error
+def decodeCursor(cursor, model, ordering):
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode()))
+        fields = [model._meta.pk if name.lstrip('-') == 'pk' else model._meta.get_field(name.lstrip('-'))
+                  for name in ordering]
+        if len(values) != len(fields):
+            return None
+        return [field.to_python(value) for field, value in zip(fields, values)]
+    except (ValueError, TypeError, ValidationError):
+        return None
+
+
+# Builds the where clause for rows after (or before) the cursor row. For ordering
+# (a, b, pk) that is a > x OR (a = x AND b > y) OR (a = x AND b = y AND pk > z)
+def _afterFilter(ordering, values, backwards):
+    condition = Q()
+    equal = {}
+
+    for name, value in zip(ordering, values):
+        field = name.lstrip('-')
+        descending = name.startswith('-') != backwards
+        condition |= Q(**equal, **{field + ('__lt' if descending else '__gt'): value})
+        equal[field] = value
+
+    return condition
+
+
+# Rows can be model instances or the dicts from a values() queryset
+def _cursorFor(row, ordering):
+    if isinstance(row, dict):
+        return encodeCursor([row[name.lstrip('-')] for name in ordering])
+    return encodeCursor([getattr(row, name.lstrip('-')) for name in ordering])
+
+
+# Keyset paginate a queryset. The ordering must be unique, so it should end in pk, and
+# none of the fields can be null. Use after for the next page and before for the
+# previous one. Only page_size + 1 rows are ever read whatever page is asked for.
+def keysetPaginate(queryset, ordering, after=None, before=None, page_size=PAGE_SIZE):
+    model = queryset.model
+    backwards = False
+    cursor = None
+
+    if before:
+        cursor = decodeCursor(before, model, ordering)
+        backwards = cursor is not None
+    if cursor is None and after:
+        cursor = decodeCursor(after, model, ordering)
+
+    order_by = [name.lstrip('-') if name.startswith('-') else '-' + name for name in ordering] \
+        if backwards else list(ordering)
+
+    if cursor is not None:
+        queryset = queryset.filter(_afterFilter(ordering, cursor, backwards))
+
+    rows = list(queryset.order_by(*order_by)[:page_size + 1])
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    if backwards:
+        rows.reverse()
+
+    if not rows:
+        return KeysetPage(rows, None, None)
+
+    # Going forwards there is a previous page whenever we started from a cursor, going
+    # backwards there is always a next page as that is where we came from
+    has_next = True if backwards else more
+    has_previous = more if backwards else cursor is not None
+
+    return KeysetPage(rows,
+                      _cursorFor(rows[-1], ordering) if has_next else None,
+                      _cursorFor(rows[0], ordering) if has_previous else None)
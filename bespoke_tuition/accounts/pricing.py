@@ -0,0 +1,78 @@
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import Products
+from .refdata import cached, invalidate, productMap
+
+# Price changes are added as a new product with the same name and a later effective from
+# date, so a products price on any date is found from every product sharing its name.
+# The timelines are built from the cached products, one sorted list per product name, and
+# built again whenever the products version stamp moves.
+def _loadTimelines():
+    by_name = defaultdict(list)
+    for product in sorted(productMap().values(), key=lambda product: (product.effective_from_date, product.pk)):
+        by_name[product.product_name].append(product)
+
+    return {name: ([product.effective_from_date for product in timeline], timeline)
+            for name, timeline in by_name.items()}
+
+
+def _timelines():
+    return cached('products', 'timelines', _loadTimelines)
+
+
+# The local day of a lesson start. An instance just saved can still hold the start as it
+# was given, such as a string, which is read as local time unless it says otherwise.
+def _asDate(value):
+    if isinstance(value, str):
+        value = parse_datetime(value) or parse_date(value)
+    if isinstance(value, datetime):
+        return timezone.localdate(value) if timezone.is_aware(value) else value.date()
+    return value
+
+
+# The product in effect on the day for the lesson type given. Steps back from the latest
+# product starting on or before the day until one covers it. If none does, such as a
+# lesson before the product was first priced, the lesson type's own price is used.
+def productOn(lesson_type_id, day):
+    product = productMap().get(lesson_type_id)
+    if product is None:
+        # Added since the stamps were last checked, look again next time
+        product = Products.objects.get(pk=lesson_type_id)
+        invalidate('products')
+        return product
+
+    starts, timeline = _timelines()[product.product_name]
+    day = _asDate(day)
+    for candidate in reversed(timeline[:bisect_right(starts, day)]):
+        if candidate.effective_to_date is None or candidate.effective_to_date >= day:
+            return candidate
+
+    return product
+
+
+def lessonPrice(lesson):
+    return productOn(lesson.lesson_type_id, lesson.lesson_start).price
+
+
+# Price a batch of lessons from the cached timelines, no queries once the cache is warm.
+# Sets price on each lesson for the templates and returns the prices in the same order.
+def priceLessons(lessons):
+    prices = []
+    for lesson in lessons:
+        lesson.price = lessonPrice(lesson)
+        prices.append(lesson.price)
+    return prices
+
+
+# Total value of the lessons in (key, lesson type id, lesson start) rows for each key, with
+# every lesson at its price on the day
+def pricedTotals(rows):
+    totals = defaultdict(int)
+    for key, lesson_type_id, lesson_start in rows:
+        totals[key] += productOn(lesson_type_id, lesson_start).price
+    return dict(totals)
@@ -0,0 +1,61 @@
+import re
+import time
+from collections import Counter
+
+from django.db import connection
+
+# The same query shape being run this many times in one request is treated as an N+1,
+# usually a template touching a related object inside a for loop.
+N_PLUS_ONE_THRESHOLD = 5
+
+_in_list = re.compile(r'IN \((?:%s, )*%s\)')
+_strings = re.compile(r"'(?:[^']|'')*'")
+_numbers = re.compile(r'\b\d+\b')
+
+
+# Reduce a SQL statement to its shape so the same query with different values can be
+# grouped together. Django already uses %s for parameters, this also handles IN lists
+# of any length and any literals in raw SQL.
+def queryShape(sql):
+    sql = _strings.sub('%s', sql)
+    sql = _numbers.sub('%s', sql)
+    return _in_list.sub('IN (...)', sql)
+
+
+# Context manager to record every query run on the default connection while it is
+# active. Used by the middleware below and by the query budget tests.
+class QueryRecorder:
+
+    def __init__(self, using=connection):
+        self.connection = using
+        self.queries = []
+        self._wrapper = None
+
+    def __enter__(self):
+        self._wrapper = self.connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({'sql': sql, 'params': params,
+                                 'time': time.perf_counter() - start})
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(query['time'] for query in self.queries)
+
+    # Query shapes run at least threshold times, most repeated first
+    def repeated(self, threshold=N_PLUS_ONE_THRESHOLD):
+        shapes = Counter(queryShape(query['sql']) for query in self.queries)
+        return [(shape, count) for shape, count in shapes.most_common() if count >= threshold]
@@ -0,0 +1,91 @@
+import re
+
+from django.db import connection
+
+# Tables that grow with the business. A full scan of any of these in a page is treated as
+# a missing index, the small reference tables (products, terms, groups) are fine to scan.
+HOT_TABLES = ['accounts_lesson', 'accounts_invoices', 'accounts_invoiceline', 'accounts_address',
+              'accounts_tuitionaddress', 'accounts_client', 'accounts_student',
+              'accounts_student_parent', 'accounts_clientbalance', 'accounts_contactdetails']
+
+# sqlite reports "SCAN table" for a full table scan and "SCAN table USING INDEX" when it
+# walks an index in order, postgres reports "Seq Scan on table"
+_sqlite_scan = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?'
+                          r'(?: USING (?:COVERING )?INDEX (\w+)| USING (INTEGER PRIMARY KEY))?')
+_postgres_scan = re.compile(r'Seq Scan on (\w+)')
+
+# The filter of a query, up to the ordering or the end, and the columns it names
+_where = re.compile(r'\sWHERE\s(.*?)(?:\sORDER BY\s|\sLIMIT\s|$)', re.S | re.I)
+_column = re.compile(r'"(\w+)"\."(\w+)"')
+_order = re.compile(r'\sORDER BY\s+"(\w+)"\."(\w+)"', re.I)
+
+
+# Plan for a query as a list of lines
+def explain(sql, params=(), using=connection):
+    with using.cursor() as cursor:
+        if using.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+        cursor.execute('EXPLAIN ' + sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+# Columns of an index, in order
+def indexColumns(name, using=connection):
+    with using.cursor() as cursor:
+        cursor.execute('PRAGMA index_info(%s)' % using.ops.quote_name(name))
+        return [row[2] for row in cursor.fetchall()]
+
+
+# Columns of the table (by its name or alias in the query) the query filters on
+def _filteredColumns(sql, table):
+    match = _where.search(sql)
+    if not match:
+        return set()
+    return {column for name, column in _column.findall(match.group(1)) if name == table}
+
+
+# Hot tables read with a full scan in the plan. A scan walking an index or the primary
+# key in the order wanted, with a LIMIT and no sort afterwards, stops after that many rows
+# (a keyset page for example) so it isn't counted. That only holds if every column the
+# query filters that table on is in the index, otherwise any number of rows can be read
+# and thrown away before the page is full. sqlite shows a walk of the primary key as a
+# plain SCAN, so that is taken from the query being ordered by the table's id.
+def fullScans(plan, hot_tables=HOT_TABLES, sql='', using=connection):
+    sorted_after = any('TEMP B-TREE' in line or 'Sort' in line for line in plan)
+    limited = ' LIMIT ' in sql.upper() and not sorted_after
+
+    scanned = []
+    for line in plan:
+        match = _sqlite_scan.match(line.strip())
+        if match:
+            table, alias, index, primary_key = match.groups()
+            if table not in hot_tables:
+                continue
+            ordered = _order.search(sql)
+            if not index and ordered and ordered.groups() == (alias or table, 'id'):
+                primary_key = True
+            if limited and (index or primary_key):
+                covered = {'id'} if primary_key else set(indexColumns(index, using))
+                if _filteredColumns(sql, alias or table) <= covered:
+                    continue
+            scanned.append(table)
+            continue
+
+        match = _postgres_scan.search(line)
+        if match and match.group(1) in hot_tables:
+            scanned.append(match.group(1))
+    return scanned
+
+
+# Check each recorded query, returning the ones that fall back to a full scan of a hot table
+def checkQueries(queries, using=connection):
+    problems = []
+    for query in queries:
+        if not query['sql'].lstrip().upper().startswith('SELECT'):
+            continue
+        plan = explain(query['sql'], query['params'] or (), using)
+        scanned = fullScans(plan, sql=query['sql'], using=using)
+        if scanned:
+            problems.append({'sql': query['sql'], 'plan': plan, 'tables': scanned})
+    return problems
@@ -0,0 +1,269 @@
+import csv
+import hashlib
+import re
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+
+from .balances import rebuildBalances
+from .bulk import chunks
+from .models import Invoices, Payment
+
+# Invoices and statement lines written in each transaction
+CHUNK_SIZE = 500
+
+# Headings banks use for each column, the first one found in the file is read
+STATEMENT_COLUMNS = {'date': ['date', 'transaction date', 'posting date'],
+                     'amount': ['amount', 'paid in', 'credit', 'money in'],
+                     'reference': ['reference', 'description', 'memo', 'details'],
+                     'name': ['name', 'payer', 'payee', 'counterparty']}
+
+DATE_FORMATS = ['%Y-%m-%d', '%d/%m/%Y', '%d/%m/%y', '%d-%m-%Y', '%d %b %Y']
+
+MATCHED = 'matched'
+UNMATCHED = 'unmatched'
+AMBIGUOUS = 'ambiguous'
+DUPLICATE = 'duplicate'
+
+
+# Upper case letters and numbers only, so SMI-2026-000042 matches smi2026000042
+def _normalise(value):
+    return re.sub(r'[^A-Z0-9]', '', value.upper())
+
+
+def _words(value):
+    return [word for word in re.split(r'[^A-Z0-9-]+', value.upper()) if word]
+
+
+def _parseAmount(value):
+    value = re.sub(r'[^0-9.\-]', '', value or '')
+    try:
+        return Decimal(value).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        return None
+
+
+def _parseDate(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime((value or '').strip(), date_format).date()
+        except ValueError:
+            pass
+    return None
+
+
+def _column(headings, column):
+    lowered = {heading.strip().lower(): heading for heading in headings if heading}
+    for heading in STATEMENT_COLUMNS[column]:
+        if heading in lowered:
+            return lowered[heading]
+    return None
+
+
+# Lines from an open statement CSV. Each gets a fingerprint from its contents and how
+# many identical lines came before it in the file, so two real payments of the same
+# amount on the same day are both kept but a statement read twice gives the same ones.
+def readStatement(source):
+    reader = csv.DictReader(source)
+    columns = {column: _column(reader.fieldnames or [], column) for column in STATEMENT_COLUMNS}
+    seen = Counter()
+    lines = []
+
+    for line_number, row in enumerate(reader, 2):
+        values = {column: (row.get(heading) or '').strip() if heading else ''
+                  for column, heading in columns.items()}
+        key = '|'.join(values[column] for column in ('date', 'amount', 'reference', 'name'))
+        seen[key] += 1
+
+        lines.append({'line': line_number, 'date': _parseDate(values['date']),
+                      'amount': _parseAmount(values['amount']), 'reference': values['reference'],
+                      'name': values['name'], 'invoice': None, 'result': None, 'reason': '',
+                      'fingerprint': hashlib.sha1(('%s|%d' % (key, seen[key])).encode()).hexdigest()})
+
+    return lines
+
+
+# Hash indexes over the invoices still owing money, built once for the whole statement.
+# One by invoice number and one by amount outstanding and client surname for payments
+# without a usable reference. remaining is kept up to date as lines are matched so two
+# lines for the same invoice can't pay more than is owed.
+class OpenInvoices:
+
+    def __init__(self):
+        self.invoices = {}
+        self.remaining = {}
+        self.by_number = {}
+        self.by_amount_name = defaultdict(list)
+
+        open_invoices = Invoices.objects.exclude(status=Invoices.PAID).filter(amount_outstanding__gt=0) \
+                                        .values('pk', 'invoice_number', 'client_id', 'client__forename',
+                                                'client__surname', 'amount_outstanding').order_by('pk')
+        for invoice in open_invoices:
+            self.invoices[invoice['pk']] = invoice
+            self.remaining[invoice['pk']] = invoice['amount_outstanding']
+            self.by_number[_normalise(invoice['invoice_number'])] = invoice['pk']
+            self.by_amount_name[(invoice['amount_outstanding'], invoice['client__surname'].upper())].append(invoice['pk'])
+
+    # Invoice numbers quoted in the reference
+    def byReference(self, reference):
+        found = []
+        for word in _words(reference):
+            invoice_id = self.by_number.get(_normalise(word))
+            if invoice_id is not None and invoice_id not in found:
+                found.append(invoice_id)
+        return found
+
+    # Invoices owing exactly this amount for a client whose surname is in the payer name
+    # or reference. Where that finds more than one family, the forename or its initial
+    # is used to pick between them.
+    def byAmountAndName(self, amount, words):
+        candidates = []
+        for word in words:
+            for invoice_id in self.by_amount_name.get((amount, word), []):
+                if invoice_id not in candidates and self.remaining[invoice_id] == amount:
+                    candidates.append(invoice_id)
+
+        if len({self.invoices[invoice_id]['client_id'] for invoice_id in candidates}) > 1:
+            named = [invoice_id for invoice_id in candidates
+                     if self.invoices[invoice_id]['client__forename'].upper() in words
+                     or self.invoices[invoice_id]['client__forename'][0:1].upper() in words]
+            candidates = named or candidates
+
+        # Same family owing the same amount on more than one invoice, the oldest is paid
+        if len({self.invoices[invoice_id]['client_id'] for invoice_id in candidates}) == 1:
+            return candidates[:1]
+        return candidates
+
+
+def matchLine(line, open_invoices):
+    if line['amount'] is None or line['date'] is None:
+        return UNMATCHED, None, 'Could not read the date or amount'
+
+    found = open_invoices.byReference(line['reference'])
+    if len(found) > 1:
+        return AMBIGUOUS, None, 'Reference quotes more than one open invoice'
+
+    if found:
+        invoice_id = found[0]
+        remaining = open_invoices.remaining[invoice_id]
+        if line['amount'] > remaining:
+            return AMBIGUOUS, invoice_id, 'Paid %s but only %s is outstanding' % (line['amount'], remaining)
+        return MATCHED, invoice_id, 'Invoice number'
+
+    found = open_invoices.byAmountAndName(line['amount'], _words(line['name']) + _words(line['reference']))
+    if len(found) > 1:
+        return AMBIGUOUS, None, 'Amount and name match more than one family'
+    if found:
+        return MATCHED, found[0], 'Amount and name'
+
+    return UNMATCHED, None, 'No open invoice for the reference, amount or name'
+
+
+class ReconcileResult:
+
+    def __init__(self):
+        self.lines = []
+        self.ignored = 0
+        self.applied = Decimal('0.00')
+        self.seconds = 0
+
+    def _result(self, result):
+        return [line for line in self.lines if line['result'] == result]
+
+    @property
+    def matched(self):
+        return self._result(MATCHED)
+
+    @property
+    def unmatched(self):
+        return self._result(UNMATCHED)
+
+    @property
+    def ambiguous(self):
+        return self._result(AMBIGUOUS)
+
+    @property
+    def duplicates(self):
+        return self._result(DUPLICATE)
+
+
+# Status for the amount paid, the same rules UpdateInvoiceForm enforces
+def paidStatus(invoice, amount_paid):
+    if amount_paid >= invoice.total_amount:
+        return Invoices.PAID
+    if amount_paid > 0:
+        return Invoices.PART_PAID
+    return invoice.status
+
+
+# Apply one chunk of matched lines in a single transaction. The invoices are read again
+# and locked first, so a payment keyed in since the indexes were built isn't lost and a
+# line that would now take an invoice over its total is reported instead.
+def applyChunk(lines, result):
+    with transaction.atomic():
+        invoice_ids = {line['invoice'] for line in lines}
+        invoices = Invoices.objects.select_for_update().in_bulk(invoice_ids)
+
+        payments = []
+        for line in lines:
+            invoice = invoices[line['invoice']]
+            if invoice.amount_paid + line['amount'] > invoice.total_amount:
+                line['result'], line['reason'] = AMBIGUOUS, 'Invoice paid since the statement was read'
+                continue
+
+            invoice.amount_paid += line['amount']
+            invoice.amount_outstanding = invoice.total_amount - invoice.amount_paid
+            invoice.status = paidStatus(invoice, invoice.amount_paid)
+            payments.append(Payment(invoice=invoice, date_paid=line['date'], amount=line['amount'],
+                                    reference=line['reference'][0:200], payer=line['name'][0:100],
+                                    fingerprint=line['fingerprint']))
+            result.applied += line['amount']
+
+        Invoices.objects.bulk_update(invoices.values(), ['amount_paid', 'amount_outstanding', 'status'])
+        Payment.objects.bulk_create(payments)
+
+        # bulk_update doesn't send the signals that keep the balances up to date
+        rebuildBalances({invoice.client_id for invoice in invoices.values()})
+
+
+# Match the payments on a bank statement CSV to invoices and, unless apply is false,
+# record them against the invoices. Money going out is ignored. Lines already recorded
+# from an earlier statement are reported as duplicates and not applied again.
+def reconcileStatement(source, apply=True, chunk_size=CHUNK_SIZE):
+    result = ReconcileResult()
+    start = time.perf_counter()
+
+    lines = []
+    for line in readStatement(source):
+        if line['amount'] is not None and line['amount'] <= 0:
+            result.ignored += 1
+        else:
+            lines.append(line)
+    result.lines = lines
+
+    recorded = set()
+    for chunk in chunks([line['fingerprint'] for line in lines], chunk_size):
+        recorded.update(Payment.objects.filter(fingerprint__in=chunk).values_list('fingerprint', flat=True))
+
+    open_invoices = OpenInvoices()
+    for line in lines:
+        if line['fingerprint'] in recorded:
+            line['result'], line['reason'] = DUPLICATE, 'Already recorded from an earlier statement'
+            continue
+
+        line['result'], line['invoice'], line['reason'] = matchLine(line, open_invoices)
+        if line['result'] == MATCHED:
+            open_invoices.remaining[line['invoice']] -= line['amount']
+        if line['invoice'] is not None:
+            line['invoice_number'] = open_invoices.invoices[line['invoice']]['invoice_number']
+
+    if apply:
+        for chunk in chunks(result.matched, chunk_size):
+            applyChunk(chunk, result)
+
+    result.seconds = time.perf_counter() - start
+
+    return result
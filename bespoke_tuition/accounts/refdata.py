@@ -0,0 +1,107 @@
+import threading
+
+from django.core.signals import request_started
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Products, ReferenceVersion, Term
+
+# Products and terms change a few times a year but are read on most lesson pages, so
+# each process keeps them in memory. Every table has a version stamp in the database
+# which is bumped on any save or delete. The stamps are read once at the start of each
+# request (one small query) and anything cached for a table whose stamp has moved is
+# dropped, so a change made in one worker is seen by the others on their next request.
+_lock = threading.RLock()
+_state = {'checked': False, 'versions': None}
+_data = {}
+
+# Stamps are kept in line with the model the signal came from
+TABLES = {Products: 'products', Term: 'term'}
+
+
+def currentVersions():
+    return dict(ReferenceVersion.objects.values_list('name', 'version'))
+
+
+def _check():
+    if _state['checked']:
+        return
+
+    versions = currentVersions()
+    if versions != _state['versions']:
+        old = _state['versions'] or {}
+        for table, key in list(_data):
+            if _state['versions'] is None or old.get(table) != versions.get(table):
+                del _data[(table, key)]
+        _state['versions'] = versions
+
+    _state['checked'] = True
+
+
+# Drop whatever is cached for the table in this process and check the stamps again next time
+def invalidate(table=None):
+    with _lock:
+        for cached_table, key in list(_data):
+            if table is None or cached_table == table:
+                del _data[(cached_table, key)]
+        _state['checked'] = False
+
+
+def bumpVersion(table):
+    if not ReferenceVersion.objects.filter(name=table).update(version=F('version') + 1):
+        ReferenceVersion.objects.get_or_create(name=table)
+    invalidate(table)
+
+
+# Value built from a reference table, built once per version of the table in this process
+def cached(table, key, builder):
+    with _lock:
+        _check()
+        if (table, key) not in _data:
+            _data[(table, key)] = builder()
+        return _data[(table, key)]
+
+
+# Version stamp of a table as last checked, for things built from it that are cached
+# somewhere else and need to know when to be built again
+def tableVersion(table):
+    with _lock:
+        _check()
+        return (_state['versions'] or {}).get(table, 0)
+
+
+def products():
+    return cached('products', 'all', lambda: list(Products.objects.order_by('pk')))
+
+
+def productMap():
+    return cached('products', 'map', lambda: {product.pk: product for product in products()})
+
+
+def terms():
+    return cached('term', 'all', lambda: list(Term.objects.order_by('pk')))
+
+
+def termMap():
+    return cached('term', 'map', lambda: {term.pk: term for term in terms()})
+
+
+# Look the stamps up again next time anything is read. Done at the start of each request,
+# and for each job by the job workers.
+def recheckVersions():
+    with _lock:
+        _state['checked'] = False
+
+
+@receiver(request_started)
+def requestStarted(sender, **kwargs):
+    recheckVersions()
+
+
+@receiver(post_save, sender=Products)
+@receiver(post_delete, sender=Products)
+@receiver(post_save, sender=Term)
+@receiver(post_delete, sender=Term)
+def referenceChanged(sender, **kwargs):
+    bumpVersion(TABLES[sender])
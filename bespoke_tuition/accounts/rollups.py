@@ -0,0 +1,164 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F, Q, Sum
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .lessonchanges import lessonBefore, lessonReceiversPaused
+from .models import Lesson, RevenueRollup, Term
+from .pricing import productOn
+from .refdata import productMap, termMap
+
+# What a lesson adds to the rollups depends only on these
+LESSON_FIELDS = ['term_id', 'lesson_type_id', 'lesson_start', 'invoiced']
+
+# Ways the revenue page can add up the rollups
+GROUPS = ['product', 'term', 'month']
+
+# Values from a lesson row or instance. An instance just saved can still hold the start
+# as it was given, such as a string, so it is turned into an aware datetime first.
+def _values(lesson):
+    if isinstance(lesson, dict):
+        return [lesson[field] for field in LESSON_FIELDS]
+
+    term_id, lesson_type_id, lesson_start, invoiced = [getattr(lesson, field) for field in LESSON_FIELDS]
+    lesson_start = Lesson._meta.get_field('lesson_start').to_python(lesson_start)
+    if timezone.is_naive(lesson_start):
+        lesson_start = timezone.make_aware(lesson_start)
+    return [term_id, lesson_type_id, lesson_start, invoiced]
+
+
+# Rollup a lesson counts towards and what it adds to it. Lessons are valued at the price
+# on the day they took place, the same as the invoice lines.
+def _contribution(term_id, lesson_type_id, lesson_start, invoiced):
+    price = productOn(lesson_type_id, lesson_start).price
+    key = (term_id, lesson_type_id, timezone.localdate(lesson_start).replace(day=1))
+    return key, (1, price if invoiced else 0, 0 if invoiced else price)
+
+
+def _addUp(changes, lessons, sign):
+    for lesson in lessons:
+        key, amounts = _contribution(*_values(lesson))
+        changes[key] = [total + sign * amount for total, amount in zip(changes[key], amounts)]
+
+
+# Make sure there is a rollup row for each key before it is updated
+def _ensureRows(keys):
+    existing = set(RevenueRollup.objects.filter(product_id__in={key[1] for key in keys},
+                                                month__in={key[2] for key in keys})
+                                        .values_list('term_id', 'product_id', 'month'))
+    missing = [RevenueRollup(term_id=term_id, product_id=product_id, month=month)
+               for term_id, product_id, month in set(keys) - existing]
+    RevenueRollup.objects.bulk_create(missing, ignore_conflicts=True)
+
+
+# Take the lessons removed off their rollups and add the lessons added on. Lessons can be
+# model instances or dicts of LESSON_FIELDS. Using F() means the database does the adding
+# so two requests at the same time can't lose an update.
+def updateRollups(removed=(), added=()):
+    changes = defaultdict(lambda: [0, 0, 0])
+    _addUp(changes, removed, -1)
+    _addUp(changes, added, 1)
+    changes = {key: amounts for key, amounts in changes.items() if any(amounts)}
+
+    if not changes:
+        return
+
+    _ensureRows(changes)
+    for (term_id, product_id, month), (count, invoiced, uninvoiced) in changes.items():
+        RevenueRollup.objects.filter(term_id=term_id, product_id=product_id, month=month) \
+                             .update(lesson_count=F('lesson_count') + count,
+                                     invoiced_value=F('invoiced_value') + invoiced,
+                                     uninvoiced_value=F('uninvoiced_value') + uninvoiced,
+                                     date_updated=timezone.now())
+
+
+# Move lessons just marked as invoiced with a queryset update from uninvoiced to invoiced
+def lessonsInvoiced(lessons):
+    rows = list(lessons.values(*LESSON_FIELDS))
+    updateRollups(removed=[dict(row, invoiced=False) for row in rows], added=rows)
+
+
+# Work the rollups out again from the lessons, for every term or just the term ids given
+# (None for lessons with no term). Needed after lessons are loaded outside the app or a
+# price change that reaches back to lessons already in the rollups.
+def rebuildRollups(term_ids=None):
+    lessons = Lesson.objects.all()
+    rollups = RevenueRollup.objects.all()
+
+    if term_ids is not None:
+        term_ids = set(term_ids)
+        condition = Q(term__in=term_ids - {None})
+        if None in term_ids:
+            condition |= Q(term__isnull=True)
+        lessons = lessons.filter(condition)
+        rollups = rollups.filter(condition)
+
+    changes = defaultdict(lambda: [0, 0, 0])
+    _addUp(changes, lessons.values(*LESSON_FIELDS).iterator(chunk_size=2000), 1)
+
+    with transaction.atomic():
+        rollups.delete()
+        RevenueRollup.objects.bulk_create([RevenueRollup(term_id=term_id, product_id=product_id, month=month,
+                                                         lesson_count=count, invoiced_value=invoiced,
+                                                         uninvoiced_value=uninvoiced)
+                                           for (term_id, product_id, month), (count, invoiced, uninvoiced)
+                                           in changes.items()], batch_size=1000)
+
+    return len(changes)
+
+
+def _label(group, value):
+    if group == 'product':
+        product = productMap().get(value)
+        return product.product_name if product else str(value)
+    if group == 'term':
+        term = termMap().get(value)
+        return term.term_name if term else 'No term'
+    return value.strftime('%B %Y')
+
+
+# Revenue added up by product, term or month, for one term or all of them. Products
+# sharing a name (price changes) are shown together.
+def revenue(group, term_id=None):
+    rollups = RevenueRollup.objects.all()
+    if term_id is not None:
+        rollups = rollups.filter(term_id=term_id)
+
+    rows = {}
+    for row in rollups.values(group).annotate(lessons=Sum('lesson_count'), invoiced=Sum('invoiced_value'),
+                                              uninvoiced=Sum('uninvoiced_value')).order_by(group):
+        label = _label(group, row[group])
+        total = rows.setdefault(label, {'label': label, 'lessons': 0, 'invoiced': 0, 'uninvoiced': 0})
+        for field in ('lessons', 'invoiced', 'uninvoiced'):
+            total[field] += row[field]
+
+    rows = list(rows.values())
+    for row in rows:
+        row['total'] = row['invoiced'] + row['uninvoiced']
+
+    return rows
+
+
+# Take the lesson off the rollups as it was before the save and add it on as it is now
+@receiver(post_save, sender=Lesson)
+def lessonSaved(sender, instance, **kwargs):
+    if lessonReceiversPaused():
+        return
+
+    before = lessonBefore(instance)
+    updateRollups(removed=[before] if before else [], added=[instance])
+
+
+@receiver(post_delete, sender=Lesson)
+def lessonDeleted(sender, instance, **kwargs):
+    if not lessonReceiversPaused():
+        updateRollups(removed=[instance])
+
+
+# A term's lessons are left with no term when it is deleted, and its rollups go with it
+@receiver(post_delete, sender=Term)
+def termDeleted(sender, instance, **kwargs):
+    rebuildRollups([None])
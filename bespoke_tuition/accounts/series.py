@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .balances import refreshUninvoiced, studentParents
+from .lessonchanges import pauseLessonReceivers
+from .rollups import updateRollups, LESSON_FIELDS
+from .models import Lesson
+
+
+# Every date in the term that falls on the weekday, skipping half term
+def seriesDates(term, weekday):
+    day = term.term_start_date + timedelta(days=(weekday - term.term_start_date.weekday()) % 7)
+
+    while day <= term.term_end_date:
+        if not term.half_term_start_date <= day <= term.half_term_end_date:
+            yield day
+        day += timedelta(days=7)
+
+
+# Week a date falls in, so a lesson moved to another day still counts for the same week
+def _week(day):
+    return day.isocalendar()[:2]
+
+
+# Unsaved lessons for each date of the series. Weeks in skip_weeks already have a lesson
+# that has been invoiced so they are left out.
+def seriesLessons(series, skip_weeks=()):
+    tz = timezone.get_current_timezone()
+    lessons = []
+
+    for day in seriesDates(series.term, series.weekday):
+        if _week(day) in skip_weeks:
+            continue
+        lessons.append(Lesson(student_id=series.student_id, lesson_type_id=series.lesson_type_id,
+                              term_id=series.term_id, series=series,
+                              lesson_start=timezone.make_aware(datetime.combine(day, series.start_time), tz),
+                              lesson_end=timezone.make_aware(datetime.combine(day, series.end_time), tz)))
+
+    return lessons
+
+
+# Lesson inserts and deletes here are done in bulk so no signals are sent, the parents
+# uninvoiced balances are worked out again instead. The revenue rollups are given the
+# lessons added and removed.
+def _refreshBalances(series):
+    refreshUninvoiced(studentParents([series.student_id]))
+
+
+# Save a new series and insert all of its lessons with one bulk write
+def createSeries(series):
+    with transaction.atomic():
+        series.save()
+        lessons = Lesson.objects.bulk_create(seriesLessons(series))
+        _refreshBalances(series)
+        updateRollups(added=lessons)
+
+    return len(lessons)
+
+
+# Apply changes to a series. Lessons not invoiced yet are deleted and made again from the
+# series in one delete and one insert, weeks already invoiced are kept as they are.
+def updateSeries(series):
+    with transaction.atomic(), pauseLessonReceivers():
+        series.save()
+        removed = list(Lesson.objects.filter(series=series, invoiced=False).values(*LESSON_FIELDS))
+        Lesson.objects.filter(series=series, invoiced=False).delete()
+        invoiced_weeks = set(_week(timezone.localtime(start).date()) for start in
+                             Lesson.objects.filter(series=series).values_list('lesson_start', flat=True))
+        lessons = Lesson.objects.bulk_create(seriesLessons(series, invoiced_weeks))
+        _refreshBalances(series)
+        updateRollups(removed=removed, added=lessons)
+
+    return len(lessons)
+
+
+# Cancel a series, removing every lesson not yet invoiced. Invoiced lessons stay on
+# their invoice and lose the link to the series.
+def cancelSeries(series):
+    with transaction.atomic(), pauseLessonReceivers():
+        removed = list(Lesson.objects.filter(series=series, invoiced=False).values(*LESSON_FIELDS))
+        deleted, counts = Lesson.objects.filter(series=series, invoiced=False).delete()
+        series.delete()
+        _refreshBalances(series)
+        updateRollups(removed=removed)
+
+    return deleted
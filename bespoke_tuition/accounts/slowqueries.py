@@ -0,0 +1,252 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+
+from .querycount import queryShape
+from .queryplans import explain
+
+# Queries taking longer than this many seconds are logged
+SLOW_QUERY_SECONDS = 0.1
+
+# The log is started again once it reaches this size, keeping this many old ones
+LOG_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+
+# Long parameter lists, such as a big IN (...), are cut down to this many in the log
+MAX_PARAMS = 50
+
+# Only statements that read or change rows have a plan worth showing
+EXPLAINED = ('SELECT', 'UPDATE', 'DELETE', 'WITH')
+
+# How long saving or reading a plan waits on another process before doing without it
+PLAN_BUSY_SECONDS = 0.1
+
+PLAN_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS query_plans (
+    shape TEXT PRIMARY KEY,
+    plan TEXT NOT NULL,
+    explained TEXT NOT NULL
+);
+'''
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Files in the app that are part of the recording rather than the code running the query
+_SKIPPED = {os.path.join(APP_DIR, name) for name in ('slowqueries.py', 'middleware.py', 'querycount.py')}
+
+logger = logging.getLogger('accounts.slowqueries')
+logger.propagate = False
+
+_seen_shapes = set()
+_plan_connections = {}
+_lock = threading.Lock()
+
+
+def slowQueryLog():
+    return getattr(settings, 'SLOW_QUERY_LOG', None)
+
+
+def slowQuerySeconds():
+    return getattr(settings, 'SLOW_QUERY_SECONDS', SLOW_QUERY_SECONDS)
+
+
+# Point the logger at the rotating file for the SLOW_QUERY_LOG setting. Each worker process
+# rolls the file over on its own, fine for occasional slow queries but a busy site with
+# several workers should give each its own file.
+def _logFile(path):
+    path = os.path.abspath(path)
+    if not any(handler.baseFilename == path for handler in logger.handlers):
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        handler = RotatingFileHandler(path, maxBytes=getattr(settings, 'SLOW_QUERY_LOG_BYTES', LOG_BYTES),
+                                      backupCount=getattr(settings, 'SLOW_QUERY_LOG_BACKUPS', LOG_BACKUPS),
+                                      encoding='utf-8', delay=True)
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    return logger
+
+
+def _frameInfo(frame, filename):
+    return {'file': filename, 'line': frame.f_lineno, 'function': frame.f_code.co_name}
+
+
+# The lines of app code the query was run from, innermost first, found by walking out of
+# Django's ORM. A query run by a helper such as keysetPaginate shows the helper and then
+# the view that called it, one run by a template shows the render() call in the view. For
+# code in other apps it falls back to the first frame outside Django.
+def callStack(frame=None, depth=5):
+    frame = frame or sys._getframe(1)
+    stack, fallback = [], None
+    django_dir = os.path.dirname(os.path.abspath(sys.modules['django'].__file__))
+    while frame is not None and len(stack) < depth:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(APP_DIR) and filename not in _SKIPPED:
+            stack.append(_frameInfo(frame, os.path.relpath(filename, os.path.dirname(APP_DIR))))
+        elif fallback is None and not filename.startswith(django_dir) and filename not in _SKIPPED:
+            fallback = _frameInfo(frame, filename)
+        frame = frame.f_back
+    return stack or ([fallback] if fallback else [])
+
+
+def _params(params, many):
+    if many:
+        return {'rows': len(params)}
+    params = list(params or ())
+    if len(params) > MAX_PARAMS:
+        return params[:MAX_PARAMS] + ['... %d more' % (len(params) - MAX_PARAMS)]
+    return params
+
+
+# True the first time this process sees a query shape
+def _firstOfShape(shape):
+    with _lock:
+        if shape in _seen_shapes:
+            return False
+        _seen_shapes.add(shape)
+        return True
+
+
+# The latest plan of each query shape is kept in a small SQLite file next to the log, so
+# the page can show it long after the entry it was logged with has rolled out of the log.
+# A connection per process as they can't be shared after a fork. Call with _lock held.
+def _planStore():
+    path = os.path.abspath(slowQueryLog()) + '.plans'
+    key = (os.getpid(), path)
+    if key not in _plan_connections:
+        connection = sqlite3.connect(path, timeout=PLAN_BUSY_SECONDS, check_same_thread=False,
+                                     isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(PLAN_SCHEMA)
+        _plan_connections[key] = connection
+    return _plan_connections[key]
+
+
+# Keep the plan for the shape, doing without if the file is busy as it is in the log anyway
+def savePlan(shape, plan):
+    try:
+        with _lock:
+            _planStore().execute('INSERT OR REPLACE INTO query_plans (shape, plan, explained) VALUES (?, ?, ?)',
+                                 (shape, json.dumps(plan), timezone.now().isoformat()))
+    except sqlite3.Error:
+        pass
+
+
+# The kept plans for the shapes given
+def storedPlans(shapes):
+    shapes = list(shapes)
+    if not shapes:
+        return {}
+    try:
+        with _lock:
+            rows = _planStore().execute('SELECT shape, plan FROM query_plans WHERE shape IN (%s)'
+                                        % ', '.join('?' * len(shapes)), shapes).fetchall()
+    except sqlite3.Error:
+        return {}
+    return {shape: json.loads(plan) for shape, plan in rows}
+
+
+# Execute wrapper timing each query run while handling a request. Queries over the
+# threshold are written to the log with the view and the app code that ran them, and
+# the first of each shape in a process gets its plan, which is also kept in the plan
+# store. A query that failed is logged without a plan as the connection may not take
+# another statement until the error is dealt with. Installed by SlowQueryMiddleware. The
+# time is for the execute, with sqlite that is up to the first row so a sort or an
+# aggregate is counted in full but reading a long result afterwards isn't.
+class SlowQueryRecorder:
+
+    def __init__(self, request=None, threshold=None):
+        self.request = request
+        self.threshold = slowQuerySeconds() if threshold is None else threshold
+        self._explaining = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if self._explaining:
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = execute(sql, params, many, context)
+            failed = False
+            return result
+        finally:
+            duration = time.perf_counter() - start
+            if duration >= self.threshold:
+                self.record(sql, params, many, duration, context['connection'], sys._getframe(1), failed)
+
+    def _viewName(self):
+        match = getattr(self.request, 'resolver_match', None)
+        if match:
+            return match.view_name
+        return self.request.path if self.request is not None else None
+
+    def record(self, sql, params, many, duration, using, frame, failed=False):
+        shape = queryShape(sql)
+        entry = {'time': timezone.now().isoformat(), 'view': self._viewName(), 'duration': round(duration, 6),
+                 'sql': sql, 'params': _params(params, many), 'stack': callStack(frame),
+                 'shape': hashlib.sha1(shape.encode()).hexdigest()[:12]}
+
+        if failed:
+            entry['failed'] = True
+        elif not many and sql.lstrip().upper().startswith(EXPLAINED) and _firstOfShape(shape):
+            self._explaining = True
+            try:
+                entry['plan'] = explain(sql, params or (), using)
+                savePlan(entry['shape'], entry['plan'])
+            except DatabaseError as error:
+                entry['plan'] = ['Could not explain: %s' % error]
+            finally:
+                self._explaining = False
+
+        _logFile(slowQueryLog()).info(json.dumps(entry, default=str))
+
+
+# Last lines of a file, read backwards in blocks so a large log isn't read in full
+def _tail(path, limit, block=64 * 1024):
+    with open(path, 'rb') as log:
+        log.seek(0, os.SEEK_END)
+        position = log.tell()
+        data = b''
+        while position > 0 and data.count(b'\n') <= limit:
+            size = min(block, position)
+            position -= size
+            log.seek(position)
+            data = log.read(size) + data
+    lines = data.splitlines()
+    if position > 0:
+        lines = lines[1:]
+    return lines[-limit:]
+
+
+# Newest entries in the current log first, for the slow queries page. The plan for a
+# query shape is only logged with its first occurrence in each process, so the later ones
+# are given the plan from an entry shown alongside or from the plan store.
+def recentEntries(limit=100):
+    path = slowQueryLog()
+    if not path or not os.path.exists(path):
+        return []
+
+    entries = []
+    for line in _tail(path, limit):
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            continue
+
+    plans = {entry['shape']: entry['plan'] for entry in entries if 'plan' in entry}
+    plans.update(storedPlans({entry['shape'] for entry in entries if not entry.get('failed')} - set(plans)))
+    for entry in entries:
+        entry.setdefault('plan', plans.get(entry['shape']))
+
+    return entries[::-1]
@@ -2,7 +2,16 @@ from django.test import TestCase
 from django.test import LiveServerTestCase
 from selenium import webdriver
 from selenium.webdriver.common.keys import Keys
+from django.db.models import Sum
+from django.contrib.auth.models import Group
+from django.urls import reverse
+from django.utils import timezone
+from django.core.management import call_command
+from io import StringIO
+from datetime import date, datetime, time, timedelta
+import json
 from .forms import *
+from .calendars import feedToken, CLIENT, STUDENT
 
 """
 Whilst this does not have a great deal of testing within the script, I can assure you that 100% of my
@@ -77,3 +86,1541 @@ I think this needs a client to be registered already to work which is what i tri
                                    'password2': "thistest1"})
         self.assertTrue(reg.is_valid())
 """
+
+class TestBatchInvoicing(TestCase):
+
+    def setUp(self):
+        self.term = Term.objects.create(term_name="Autumn", term_start_date="2021-09-01",
+                                        term_end_date="2021-12-17", half_term_start_date="2021-10-25",
+                                        half_term_end_date="2021-10-29")
+        self.product = Products.objects.create(product_name="Maths", price=20,
+                                               effective_from_date="2021-01-01")
+        self.clients = []
+        for i in range(3):
+            client = Client.objects.create(forename="Parent", surname="Smith")
+            student = Student.objects.create(forename="Child", surname="Smith")
+            student.parent.add(client)
+            for day in range(1, 3):
+                Lesson.objects.create(student=student, lesson_type=self.product, term=self.term,
+                                      lesson_start="2021-09-0%dT16:00:00Z" % day,
+                                      lesson_end="2021-09-0%dT17:00:00Z" % day)
+            self.clients.append(client)
+
+    # Does the batch run create one invoice per client with the totals from the lessons?
+    def test_run_invoices(self):
+        from .invoicing import runInvoices
+        results = runInvoices(chunk_size=2)
+        self.assertEqual(sum(r['invoices'] for r in results), 3)
+        self.assertEqual(Lesson.objects.filter(invoiced=False).count(), 0)
+        for invoice in Invoices.objects.all():
+            self.assertEqual(invoice.total_amount, 40)
+            self.assertEqual(invoice.amount_outstanding, 40)
+
+    # Running it again shouldn't create any more invoices
+    def test_run_invoices_rerun(self):
+        from .invoicing import runInvoices
+        runInvoices()
+        results = runInvoices()
+        self.assertEqual(sum(r['invoices'] for r in results), 0)
+        self.assertEqual(Invoices.objects.count(), 3)
+
+    # A student with two parents should only be billed to one of them
+    def test_shared_student_billed_once(self):
+        from .invoicing import runInvoices
+        shared = Student.objects.get(parent=self.clients[0])
+        shared.parent.add(self.clients[1])
+        runInvoices()
+        self.assertEqual(Invoices.objects.aggregate(total=Sum('total_amount'))['total'], 120)
+
+    # Is a student who is the only child of both their parents billed once, with no empty invoice?
+    def test_shared_only_child(self):
+        from .invoicing import runInvoices
+        Lesson.objects.all().delete()
+        shared = Student.objects.get(parent=self.clients[0])
+        shared.parent.add(self.clients[1])
+        Student.objects.filter(parent=self.clients[1]).exclude(pk=shared.pk).delete()
+        Lesson.objects.create(student=shared, lesson_type=self.product, term=self.term,
+                              lesson_start="2021-09-01T16:00:00Z", lesson_end="2021-09-01T17:00:00Z")
+
+        results = runInvoices()
+        self.assertEqual(sum(r['invoices'] for r in results), 1)
+        self.assertEqual(list(Invoices.objects.values_list('total_amount', flat=True)), [20])
+
+    # Is a run over several workers turned away on sqlite before anything is invoiced?
+    def test_workers_on_sqlite(self):
+        from django.core.management.base import CommandError
+        from .invoicing import runInvoices
+        with self.assertRaises(ValueError):
+            runInvoices(workers=4)
+        with self.assertRaises(CommandError):
+            call_command('runinvoices', workers=4, stdout=StringIO())
+        self.assertEqual(Invoices.objects.count(), 0)
+
+    # Are the numbers readable, unique and in order even with the same surname?
+    def test_invoice_numbers(self):
+        from .invoicing import runInvoices
+        from .numbering import invoiceYear
+        runInvoices(chunk_size=2)
+        year = invoiceYear()
+        numbers = list(Invoices.objects.order_by('client').values_list('invoice_number', flat=True))
+        self.assertEqual(numbers, ['SMI-%d-%06d' % (year, number) for number in (1, 2, 3)])
+
+    # Do two workers get separate blocks, and does a new year start again from one?
+    def test_number_allocator(self):
+        from .numbering import InvoiceNumberAllocator, allocateBlock
+        first = InvoiceNumberAllocator(block_size=10)
+        second = InvoiceNumberAllocator(block_size=10)
+        self.assertEqual(first.take(3, 2026), [1, 2, 3])
+        self.assertEqual(second.take(3, 2026), [11, 12, 13])
+        first.giveBack([3], 2026)
+        self.assertEqual(first.take(8, 2026), [3, 4, 5, 6, 7, 8, 9, 10])
+        self.assertEqual(first.take(1, 2026), [21])
+        self.assertEqual(allocateBlock(2027, 2), [1, 2])
+
+class TestQueryBudgets(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="admin", password="thistest1", is_staff=True)
+        cls.user.groups.add(Group.objects.create(name="admin"))
+        Group.objects.create(name="customer")
+
+        term = Term.objects.create(term_name="Autumn", term_start_date="2021-09-01",
+                                   term_end_date="2021-12-17", half_term_start_date="2021-10-25",
+                                   half_term_end_date="2021-10-29")
+        products = [Products.objects.create(product_name="Product%d" % i, price=10 + i,
+                                            effective_from_date="2021-01-01",
+                                            effective_to_date="2022-01-01") for i in range(3)]
+
+        # Enough rows that any per row query would go well over the budgets
+        for i in range(10):
+            client = Client.objects.create(forename="Parent", surname="Smith")
+            Address.objects.create(client=client, line_one="1 Street", town="Town",
+                                   postcode="AB1 2CD", effective_from_date="2021-01-01")
+            ContactDetails.objects.create(client=client, contact_number="0123",
+                                          email_address="parent%d@example.com" % i)
+            invoice = Invoices.objects.create(invoice_number="SMI%d" % i, client=client, total_amount=100,
+                                              amount_paid=0, amount_outstanding=100)
+            for j in range(2):
+                student = Student.objects.create(forename="Child", surname="Smith")
+                student.parent.add(client)
+                TuitionAddress.objects.create(student=student, line_one="1 Street", town="Town",
+                                              postcode="AB1 2CD")
+                for day in range(1, 6):
+                    Lesson.objects.create(student=student, lesson_type=products[day % 3], term=term,
+                                          lesson_start="2021-09-0%dT16:00:00Z" % day,
+                                          lesson_end="2021-09-0%dT17:00:00Z" % day,
+                                          invoiced=day < 3, invoice_number=invoice if day < 3 else None)
+
+        client.user = cls.user
+        client.save()
+
+        from .invoicing import createInvoiceLines
+        createInvoiceLines(Invoices.objects.values_list('pk', flat=True))
+        cls.client_obj = client
+        cls.student = student
+        cls.lesson = Lesson.objects.filter(student=student, invoiced=False).first()
+        cls.invoice = invoice
+        cls.product = products[0]
+        cls.term = term
+        cls.job = Job.objects.create(task='invoices')
+        cls.series = LessonSeries.objects.create(student=student, lesson_type=products[0], term=term,
+                                                 weekday=LessonSeries.MONDAY, start_time="16:00",
+                                                 end_time="17:00")
+
+    def urlArgs(self, name):
+        args = {'updateproduct': [self.product.pk],
+                'updateterm': [self.term.pk],
+                'lessonconflicts': [self.term.pk],
+                'clientdetailedinvoice': [self.invoice.pk],
+                'client': [self.client_obj.pk],
+                'student': [self.student.pk],
+                'addlessons': [self.student.pk],
+                'addseries': [self.student.pk],
+                'updateseries': [self.series.pk],
+                'cancelseries': [self.series.pk],
+                'updatelesson': [self.lesson.pk],
+                'deletelesson': [self.lesson.pk],
+                'accountsdetailed': [self.client_obj.pk],
+                'invoicesdetailed': [self.invoice.pk],
+                'updateinvoice': [self.invoice.pk],
+                'export': ['lessons'],
+                'jobdetail': [self.job.pk],
+                'queuejob': ['invoices'],
+                'calendarfeed': [feedToken(CLIENT, self.client_obj)]}
+        return args.get(name, [])
+
+    # Does every page stay within its query budget with no repeated queries?
+    def test_query_budgets(self):
+        from .urls import QUERY_BUDGETS
+        from .querycount import QueryRecorder
+
+        # First request loads the users roles into the role cache
+        self.client.force_login(self.user)
+        self.client.get(reverse('accounts:allclients'))
+
+        for name, budget in QUERY_BUDGETS.items():
+            with self.subTest(url=name):
+                # Logging in again each time as the logout page ends the session
+                self.client.force_login(self.user)
+                url = reverse('accounts:' + name, args=self.urlArgs(name))
+                with QueryRecorder() as recorder:
+                    response = self.client.get(url)
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                self.assertLessEqual(recorder.count, budget, [q['sql'] for q in recorder.queries])
+                self.assertEqual(recorder.repeated(), [])
+
+    # Does every page avoid full scans of the large tables?
+    def test_query_plans(self):
+        output = StringIO()
+        call_command('checkqueryplans', username='admin', stdout=output, stderr=StringIO())
+        self.assertIn('No full scans of large tables', output.getvalue())
+
+    # Is a full scan spotted in a plan, but not a limited walk of an index in order?
+    def test_full_scan_detected(self):
+        from .queryplans import fullScans
+        by_id = 'SELECT ... FROM "accounts_lesson" ORDER BY "accounts_lesson"."id" ASC LIMIT 51'
+        by_start = 'SELECT ... FROM "accounts_lesson" %s ORDER BY "accounts_lesson"."lesson_start" ASC LIMIT 51'
+        walk = ['SCAN accounts_lesson USING INDEX accounts_le_lesson__112cf8_idx']
+        self.assertEqual(fullScans(['SCAN accounts_lesson']), ['accounts_lesson'])
+        self.assertEqual(fullScans(['SEARCH accounts_lesson USING INDEX idx (student_id=?)']), [])
+        self.assertEqual(fullScans(['SCAN accounts_lesson'], sql='SELECT ... LIMIT 51'), ['accounts_lesson'])
+        self.assertEqual(fullScans(['SCAN accounts_lesson'], sql=by_id), [])
+        self.assertEqual(fullScans(['SCAN accounts_lesson', 'USE TEMP B-TREE FOR ORDER BY'], sql=by_id),
+                         ['accounts_lesson'])
+        self.assertEqual(fullScans(walk, sql=by_start % ''), [])
+        self.assertEqual(fullScans(walk, sql=by_start % 'WHERE "accounts_lesson"."lesson_end" > %s'), [])
+        # A filter the index can't answer can read every row before the page is full
+        self.assertEqual(fullScans(walk, sql=by_start % 'WHERE "accounts_lesson"."term_id" = %s'),
+                         ['accounts_lesson'])
+        filtered_by_id = by_id.replace('ORDER', 'WHERE "accounts_lesson"."term_id" = %s ORDER')
+        self.assertEqual(fullScans(['SCAN accounts_lesson'], sql=filtered_by_id), ['accounts_lesson'])
+
+    # Are repeated query shapes picked up as an N+1?
+    def test_repeated_queries_detected(self):
+        from .querycount import QueryRecorder
+
+        with QueryRecorder() as recorder:
+            for lesson in Lesson.objects.all():
+                lesson.lesson_type.product_name
+        self.assertEqual(len(recorder.repeated()), 1)
+
+class TestSeedData(TestCase):
+
+    # Does the seed command create the volumes asked for with the invoice totals set?
+    def test_seed_volumes(self):
+        call_command('seeddata', clients=20, students=30, lessons=200, invoices=40, batch_size=50,
+                     seed=1, stdout=StringIO())
+        self.assertEqual(Client.objects.count(), 20)
+        self.assertEqual(Student.objects.count(), 30)
+        self.assertEqual(Lesson.objects.count(), 200)
+        self.assertEqual(Invoices.objects.count(), 40)
+        invoiced_total = Lesson.objects.filter(invoiced=True).aggregate(total=Sum('lesson_type__price'))['total']
+        self.assertEqual(Invoices.objects.aggregate(total=Sum('total_amount'))['total'], invoiced_total)
+
+class TestKeysetPagination(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(7):
+            Client.objects.create(forename="Parent", surname="Smith" if i % 2 else "Jones")
+
+    # Can every client be reached by following the next cursors, and back again?
+    def test_pages_forward_and_back(self):
+        from .pagination import keysetPaginate
+        seen = []
+        page = keysetPaginate(Client.objects.all(), ['pk'], page_size=3)
+        pages = [page]
+        while page.has_next:
+            page = keysetPaginate(Client.objects.all(), ['pk'], after=page.next_cursor, page_size=3)
+            pages.append(page)
+        for page in pages:
+            seen.extend(client.pk for client in page)
+        self.assertEqual(seen, list(Client.objects.order_by('pk').values_list('pk', flat=True)))
+        self.assertFalse(pages[0].has_previous)
+
+        previous = keysetPaginate(Client.objects.all(), ['pk'], before=pages[-1].previous_cursor, page_size=3)
+        self.assertEqual([c.pk for c in previous], [c.pk for c in pages[-2]])
+
+    # Does a new client added after the first page was shown not move the next page?
+    def test_stable_under_inserts(self):
+        from .pagination import keysetPaginate
+        first = keysetPaginate(Client.objects.all(), ['-pk'], page_size=3)
+        Client.objects.create(forename="New", surname="Client")
+        second = keysetPaginate(Client.objects.all(), ['-pk'], after=first.next_cursor, page_size=3)
+        self.assertLess(second.rows[0].pk, first.rows[-1].pk)
+        self.assertEqual(second.rows[0].pk, first.rows[-1].pk - 1)
+
+    # Are rows whose sort values share a millisecond each shown once, in order?
+    def test_same_millisecond(self):
+        from .pagination import keysetPaginate
+        client = Client.objects.first()
+        created = timezone.make_aware(datetime(2021, 9, 1, 16, 0, 0, 123000))
+        for i in range(5):
+            invoice = Invoices.objects.create(invoice_number="SMI%d" % i, client=client, total_amount=10,
+                                              amount_paid=0, amount_outstanding=10)
+            Invoices.objects.filter(pk=invoice.pk).update(date_created=created + timedelta(microseconds=100 * i))
+
+        seen = []
+        page = keysetPaginate(Invoices.objects.all(), ['date_created', 'pk'], page_size=2)
+        seen.extend(invoice.pk for invoice in page)
+        while page.has_next:
+            page = keysetPaginate(Invoices.objects.all(), ['date_created', 'pk'], after=page.next_cursor, page_size=2)
+            seen.extend(invoice.pk for invoice in page)
+            self.assertLessEqual(len(seen), 5)
+        self.assertEqual(seen, list(Invoices.objects.order_by('date_created', 'pk').values_list('pk', flat=True)))
+
+    # Does the search only return matching names?
+    def test_name_search(self):
+        user = User.objects.create_user(username="admin", password="thistest1")
+        user.groups.add(Group.objects.create(name="admin"))
+        self.client.force_login(user)
+        response = self.client.get(reverse('accounts:allclients'), {'search': 'smi'})
+        self.assertEqual(len(response.context['clients']), 3)
+
+    # Do the name and invoice number searches use the case insensitive indexes?
+    def test_search_indexes(self):
+        from .queryplans import explain
+        from .views import nameSearch
+        for queryset in (nameSearch(Client.objects.order_by('pk'), 'smi'), nameSearch(Student.objects.all(), 'Smi'),
+                         Invoices.objects.filter(invoice_number__istartswith='inv-0')):
+            sql, params = queryset.query.sql_with_params()
+            plan = explain(sql, params)
+            self.assertFalse([line for line in plan if line.startswith('SCAN')], plan)
+
+class TestRoleCache(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="customer", password="thistest1")
+        self.admin = Group.objects.create(name="admin")
+        self.customer = Group.objects.create(name="customer")
+        self.user.groups.add(self.customer)
+
+    # Is the second role check served from the cache?
+    def test_roles_cached(self):
+        from .roles import hasRole, rolesCacheStats
+        hasRole(self.user, ['admin', 'customer'])
+        before = rolesCacheStats()
+        with self.assertNumQueries(0):
+            self.assertTrue(hasRole(self.user, ['admin', 'customer']))
+        self.assertEqual(rolesCacheStats()['avoided'] - before['avoided'], 2)
+
+    # Are the cached roles dropped when the user is added to a group?
+    def test_roles_invalidated(self):
+        from .roles import hasRole
+        self.assertFalse(hasRole(self.user, ['admin']))
+        self.user.groups.add(self.admin)
+        self.assertTrue(hasRole(self.user, ['admin']))
+        self.admin.user_set.remove(self.user)
+        self.assertFalse(hasRole(self.user, ['admin']))
+
+    # Is a change made by another worker seen here on the next request?
+    def test_roles_other_worker(self):
+        from django.db.models import F
+        from .roles import hasRole
+        from . import refdata
+        self.user.groups.add(self.admin)
+        self.assertTrue(hasRole(self.user, ['admin']))
+
+        # The other worker's change, its signal bumped the stamp in the database only
+        User.groups.through.objects.filter(user=self.user, group=self.admin).delete()
+        ReferenceVersion.objects.filter(name='roles').update(version=F('version') + 1)
+        self.assertTrue(hasRole(self.user, ['admin']))
+
+        refdata.recheckVersions()
+        self.assertFalse(hasRole(self.user, ['admin']))
+
+class TestInvoiceLines(TestCase):
+
+    def setUp(self):
+        term = Term.objects.create(term_name="Autumn", term_start_date="2021-09-01",
+                                   term_end_date="2021-12-17", half_term_start_date="2021-10-25",
+                                   half_term_end_date="2021-10-29")
+        self.product = Products.objects.create(product_name="Maths", price=20, effective_from_date="2021-01-01")
+        self.client_obj = Client.objects.create(forename="Parent", surname="Smith")
+        student = Student.objects.create(forename="Child", surname="Smith")
+        student.parent.add(self.client_obj)
+        for day in range(1, 4):
+            Lesson.objects.create(student=student, lesson_type=self.product, term=term,
+                                  lesson_start="2021-09-0%dT16:00:00Z" % day,
+                                  lesson_end="2021-09-0%dT17:00:00Z" % day)
+
+    # Do the lines keep the price charged when the product price changes later?
+    def test_lines_snapshot_price(self):
+        from .invoicing import runInvoices
+        runInvoices()
+        self.product.price = 25
+        self.product.save()
+        line = InvoiceLine.objects.get()
+        self.assertEqual((line.quantity, line.unit_price, line.line_total), (3, 20, 60))
+
+    # Does the backfill command write lines for invoices without them, only once?
+    def test_backfill(self):
+        invoice = Invoices.objects.create(invoice_number="SMI1", client=self.client_obj, total_amount=60,
+                                          amount_paid=0, amount_outstanding=60)
+        Lesson.objects.update(invoiced=True, invoice_number=invoice)
+        call_command('backfillinvoicelines', stdout=StringIO())
+        call_command('backfillinvoicelines', stdout=StringIO())
+        self.assertEqual(invoice.lines.count(), 1)
+
+class TestClientBalances(TestCase):
+
+    def setUp(self):
+        self.term = Term.objects.create(term_name="Autumn", term_start_date="2021-09-01",
+                                        term_end_date="2021-12-17", half_term_start_date="2021-10-25",
+                                        half_term_end_date="2021-10-29")
+        self.product = Products.objects.create(product_name="Maths", price=20, effective_from_date="2021-01-01")
+        self.client_obj = Client.objects.create(forename="Parent", surname="Smith")
+        self.student = Student.objects.create(forename="Child", surname="Smith")
+        self.student.parent.add(self.client_obj)
+
+    def addLesson(self, day):
+        return Lesson.objects.create(student=self.student, lesson_type=self.product, term=self.term,
+                                     lesson_start="2021-09-0%dT16:00:00Z" % day,
+                                     lesson_end="2021-09-0%dT17:00:00Z" % day)
+
+    def balance(self):
+        return ClientBalance.objects.get(client=self.client_obj)
+
+    # Do lessons being added and deleted change the uninvoiced value?
+    def test_lessons_update_balance(self):
+        self.addLesson(1)
+        lesson = self.addLesson(2)
+        self.assertEqual(self.balance().uninvoiced_value, 40)
+        lesson.delete()
+        self.assertEqual(self.balance().uninvoiced_value, 20)
+
+    # Do invoices being created and paid move the totals, matching a full rebuild?
+    def test_invoices_update_balance(self):
+        from .invoicing import runInvoices
+        from .balances import rebuildBalances
+        self.addLesson(1)
+        self.addLesson(2)
+        runInvoices()
+        invoice = Invoices.objects.get()
+        invoice.amount_paid = 15
+        invoice.amount_outstanding = 25
+        invoice.save()
+
+        balance = self.balance()
+        self.assertEqual((balance.total_invoiced, balance.total_paid, balance.total_outstanding,
+                          balance.uninvoiced_value), (40, 15, 25, 0))
+
+        rebuildBalances([self.client_obj.pk])
+        rebuilt = self.balance()
+        self.assertEqual((rebuilt.total_invoiced, rebuilt.total_paid, rebuilt.total_outstanding,
+                          rebuilt.uninvoiced_value), (40, 15, 25, 0))
+
+class TestExports(TestCase):
+
+    def setUp(self):
+        term = Term.objects.create(term_name="Autumn", term_start_date="2021-09-01",
+                                   term_end_date="2021-12-17", half_term_start_date="2021-10-25",
+                                   half_term_end_date="2021-10-29")
+        product = Products.objects.create(product_name="Maths", price=20, effective_from_date="2021-01-01")
+        client = Client.objects.create(forename="Parent", surname="Smith")
+        student = Student.objects.create(forename="Child", surname="Smith")
+        student.parent.add(client)
+        for day in range(1, 4):
+            Lesson.objects.create(student=student, lesson_type=product, term=term,
+                                  lesson_start="2021-09-0%dT16:00:00Z" % day,
+                                  lesson_end="2021-09-0%dT17:00:00Z" % day)
+        user = User.objects.create_user(username="admin", password="thistest1")
+        user.groups.add(Group.objects.create(name="admin"))
+        self.client.force_login(user)
+
+    # Does the CSV export stream the filtered lessons with the joined names?
+    def test_lesson_csv(self):
+        response = self.client.get(reverse('accounts:export', args=['lessons']),
+                                   {'date_from': '2021-09-02', 'status': 'uninvoiced'})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('lesson_id,lesson_start'))
+        self.assertIn('Child,Smith,Maths,20.00,Autumn', lines[1])
+
+    # Does the benchmark read the streamed body, so the export's queries are counted?
+    def test_benchmark_reads_body(self):
+        import tempfile
+        from .querycount import QueryRecorder
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = directory.name + '/benchmark.json'
+
+        # The benchmark calls the pages as localhost
+        with self.settings(ALLOWED_HOSTS=['localhost']):
+            call_command('benchmarkviews', username='admin', iterations=1, urls=['export'], output=path,
+                         stdout=StringIO(), stderr=StringIO())
+
+        with QueryRecorder() as recorder:
+            response = self.client.get(reverse('accounts:export', args=['lessons']))
+            b''.join(response.streaming_content)
+        with open(path) as results:
+            self.assertEqual(json.load(results)['views']['export']['queries'], recorder.count)
+
+    # Does the command write one JSON object per client?
+    def test_client_jsonl_command(self):
+        output = StringIO()
+        call_command('exportdata', 'clients', format='jsonl', stdout=output)
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([row['surname'] for row in rows], ['Smith'])
+
+class TestImportClients(TestCase):
+
+    header = ("forename,surname,line_one,town,postcode,contact_number,email_address,"
+              "student_forename,student_surname,student_school_year,tuition_line_one,tuition_town,tuition_postcode\n")
+
+    # Are families with more than one child imported once, and bad rows reported?
+    def test_import_csv(self):
+        from .importer import importClients
+        ContactDetails.objects.create(client=Client.objects.create(forename="Old", surname="Client"),
+                                      contact_number="0123", email_address="old@example.com")
+        source = StringIO(self.header +
+                          "Jane,Smith,1 Street,Town,AB1 2CD,0123,jane@example.com,Tom,Smith,3,1 Street,Town,AB1 2CD\n"
+                          ",,,,,,jane@example.com,Amy,Smith,5,,,\n"
+                          "Bob,Jones2,1 Street,Town,AB1 2CD,0123,bob@example.com,,,,,,\n"
+                          "Old,Client,1 Street,Town,AB1 2CD,0123,old@example.com,,,,,,\n"
+                          ",,,,,,bob@example.com,Sam,Jones,2,,,\n")
+        result = importClients(source, chunk_size=2)
+
+        self.assertEqual((result.clients, result.students), (1, 2))
+        self.assertEqual([error['row'] for error in result.errors], [3, 4, 5])
+        self.assertIn('surname', result.errors[0]['errors'])
+        jane = Client.objects.get(forename="Jane")
+        self.assertEqual(jane.student_set.count(), 2)
+        self.assertEqual(TuitionAddress.objects.count(), 1)
+
+    # Is an email address only differing in case treated as the same one when importing or adding a contact?
+    def test_email_case(self):
+        from .importer import importClients
+        old = Client.objects.create(forename="Old", surname="Client")
+        ContactDetails.objects.create(client=old, contact_number="0123", email_address="Old@Example.com")
+        self.assertTrue(ContactDetails.objects.filter(email_address="old@example.com").exists())
+
+        result = importClients(StringIO(self.header + "Old,Client,1 Street,Town,AB1 2CD,0123,OLD@example.com,,,,,,\n"))
+        self.assertEqual((result.clients, len(result.errors)), (0, 1))
+
+        contacts = AddContactSet({'contacts-TOTAL_FORMS': 1, 'contacts-INITIAL_FORMS': 0,
+                                  'contacts-0-contact_number': '0456', 'contacts-0-email_address': 'OLD@EXAMPLE.COM'},
+                                 instance=Client.objects.create(forename="New", surname="Client"))
+        self.assertFalse(contacts.is_valid())
+
+        reg = CreateUserForm(data={'username': "old", 'email': "OLD@example.com",
+                                   'password1': "thisTest1!x", 'password2': "thisTest1!x"})
+        self.assertTrue(reg.is_valid(), reg.errors)
+
+class TestLessonSeries(TestCase):
+
+    def setUp(self):
+        self.term = Term.objects.create(term_name="Autumn", term_start_date="2021-09-01",
+                                        term_end_date="2021-12-17", half_term_start_date="2021-10-25",
+                                        half_term_end_date="2021-10-29")
+        self.product = Products.objects.create(product_name="Maths", price=20, effective_from_date="2021-01-01")
+        self.client_obj = Client.objects.create(forename="Parent", surname="Smith")
+        self.student = Student.objects.create(forename="Child", surname="Smith")
+        self.student.parent.add(self.client_obj)
+        user = User.objects.create_user(username="admin", password="thistest1")
+        user.groups.add(Group.objects.create(name="admin"))
+        self.client.force_login(user)
+
+    def addSeries(self, weekday=LessonSeries.MONDAY):
+        self.client.post(reverse('accounts:addseries', args=[self.student.pk]),
+                         {'student': self.student.pk, 'lesson_type': self.product.pk, 'term': self.term.pk,
+                          'weekday': weekday, 'start_time': '16:00', 'end_time': '17:00'})
+        return LessonSeries.objects.get(student=self.student)
+
+    # Is a lesson added every week of the term apart from half term?
+    def test_series_skips_half_term(self):
+        series = self.addSeries()
+        starts = [timezone.localtime(start) for start in
+                  series.lessons.order_by('lesson_start').values_list('lesson_start', flat=True)]
+        self.assertEqual(len(starts), 14)
+        self.assertEqual(starts[0].date().isoformat(), "2021-09-06")
+        self.assertEqual(starts[0].hour, 16)
+        self.assertNotIn("2021-10-25", [start.date().isoformat() for start in starts])
+        self.assertEqual(ClientBalance.objects.get(client=self.client_obj).uninvoiced_value, 280)
+
+    # Does an update move the lessons not invoiced yet and leave invoiced ones alone?
+    def test_update_keeps_invoiced(self):
+        series = self.addSeries()
+        first = series.lessons.order_by('lesson_start').first()
+        first.invoiced = True
+        first.save()
+
+        self.client.post(reverse('accounts:updateseries', args=[series.pk]),
+                         {'student': self.student.pk, 'lesson_type': self.product.pk, 'term': self.term.pk,
+                          'weekday': LessonSeries.TUESDAY, 'start_time': '16:00', 'end_time': '17:00'})
+
+        self.assertEqual(series.lessons.count(), 14)
+        self.assertTrue(Lesson.objects.filter(pk=first.pk, invoiced=True).exists())
+        moved = series.lessons.filter(invoiced=False).order_by('lesson_start').first()
+        self.assertEqual(timezone.localtime(moved.lesson_start).weekday(), LessonSeries.TUESDAY)
+        self.assertEqual(ClientBalance.objects.get(client=self.client_obj).uninvoiced_value, 260)
+
+    # Does cancelling remove the uninvoiced lessons but keep the invoiced ones?
+    def test_cancel_series(self):
+        series = self.addSeries()
+        Lesson.objects.filter(pk=series.lessons.first().pk).update(invoiced=True)
+
+        self.client.post(reverse('accounts:cancelseries', args=[series.pk]))
+
+        self.assertFalse(LessonSeries.objects.exists())
+        self.assertEqual(Lesson.objects.count(), 1)
+        self.assertEqual(ClientBalance.objects.get(client=self.client_obj).uninvoiced_value, 0)
+
+class TestLessonConflicts(TestCase):
+
+    def setUp(self):
+        self.term = Term.objects.create(term_name="Autumn", term_start_date="2021-09-01",
+                                        term_end_date="2021-12-17", half_term_start_date="2021-10-25",
+                                        half_term_end_date="2021-10-29")
+        self.product = Products.objects.create(product_name="Maths", price=20, effective_from_date="2021-01-01")
+        self.student = Student.objects.create(forename="Child", surname="Smith")
+        self.other = Student.objects.create(forename="Other", surname="Jones")
+        self.lesson = Lesson.objects.create(student=self.student, lesson_type=self.product, term=self.term,
+                                            lesson_start="2021-09-06T16:00:00+01:00",
+                                            lesson_end="2021-09-06T17:00:00+01:00")
+
+    def lessonForm(self, form_class, start, end, instance=None):
+        return form_class({'student': self.other.pk, 'lesson_type': self.product.pk, 'term': self.term.pk,
+                           'lesson_start': start, 'lesson_end': end, 'invoiced': False}, instance=instance)
+
+    # Is a lesson overlapping one already booked turned away, but one straight after allowed?
+    def test_lesson_forms(self):
+        self.assertFalse(self.lessonForm(AddLessonForm, "2021-09-06T16:30", "2021-09-06T17:30").is_valid())
+        self.assertTrue(self.lessonForm(AddLessonForm, "2021-09-06T17:00", "2021-09-06T18:00").is_valid())
+        # A lesson doesn't clash with itself when it is moved
+        self.assertTrue(self.lessonForm(UpdateLessonForm, "2021-09-06T16:30", "2021-09-06T17:30",
+                                        instance=self.lesson).is_valid())
+
+    # Are lessons running into another day, or a month later on the same day of the month, turned away?
+    def test_lesson_length(self):
+        for form_class in (AddLessonForm, UpdateLessonForm):
+            self.assertFalse(self.lessonForm(form_class, "2021-09-07T16:00", "2021-10-07T17:00").is_valid())
+            self.assertFalse(self.lessonForm(form_class, "2021-09-07T23:00", "2021-09-08T01:00").is_valid())
+            self.assertFalse(self.lessonForm(form_class, "2021-09-07T16:00", "2021-09-07T16:00").is_valid())
+            self.assertTrue(self.lessonForm(form_class, "2021-09-07T16:00", "2021-09-07T17:00").is_valid())
+
+    # Does the series form find the clash with the booked Monday lesson?
+    def test_series_form(self):
+        data = {'student': self.other.pk, 'lesson_type': self.product.pk, 'term': self.term.pk,
+                'start_time': '16:30', 'end_time': '17:30'}
+        self.assertFalse(LessonSeriesForm(dict(data, weekday=LessonSeries.MONDAY)).is_valid())
+        self.assertTrue(LessonSeriesForm(dict(data, weekday=LessonSeries.TUESDAY)).is_valid())
+
+    # Are clashes in the term found and marked for the same student or the tutor?
+    def test_term_conflicts(self):
+        from .conflicts import termConflicts
+        Lesson.objects.create(student=self.student, lesson_type=self.product, term=self.term,
+                              lesson_start="2021-09-06T16:15:00+01:00", lesson_end="2021-09-06T16:45:00+01:00")
+        Lesson.objects.create(student=self.other, lesson_type=self.product, term=self.term,
+                              lesson_start="2021-09-06T16:40:00+01:00", lesson_end="2021-09-06T18:00:00+01:00")
+        Lesson.objects.create(student=self.other, lesson_type=self.product, term=self.term,
+                              lesson_start="2021-09-06T18:00:00+01:00", lesson_end="2021-09-06T19:00:00+01:00")
+
+        conflicts = termConflicts(self.term)
+        self.assertEqual(sorted(conflict['kind'] for conflict in conflicts), ['student', 'tutor', 'tutor'])
+        output = StringIO()
+        call_command('lessonconflicts', 'Autumn', stdout=output)
+        self.assertIn('3 clashes in Autumn', output.getvalue())
+
+class TestAddressAsOf(TestCase):
+
+    def setUp(self):
+        self.clients = []
+        for i in range(3):
+            client = Client.objects.create(forename="Parent", surname="Smith")
+            Address.objects.create(client=client, line_one="Old", town="Town", postcode="AB1 1AA",
+                                   effective_from_date="2020-01-01", effective_to_date="2020-12-31")
+            Address.objects.create(client=client, line_one="New", town="Town", postcode="AB1 2BB",
+                                   effective_from_date="2021-01-01")
+            self.clients.append(client)
+        # Overlaps the open ended address for the first client
+        Address.objects.create(client=self.clients[0], line_one="Moved", town="Town", postcode="AB1 3CC",
+                               effective_from_date="2021-06-01")
+
+    # Are many client and date pairs resolved with one query, latest start winning on overlaps?
+    def test_batched_lookup(self):
+        from .addresses import clientAddresses
+        from .querycount import QueryRecorder
+        from datetime import date
+
+        pairs = [(client.pk, day) for client in self.clients
+                 for day in (date(2019, 6, 1), date(2020, 6, 1), date(2021, 3, 1), date(2021, 7, 1))]
+        with QueryRecorder() as recorder:
+            resolved = clientAddresses(pairs)
+
+        self.assertEqual(recorder.count, 1)
+        first = self.clients[0].pk
+        self.assertNotIn((first, date(2019, 6, 1)), resolved)
+        self.assertEqual(resolved[(first, date(2020, 6, 1))].line_one, "Old")
+        self.assertEqual(resolved[(first, date(2021, 3, 1))].line_one, "New")
+        self.assertEqual(resolved[(first, date(2021, 7, 1))].line_one, "Moved")
+        self.assertEqual(resolved[(self.clients[1].pk, date(2021, 7, 1))].line_one, "New")
+
+    # Does the invoice export carry the billing address from when the invoice was made?
+    def test_invoice_export(self):
+        from .exports import exportRows
+        invoice = Invoices.objects.create(invoice_number="SMI1", client=self.clients[1], total_amount=10,
+                                          amount_paid=0, amount_outstanding=10)
+        Invoices.objects.filter(pk=invoice.pk).update(date_created="2020-03-01T12:00:00Z")
+
+        rows = list(exportRows('invoices'))
+        self.assertEqual(rows[0]['billing_postcode'], "AB1 1AA")
+
+class TestPricing(TestCase):
+
+    def setUp(self):
+        term = Term.objects.create(term_name="Autumn", term_start_date="2020-09-01",
+                                   term_end_date="2021-12-17", half_term_start_date="2020-10-26",
+                                   half_term_end_date="2020-10-30")
+        self.old = Products.objects.create(product_name="Maths", price=20, effective_from_date="2020-01-01",
+                                           effective_to_date="2020-12-31")
+        self.new = Products.objects.create(product_name="Maths", price=25, effective_from_date="2021-01-01")
+        self.client_obj = Client.objects.create(forename="Parent", surname="Smith")
+        student = Student.objects.create(forename="Child", surname="Smith")
+        student.parent.add(self.client_obj)
+        for start in ("2020-11-02T16:00:00Z", "2021-02-01T16:00:00Z", "2021-02-08T16:00:00Z"):
+            Lesson.objects.create(student=student, lesson_type=self.new, term=term,
+                                  lesson_start=start, lesson_end=start.replace("T16", "T17"))
+
+    # Is each lesson charged the price in effect on its day, with one query for the batch?
+    def test_price_batch(self):
+        from .pricing import priceLessons
+        from .querycount import QueryRecorder
+        from . import refdata
+
+        lessons = list(Lesson.objects.order_by('lesson_start'))
+        # Saving the lessons priced them for the rollups, start again from a cold cache
+        refdata.invalidate()
+        with QueryRecorder() as recorder:
+            prices = priceLessons(lessons)
+            priceLessons(lessons)
+        self.assertEqual(prices, [20, 25, 25])
+        # The version stamps and the products, then nothing for the second batch
+        self.assertEqual(recorder.count, 2)
+
+    # Do batch invoices use the dated prices and pick up a price change straight away?
+    def test_invoice_prices(self):
+        from .invoicing import runInvoices
+        from .pricing import priceLessons
+        priceLessons(Lesson.objects.all())
+        self.new.price = 30
+        self.new.save()
+
+        runInvoices()
+
+        invoice = Invoices.objects.get(client=self.client_obj)
+        self.assertEqual(invoice.total_amount, 80)
+        self.assertEqual(sorted((line.unit_price, line.quantity) for line in invoice.lines.all()),
+                         [(20, 1), (30, 2)])
+
+    # Do the uninvoiced balance and the lesson export use the price on the day too?
+    def test_balance_and_export_prices(self):
+        from .balances import rebuildBalances
+        from .exports import exportRows
+        self.assertEqual(ClientBalance.objects.get(client=self.client_obj).uninvoiced_value, 70)
+        rebuildBalances([self.client_obj.pk])
+        self.assertEqual(ClientBalance.objects.get(client=self.client_obj).uninvoiced_value, 70)
+        self.assertEqual([row['price'] for row in exportRows('lessons')], [20, 25, 25])
+
+        Lesson.objects.order_by('lesson_start').first().delete()
+        self.assertEqual(ClientBalance.objects.get(client=self.client_obj).uninvoiced_value, 50)
+
+class TestReferenceData(TestCase):
+
+    def setUp(self):
+        self.product = Products.objects.create(product_name="Maths", price=20, effective_from_date="2021-01-01")
+        self.term = Term.objects.create(term_name="Autumn", term_start_date="2021-09-01",
+                                        term_end_date="2021-12-17", half_term_start_date="2021-10-25",
+                                        half_term_end_date="2021-10-29")
+
+    # Are the lesson form drop downs served from memory once the cache is warm?
+    def test_form_choices_cached(self):
+        from .querycount import QueryRecorder
+        str(AddLessonForm())
+        with QueryRecorder() as recorder:
+            html = str(AddLessonForm())
+        self.assertEqual(recorder.count, 0)
+        self.assertIn("Maths", html)
+        self.assertIn("Autumn", html)
+
+    # Is a change made by another process picked up at the start of the next request?
+    def test_version_stamp(self):
+        from django.core.signals import request_started
+        from django.db.models import F
+        from . import refdata
+        self.assertEqual(refdata.productMap()[self.product.pk].price, 20)
+
+        # No signals from a queryset update, as if another worker had made the change
+        Products.objects.filter(pk=self.product.pk).update(price=30)
+        ReferenceVersion.objects.filter(name='products').update(version=F('version') + 1)
+        self.assertEqual(refdata.productMap()[self.product.pk].price, 20)
+
+        request_started.send(sender=None)
+        self.assertEqual(refdata.productMap()[self.product.pk].price, 30)
+        self.assertEqual(refdata.termMap()[self.term.pk].term_name, "Autumn")
+
+class TestInvoiceClaims(TestCase):
+
+    def setUp(self):
+        self.term = Term.objects.create(term_name="Autumn", term_start_date="2021-09-01",
+                                        term_end_date="2021-12-17", half_term_start_date="2021-10-25",
+                                        half_term_end_date="2021-10-29")
+        self.product = Products.objects.create(product_name="Maths", price=20, effective_from_date="2021-01-01")
+        self.client_obj = Client.objects.create(forename="Parent", surname="Smith")
+        self.student = Student.objects.create(forename="Child", surname="Smith")
+        self.student.parent.add(self.client_obj)
+        for day in range(1, 3):
+            self.addLesson(day)
+        user = User.objects.create_user(username="admin", password="thistest1")
+        user.groups.add(Group.objects.create(name="admin"))
+        self.client.force_login(user)
+        self.url = reverse('accounts:accountsdetailed', args=[self.client_obj.pk])
+
+    def addLesson(self, day):
+        return Lesson.objects.create(student=self.student, lesson_type=self.product, term=self.term,
+                                     lesson_start="2021-09-0%dT16:00:00Z" % day,
+                                     lesson_end="2021-09-0%dT17:00:00Z" % day)
+
+    # Form as shown on the preview page, ready to post back
+    def preview(self):
+        form = self.client.get(self.url).context['create_invoice']
+        return {name: form.initial.get(name, field.initial) for name, field in form.fields.items()}
+
+    # Does a lesson added after the preview stay off the invoice?
+    def test_claims_previewed_lessons(self):
+        data = self.preview()
+        late = self.addLesson(3)
+        self.client.post(self.url, data)
+
+        invoice = Invoices.objects.get()
+        self.assertEqual(invoice.invoice_no.count(), 2)
+        self.assertFalse(Lesson.objects.get(pk=late.pk).invoiced)
+        self.assertEqual(ClientBalance.objects.get(client=self.client_obj).uninvoiced_value, 20)
+
+    # Does posting the same preview twice only make one invoice?
+    def test_double_submit(self):
+        data = self.preview()
+        self.client.post(self.url, data)
+        self.addLesson(3)
+        self.client.post(self.url, data)
+        self.assertEqual(Invoices.objects.count(), 1)
+
+    # Are the totals worked out from the lines rather than taken from the posted form?
+    def test_total_from_lines(self):
+        data = self.preview()
+        data.update(total_amount=999, amount_outstanding=999)
+        self.client.post(self.url, data)
+
+        invoice = Invoices.objects.get()
+        self.assertEqual((invoice.total_amount, invoice.amount_outstanding), (40, 40))
+        self.assertEqual(invoice.lines.aggregate(total=Sum('line_total'))['total'], 40)
+        self.assertEqual(ClientBalance.objects.get(client=self.client_obj).total_invoiced, 40)
+
+    # Is nothing invoiced if a lesson was changed after the preview?
+    def test_changed_lesson(self):
+        data = self.preview()
+        Lesson.objects.filter(lesson_start__day=1).update(lesson_start="2021-09-01T15:00:00Z")
+        response = self.client.post(self.url, data, follow=True)
+        self.assertEqual(Invoices.objects.count(), 0)
+        self.assertEqual(Lesson.objects.filter(invoiced=True).count(), 0)
+        self.assertContains(response, "changed since they were shown")
+
+class TestJobQueue(TestCase):
+
+    def setUp(self):
+        term = Term.objects.create(term_name="Autumn", term_start_date="2021-09-01",
+                                   term_end_date="2021-12-17", half_term_start_date="2021-10-25",
+                                   half_term_end_date="2021-10-29")
+        product = Products.objects.create(product_name="Maths", price=20, effective_from_date="2021-01-01")
+        client = Client.objects.create(forename="Parent", surname="Smith")
+        student = Student.objects.create(forename="Child", surname="Smith")
+        student.parent.add(client)
+        Lesson.objects.create(student=student, lesson_type=product, term=term,
+                              lesson_start="2021-09-01T16:00:00Z", lesson_end="2021-09-01T17:00:00Z")
+
+    # Does a queued job get run by the worker with its result and timings saved?
+    def test_run_job(self):
+        from .jobs import enqueue, work
+        job = enqueue('invoices')
+        self.assertEqual(work(once=True), 1)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(job.result[0]['invoices'], 1)
+        self.assertIsNotNone(job.run_seconds)
+        self.assertEqual(Invoices.objects.count(), 1)
+
+    # Is a failing job retried after a back off and then marked failed?
+    def test_retries(self):
+        from .jobs import TASKS, enqueue, work
+
+        def broken():
+            raise ValueError('broken')
+        TASKS['broken'] = broken
+        self.addCleanup(TASKS.pop, 'broken')
+
+        job = enqueue('broken', max_attempts=2)
+        work(once=True)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIn('broken', job.error)
+
+        # Nothing is due until the back off is over
+        self.assertEqual(work(once=True), 0)
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        work(once=True)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+
+    # Can only one worker claim a job?
+    def test_single_claim(self):
+        from .jobs import claimJob, enqueue
+        enqueue('invoices')
+        self.assertIsNotNone(claimJob('first'))
+        self.assertIsNone(claimJob('second'))
+
+    # Is a job that stopped sending heartbeats queued again, or failed once out of attempts,
+    # while a long job that is still sending them is left running?
+    def test_stale_jobs(self):
+        from .jobs import claimJob, enqueue, heartbeat, requeueStale
+        lost, last_try, alive = enqueue('invoices'), enqueue('invoices', max_attempts=1), enqueue('invoices')
+        for worker in ('first', 'second', 'third'):
+            claimJob(worker)
+        long_ago = timezone.now() - timedelta(hours=2)
+        Job.objects.update(started_at=long_ago, heartbeat_at=long_ago)
+        alive = Job.objects.get(pk=alive.pk)
+        self.assertEqual(heartbeat(alive), 1)
+        self.assertEqual(heartbeat(Job(pk=alive.pk, worker='first', attempts=alive.attempts)), 0)
+
+        self.assertEqual(requeueStale(), (1, 1))
+        self.assertEqual([Job.objects.get(pk=job.pk).status for job in (lost, last_try, alive)],
+                         [Job.QUEUED, Job.FAILED, Job.RUNNING])
+
+    # Does a worker that lost its job leave alone the run of the worker that took it over?
+    def test_lost_claim(self):
+        from .jobs import claimJob, enqueue, requeueStale, runJob
+        enqueue('invoices')
+        slow = claimJob('slow')
+        Job.objects.update(heartbeat_at=timezone.now() - timedelta(hours=2))
+        requeueStale()
+        claimJob('other')
+
+        self.assertFalse(runJob(slow))
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.worker), (Job.RUNNING, 'other'))
+
+    # Is an invoices job asking for a pool of workers failed rather than starting one?
+    def test_invoices_job_workers(self):
+        from .jobs import enqueue, work
+        job = enqueue('invoices', max_attempts=1, workers=4)
+        work(once=True)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn('one worker', job.error)
+
+    # Does the worker loop put back a job that lost its worker and then run it?
+    def test_worker_requeues(self):
+        from .jobs import claimJob, enqueue, work
+        job = enqueue('invoices')
+        claimJob('gone')
+        Job.objects.update(heartbeat_at=timezone.now() - timedelta(hours=2))
+
+        self.assertEqual(work(once=True), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DONE, 2))
+
+    # Does the jobs page queue a job rather than running it in the request?
+    def test_queue_from_page(self):
+        user = User.objects.create_user(username="admin", password="thistest1")
+        user.groups.add(Group.objects.create(name="admin"))
+        self.client.force_login(user)
+
+        response = self.client.post(reverse('accounts:queuejob', args=['invoices']), follow=True)
+        self.assertContains(response, 'Queued')
+        self.assertEqual(Job.objects.get().status, Job.QUEUED)
+        self.assertEqual(Invoices.objects.count(), 0)
+        self.assertContains(self.client.get(reverse('accounts:jobs')), 'invoices')
+
+class TestPaymentReconciliation(TestCase):
+
+    def setUp(self):
+        self.smith = Client.objects.create(forename="John", surname="Smith")
+        self.jones = Client.objects.create(forename="Anna", surname="Jones")
+        self.other_smith = Client.objects.create(forename="Mary", surname="Smith")
+        self.invoices = {}
+        for number, client, total in (('SMI-2026-000001', self.smith, 40), ('JON-2026-000002', self.jones, 60),
+                                      ('SMI-2026-000003', self.other_smith, 60)):
+            self.invoices[number] = Invoices.objects.create(invoice_number=number, client=client, status=Invoices.ISSUED,
+                                                            total_amount=total, amount_paid=0,
+                                                            amount_outstanding=total)
+
+    def statement(self, *lines):
+        return StringIO('Date,Amount,Reference,Name\n' + '\n'.join(lines) + '\n')
+
+    def invoice(self, number):
+        return Invoices.objects.get(invoice_number=number)
+
+    # Are payments quoting the invoice number recorded with the status the form would need?
+    def test_match_by_invoice_number(self):
+        from .reconcile import reconcileStatement
+        result = reconcileStatement(self.statement('01/10/2026,25.00,SMI2026000001,J SMITH',
+                                                   '02/10/2026,15.00,Inv SMI-2026-000001,J SMITH',
+                                                   '2026-10-03,20.00,JON-2026-000002,A JONES'))
+        self.assertEqual(len(result.matched), 3)
+        self.assertEqual(result.applied, 60)
+
+        paid = self.invoice('SMI-2026-000001')
+        self.assertEqual((paid.status, paid.amount_paid, paid.amount_outstanding), (Invoices.PAID, 40, 0))
+        part = self.invoice('JON-2026-000002')
+        self.assertEqual((part.status, part.amount_outstanding), (Invoices.PART_PAID, 40))
+        self.assertEqual(Payment.objects.count(), 3)
+        self.assertEqual(ClientBalance.objects.get(client=self.jones).total_outstanding, 40)
+
+    # Without a reference is the amount and name used, and ambiguous names reported?
+    def test_match_by_amount_and_name(self):
+        from .reconcile import reconcileStatement
+        Invoices.objects.create(invoice_number='SMI-2026-000004', client=self.smith, status=Invoices.ISSUED,
+                                total_amount=60, amount_paid=0, amount_outstanding=60)
+        result = reconcileStatement(self.statement('01/10/2026,60.00,TUITION,MRS A JONES',
+                                                   '01/10/2026,60.00,TUITION,SMITH',
+                                                   '01/10/2026,60.00,TUITION,M SMITH'),
+                                    apply=False)
+        self.assertEqual([line['result'] for line in result.lines], ['matched', 'ambiguous', 'matched'])
+        self.assertEqual(result.lines[0]['invoice'], self.invoices['JON-2026-000002'].pk)
+        self.assertEqual(result.lines[2]['invoice'], self.invoices['SMI-2026-000003'].pk)
+        self.assertEqual(Payment.objects.count(), 0)
+
+    # Are overpayments, unknown payments and money going out left alone?
+    def test_unmatched_lines(self):
+        from .reconcile import reconcileStatement
+        result = reconcileStatement(self.statement('01/10/2026,50.00,SMI-2026-000001,J SMITH',
+                                                   '01/10/2026,12.34,GIFT,NOBODY',
+                                                   '01/10/2026,-30.00,RENT,LANDLORD',
+                                                   'yesterday,10.00,SMI-2026-000001,J SMITH'))
+        self.assertEqual([line['result'] for line in result.lines], ['ambiguous', 'unmatched', 'unmatched'])
+        self.assertEqual(result.ignored, 1)
+        self.assertEqual(self.invoice('SMI-2026-000001').amount_paid, 0)
+
+    # Does uploading the same statement again leave the invoices as they were?
+    def test_statement_read_twice(self):
+        from .reconcile import reconcileStatement
+        lines = ('01/10/2026,10.00,SMI-2026-000001,J SMITH', '01/10/2026,10.00,SMI-2026-000001,J SMITH')
+        reconcileStatement(self.statement(*lines))
+        result = reconcileStatement(self.statement(*lines))
+        self.assertEqual(len(result.duplicates), 2)
+        self.assertEqual(self.invoice('SMI-2026-000001').amount_paid, 20)
+
+    # Can a statement be uploaded from the invoices page?
+    def test_upload(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        user = User.objects.create_user(username="admin", password="thistest1")
+        user.groups.add(Group.objects.create(name="admin"))
+        self.client.force_login(user)
+
+        upload = SimpleUploadedFile('statement.csv', self.statement('01/10/2026,40.00,SMI-2026-000001,J SMITH',
+                                                                    '01/10/2026,1.00,?,?').getvalue().encode())
+        response = self.client.post(reverse('accounts:reconcile'), {'statement': upload})
+        self.assertContains(response, 'Matched: 1')
+        self.assertContains(response, 'No open invoice')
+        self.assertEqual(self.invoice('SMI-2026-000001').status, Invoices.PAID)
+
+class TestAgedDebt(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.smith = Client.objects.create(forename="John", surname="Smith")
+        self.jones = Client.objects.create(forename="Anna", surname="Jones")
+        Client.objects.create(forename="Paid", surname="Up")
+        for number, (client, days, outstanding, status) in enumerate(((self.smith, 0, 10, Invoices.ISSUED),
+                                                                      (self.smith, 30, 20, Invoices.PART_PAID),
+                                                                      (self.smith, 31, 40, Invoices.ISSUED),
+                                                                      (self.jones, 75, 80, Invoices.UNPAID),
+                                                                      (self.jones, 120, 160, Invoices.ISSUED),
+                                                                      (self.jones, 200, 0, Invoices.PAID))):
+            invoice = Invoices.objects.create(invoice_number='INV%d' % number, client=client, status=status,
+                                              total_amount=200, amount_paid=200 - outstanding,
+                                              amount_outstanding=outstanding)
+            Invoices.objects.filter(pk=invoice.pk).update(date_created=self.now - timedelta(days=days))
+
+    # Are the outstanding amounts put in the right age bucket in one query?
+    def test_totals(self):
+        from .ageddebt import agedDebtTotals
+        with self.assertNumQueries(1):
+            totals = agedDebtTotals(self.now)
+        self.assertEqual([totals[name] for name in ('days_0_30', 'days_31_60', 'days_61_90', 'days_over_90', 'total')],
+                         [30, 40, 80, 160, 310])
+
+    # Is each client owing money listed with their own buckets?
+    def test_clients(self):
+        from .ageddebt import clientAgedDebt
+        with self.assertNumQueries(1):
+            clients = {client['client']: client for client in clientAgedDebt(self.now)}
+        self.assertEqual(set(clients), {self.smith.pk, self.jones.pk})
+        self.assertEqual((clients[self.smith.pk]['days_0_30'], clients[self.smith.pk]['days_31_60']), (30, 40))
+        self.assertEqual((clients[self.jones.pk]['days_61_90'], clients[self.jones.pk]['total']), (80, 240))
+
+    # Does the page for an earlier day show the snapshot even after invoices are paid?
+    def test_snapshot(self):
+        from .ageddebt import takeSnapshot
+        takeSnapshot(self.now)
+        takeSnapshot(self.now)
+        self.assertEqual(AgedDebtSnapshot.objects.count(), 3)
+        self.assertEqual(AgedDebtSnapshot.objects.get(client=None).total, 310)
+
+        yesterday = timezone.localdate(self.now) - timedelta(days=1)
+        AgedDebtSnapshot.objects.update(date=yesterday)
+        Invoices.objects.update(amount_outstanding=0, status=Invoices.PAID)
+
+        user = User.objects.create_user(username="admin", password="thistest1")
+        user.groups.add(Group.objects.create(name="admin"))
+        self.client.force_login(user)
+        response = self.client.get(reverse('accounts:ageddebt'), {'date': yesterday.isoformat()})
+        self.assertEqual(response.context['totals'].total, 310)
+        self.assertEqual(len(response.context['clients']), 2)
+        self.assertEqual(self.client.get(reverse('accounts:ageddebt')).context['totals']['total'], 0)
+
+class TestRevenueRollups(TestCase):
+
+    def setUp(self):
+        self.term = Term.objects.create(term_name="Autumn", term_start_date="2021-09-01",
+                                        term_end_date="2021-12-17", half_term_start_date="2021-10-25",
+                                        half_term_end_date="2021-10-29")
+        self.maths = Products.objects.create(product_name="Maths", price=20, effective_from_date="2021-01-01")
+        self.english = Products.objects.create(product_name="English", price=30, effective_from_date="2021-01-01")
+        self.client_obj = Client.objects.create(forename="Parent", surname="Smith")
+        self.student = Student.objects.create(forename="Child", surname="Smith")
+        self.student.parent.add(self.client_obj)
+        self.lessons = [Lesson.objects.create(student=self.student, lesson_type=self.maths, term=self.term,
+                                              lesson_start=start, lesson_end=start.replace("T16", "T17"))
+                        for start in ("2021-09-06T16:00:00Z", "2021-09-13T16:00:00Z", "2021-10-04T16:00:00Z")]
+
+    def rollups(self):
+        return sorted(RevenueRollup.objects.filter(lesson_count__gt=0)
+                                           .values_list('term', 'product', 'month', 'lesson_count',
+                                                        'invoiced_value', 'uninvoiced_value'))
+
+    # Is the old row read once for both the balances and the rollups when a lesson is saved?
+    def test_one_snapshot(self):
+        from .querycount import QueryRecorder
+        lesson = self.lessons[0]
+        lesson.lesson_type = self.english
+        with QueryRecorder() as recorder:
+            lesson.save()
+        self.assertEqual(len([query for query in recorder.queries if query['sql'].startswith('SELECT')
+                              and 'FROM "accounts_lesson" WHERE "accounts_lesson"."id"' in query['sql']]), 1)
+        self.assertEqual(ClientBalance.objects.get(client=self.client_obj).uninvoiced_value, 70)
+
+    # Are the rollups kept the same as a rebuild as lessons are changed, deleted and invoiced?
+    def test_matches_rebuild(self):
+        from .invoicing import runInvoices
+        from .rollups import rebuildRollups
+        self.assertEqual(self.rollups(), [(self.term.pk, self.maths.pk, date(2021, 9, 1), 2, 0, 40),
+                                          (self.term.pk, self.maths.pk, date(2021, 10, 1), 1, 0, 20)])
+
+        moved = self.lessons[0]
+        moved.lesson_type = self.english
+        moved.lesson_start = timezone.make_aware(datetime(2021, 10, 11, 16))
+        moved.lesson_end = timezone.make_aware(datetime(2021, 10, 11, 17))
+        moved.save()
+        self.lessons[1].delete()
+        runInvoices()
+        Lesson.objects.create(student=self.student, lesson_type=self.maths, term=self.term,
+                              lesson_start="2021-11-01T16:00:00Z", lesson_end="2021-11-01T17:00:00Z")
+
+        incremental = self.rollups()
+        self.assertEqual(incremental, [(self.term.pk, self.maths.pk, date(2021, 10, 1), 1, 20, 0),
+                                       (self.term.pk, self.maths.pk, date(2021, 11, 1), 1, 0, 20),
+                                       (self.term.pk, self.english.pk, date(2021, 10, 1), 1, 30, 0)])
+        rebuildRollups()
+        self.assertEqual(self.rollups(), incremental)
+
+    # Do bulk series changes update the rollups?
+    def test_series(self):
+        from .series import createSeries, cancelSeries
+        series = LessonSeries(student=self.student, lesson_type=self.english, term=Term.objects.get(pk=self.term.pk),
+                              weekday=LessonSeries.MONDAY, start_time=time(16), end_time=time(17))
+        created = createSeries(series)
+        self.assertEqual(RevenueRollup.objects.filter(product=self.english)
+                                              .aggregate(lessons=Sum('lesson_count'))['lessons'], created)
+        cancelSeries(series)
+        self.assertEqual(RevenueRollup.objects.filter(product=self.english)
+                                              .aggregate(lessons=Sum('lesson_count'))['lessons'], 0)
+
+    # Does the revenue page add the rollups up by product without reading the lessons?
+    def test_report(self):
+        from .querycount import QueryRecorder
+        user = User.objects.create_user(username="admin", password="thistest1")
+        user.groups.add(Group.objects.create(name="admin"))
+        self.client.force_login(user)
+
+        with QueryRecorder() as recorder:
+            response = self.client.get(reverse('accounts:revenue'), {'term': self.term.pk, 'group': 'product'})
+        self.assertEqual(response.context['rows'], [{'label': 'Maths', 'lessons': 3, 'invoiced': 0,
+                                                     'uninvoiced': 60, 'total': 60}])
+        self.assertFalse([query for query in recorder.queries if 'accounts_lesson' in query['sql']])
+
+class TestCalendarFeeds(TestCase):
+
+    def setUp(self):
+        self.term = Term.objects.create(term_name="Autumn", term_start_date="2026-09-01",
+                                        term_end_date="2026-12-17", half_term_start_date="2026-10-26",
+                                        half_term_end_date="2026-10-30")
+        self.product = Products.objects.create(product_name="Maths, GCSE", price=20, effective_from_date="2021-01-01")
+        self.client_obj = Client.objects.create(forename="Parent", surname="Smith")
+        self.students = []
+        for forename in ("Amy", "Ben"):
+            student = Student.objects.create(forename=forename, surname="Smith")
+            student.parent.add(self.client_obj)
+            TuitionAddress.objects.create(student=student, line_one="1 Long Street Name", town="Town",
+                                          postcode="AB1 2CD", effective_from_date="2020-01-01")
+            self.students.append(student)
+        self.lesson = Lesson.objects.create(student=self.students[0], lesson_type=self.product, term=self.term,
+                                            lesson_start=timezone.now() + timedelta(days=2),
+                                            lesson_end=timezone.now() + timedelta(days=2, hours=1))
+        Lesson.objects.create(student=self.students[1], lesson_type=self.product, term=self.term,
+                              lesson_start=timezone.now() + timedelta(days=3),
+                              lesson_end=timezone.now() + timedelta(days=3, hours=1))
+        # Too long ago to be in the feed
+        Lesson.objects.create(student=self.students[0], lesson_type=self.product, term=self.term,
+                              lesson_start=timezone.now() - timedelta(days=400),
+                              lesson_end=timezone.now() - timedelta(days=400, hours=-1))
+
+    def feed(self, kind, owner, **headers):
+        return self.client.get(reverse('accounts:calendarfeed', args=[feedToken(kind, owner)]), **headers)
+
+    # Does the student feed have just their lessons with the tuition address, escaped for iCalendar?
+    def test_student_feed(self):
+        response = self.feed(STUDENT, self.students[0])
+        body = response.content.decode()
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        self.assertTrue(body.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertEqual(body.count('BEGIN:VEVENT'), 1)
+        self.assertIn('UID:lesson-%d@bespoke-tuition' % self.lesson.pk, body)
+        self.assertIn('SUMMARY:Maths\\, GCSE - Amy Smith', body)
+        self.assertIn('LOCATION:1 Long Street Name\\, Town\\, AB1 2CD', body)
+        self.assertTrue(all(len(line.encode()) <= 75 for line in body.split('\r\n')))
+
+    # Is a student with no surname named by their forename?
+    def test_no_surname(self):
+        Student.objects.filter(pk=self.students[0].pk).update(surname=None)
+        response = self.feed(STUDENT, self.students[0])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('X-WR-CALNAME:Amy lessons', response.content.decode())
+
+    # Does the family feed have every child's lessons?
+    def test_client_feed(self):
+        body = self.feed(CLIENT, self.client_obj).content.decode()
+        self.assertEqual(body.count('BEGIN:VEVENT'), 2)
+        self.assertIn('Ben Smith', body)
+
+    # Is a 304 sent while nothing has changed, and the new feed once a lesson does?
+    def test_conditional_get(self):
+        from .querycount import QueryRecorder
+        first = self.feed(STUDENT, self.students[0])
+        self.assertFalse(first.has_header('Last-Modified'))
+
+        with QueryRecorder() as recorder:
+            again = self.feed(STUDENT, self.students[0], HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertFalse([query for query in recorder.queries
+                          if 'accounts_lesson' in query['sql'] and 'COUNT' not in query['sql']])
+
+        self.lesson.lesson_end += timedelta(minutes=30)
+        self.lesson.save()
+        changed = self.feed(STUDENT, self.students[0], HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+
+        self.lesson.delete()
+        self.assertNotEqual(self.feed(STUDENT, self.students[0])['ETag'], changed['ETag'])
+
+    # Does a renamed student give a new feed to an app that sends If-Modified-Since?
+    def test_renamed_student(self):
+        from django.utils.http import http_date
+        self.feed(STUDENT, self.students[0])
+        Student.objects.filter(pk=self.students[0].pk).update(forename="Anna")
+        again = self.feed(STUDENT, self.students[0], HTTP_IF_MODIFIED_SINCE=http_date())
+        self.assertEqual(again.status_code, 200)
+        self.assertIn('Anna Smith', again.content.decode())
+
+    # Do old links stop working once the family is given a new calendar key?
+    def test_revoked_feed(self):
+        old_client, old_student = Client.objects.get(pk=self.client_obj.pk), Student.objects.get(pk=self.students[0].pk)
+        call_command('revokecalendar', 'client', str(self.client_obj.pk), stdout=StringIO())
+        call_command('revokecalendar', 'student', str(self.students[0].pk), stdout=StringIO())
+        self.assertEqual(self.feed(CLIENT, old_client).status_code, 404)
+        self.assertEqual(self.feed(STUDENT, old_student).status_code, 404)
+        self.assertEqual(self.feed(CLIENT, Client.objects.get(pk=self.client_obj.pk)).status_code, 200)
+        self.assertEqual(self.feed(STUDENT, Student.objects.get(pk=self.students[0].pk)).status_code, 200)
+
+    # Are made up tokens turned away?
+    def test_bad_token(self):
+        self.assertEqual(self.client.get(reverse('accounts:calendarfeed', args=['student:1'])).status_code, 404)
+        self.assertEqual(self.feed(STUDENT, Student(pk=9999)).status_code, 404)
+
+class TestTimetable(TestCase):
+
+    def setUp(self):
+        from . import refdata
+        refdata.invalidate()
+        self.autumn = Term.objects.create(term_name="Autumn", term_start_date="2021-09-01",
+                                          term_end_date="2021-12-17", half_term_start_date="2021-10-25",
+                                          half_term_end_date="2021-10-29")
+        self.spring = Term.objects.create(term_name="Spring", term_start_date="2022-01-04",
+                                          term_end_date="2022-03-31", half_term_start_date="2022-02-14",
+                                          half_term_end_date="2022-02-18")
+        self.product = Products.objects.create(product_name="Maths", price=20, effective_from_date="2021-01-01")
+        self.students = []
+        for forename in ("Amy", "Ben", "Cat"):
+            student = Student.objects.create(forename=forename, surname="Smith")
+            TuitionAddress.objects.create(student=student, line_one="1 High Street", town="Town",
+                                          postcode="AB1 2CD", effective_from_date="2020-01-01")
+            self.students.append(student)
+        # Monday 13 September 2021 and the days either side of that week
+        for student, start in zip(self.students, ("2021-09-12T15:00:00Z", "2021-09-13T15:00:00Z",
+                                                  "2021-09-20T15:00:00Z")):
+            Lesson.objects.create(student=student, lesson_type=self.product, term=self.autumn,
+                                  lesson_start=start, lesson_end=start.replace("T15", "T16"))
+        Lesson.objects.create(student=self.students[2], lesson_type=self.product, term=self.autumn,
+                              lesson_start="2021-09-17T15:00:00Z", lesson_end="2021-09-17T16:00:00Z")
+
+        user = User.objects.create_user(username="admin", password="thistest1")
+        user.groups.add(Group.objects.create(name="admin"))
+        self.client.force_login(user)
+
+    # Does the week have just its own lessons, with the product, term and address?
+    def test_week(self):
+        response = self.client.get(reverse('accounts:timetable'), {'view': 'week', 'date': '2021-09-15'})
+        window = response.context['window']
+        self.assertEqual((window['first'], window['last']), (date(2021, 9, 13), date(2021, 9, 19)))
+        self.assertEqual(len(window['days']), 7)
+        lessons = [lesson for day in window['days'] for lesson in day['lessons']]
+        self.assertEqual([lesson['student'] for lesson in lessons], ["Ben Smith", "Cat Smith"])
+        self.assertEqual((lessons[0]['start'], lessons[0]['product'], lessons[0]['term'], lessons[0]['address']),
+                         ("16:00", "Maths", "Autumn", "1 High Street, Town, AB1 2CD"))
+
+    # Is a student with no surname shown by their forename on the page and in the data?
+    def test_no_surname(self):
+        Student.objects.filter(pk=self.students[1].pk).update(surname=None)
+        params = {'view': 'week', 'date': '2021-09-15'}
+        window = self.client.get(reverse('accounts:timetable'), params).context['window']
+        self.assertEqual([lesson['student'] for day in window['days'] for lesson in day['lessons']],
+                         ["Ben", "Cat Smith"])
+        self.assertEqual(self.client.get(reverse('accounts:timetabledata'), params).status_code, 200)
+
+    # Does a term view find the term for the day and link to the terms either side?
+    def test_term(self):
+        from .timetable import window
+        current = window('term', date(2021, 10, 1))
+        self.assertEqual((current['label'], current['previous'], current['next']),
+                         ("Autumn", None, date(2022, 1, 4)))
+        self.assertEqual(window('term', date(2021, 12, 25))['label'], "Spring")
+        self.assertEqual(window('day', date(2021, 9, 13))['next'], date(2021, 9, 14))
+
+    # Are the weeks either side sent with adjacent, read in the same number of queries
+    # whatever the number of students?
+    def test_adjacent_data(self):
+        from .querycount import QueryRecorder
+        url = reverse('accounts:timetabledata')
+        self.client.get(url)
+        with QueryRecorder() as recorder:
+            data = self.client.get(url, {'view': 'week', 'date': '2021-09-13', 'adjacent': '1'}).json()
+        self.assertEqual([shown['first'] for shown in data['windows']], ['2021-09-06', '2021-09-13', '2021-09-20'])
+        self.assertEqual([sum(len(day['lessons']) for day in shown['days']) for shown in data['windows']], [1, 2, 1])
+        self.assertEqual(len([query for query in recorder.queries if 'accounts_lesson' in query['sql']]), 1)
+
+        for forename in ("Dan", "Eve"):
+            student = Student.objects.create(forename=forename, surname="Jones")
+            Lesson.objects.create(student=student, lesson_type=self.product, term=self.autumn,
+                                  lesson_start="2021-09-14T15:00:00Z", lesson_end="2021-09-14T16:00:00Z")
+        with QueryRecorder() as more:
+            self.client.get(url, {'view': 'week', 'date': '2021-09-13', 'adjacent': '1'})
+        self.assertEqual(len(more.queries), len(recorder.queries))
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        import tempfile
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name + '/metrics.sqlite3'
+        override = self.settings(METRICS_FILE=self.path, METRICS_TOKEN="scrape-token")
+        override.enable()
+        self.addCleanup(override.disable)
+        # A new client so the middleware is loaded with the settings above
+        self.client = self.client_class()
+
+        self.user = User.objects.create_user(username="admin", password="thistest1")
+        self.user.groups.add(Group.objects.create(name="admin"))
+
+    def scrape(self):
+        return self.client.get(reverse('accounts:metrics'), HTTP_AUTHORIZATION="Bearer scrape-token")
+
+    # Are requests counted against their url name with the histogram and database totals?
+    def test_records_views(self):
+        self.client.force_login(self.user)
+        for i in range(3):
+            self.client.get(reverse('accounts:allclients'))
+        self.client.get('/no/such/page')
+        self.client.logout()
+
+        body = self.scrape().content.decode()
+        self.assertIn('bespoke_requests_total{view="accounts:allclients"} 3', body)
+        self.assertIn('bespoke_request_duration_seconds_bucket{view="accounts:allclients",le="+Inf"} 3', body)
+        self.assertIn('bespoke_request_duration_seconds_count{view="accounts:allclients"} 3', body)
+        self.assertIn('bespoke_requests_total{view="unresolved"} 1', body)
+        queries = [line for line in body.splitlines() if line.startswith('bespoke_db_queries_total{view="accounts:allclients"}')]
+        self.assertGreater(int(queries[0].split()[-1]), 0)
+
+    # Do two worker processes sharing the file add to each other's totals?
+    def test_shared_between_processes(self):
+        from .metrics import MetricsStore
+        first, second = MetricsStore(self.path), MetricsStore(self.path)
+        first.record('accounts:invoices', 0.02, 3, 0.001)
+        second.record('accounts:invoices', 2.0, 5, 0.5)
+        first.flush()
+        views = {row[0]: row for row in second.read()}
+        view, requests, duration, queries, db_time, buckets = views['accounts:invoices']
+        self.assertEqual((requests, queries), (2, 8))
+        self.assertAlmostEqual(duration, 2.02)
+        self.assertEqual(sum(buckets), 2)
+
+    # Do pages still work while another process holds the file, with the counts kept
+    # until it can be written?
+    def test_file_locked(self):
+        import sqlite3
+        from .metrics import metricsStore
+        metricsStore().flush()
+        holder = sqlite3.connect(self.path, isolation_level=None)
+        holder.execute('BEGIN IMMEDIATE')
+        try:
+            self.assertEqual(self.client.get(reverse('accounts:login')).status_code, 200)
+            self.assertFalse(metricsStore().flush())
+        finally:
+            holder.execute('ROLLBACK')
+            holder.close()
+        self.assertTrue(metricsStore().flush())
+        self.assertIn('bespoke_requests_total{view="accounts:login"} 1', self.scrape().content.decode())
+
+    # Does an idle worker's count reach the file without another request?
+    def test_flushed_on_timer(self):
+        from time import monotonic, sleep
+        from .metrics import MetricsStore
+        worker = MetricsStore(self.path, flush_seconds=0.05)
+        worker.record('accounts:invoices', 0.02, 3, 0.001)
+        deadline = monotonic() + 5
+        rows = []
+        while not rows and monotonic() < deadline:
+            sleep(0.05)
+            rows = MetricsStore(self.path).read()
+        self.assertEqual([row[:2] for row in rows], [('accounts:invoices', 1)])
+
+    # Is the page only shown to scrapers with the token and admin users?
+    def test_protected(self):
+        self.assertEqual(self.client.get(reverse('accounts:metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('accounts:metrics'), HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        self.assertEqual(self.scrape().status_code, 200)
+        self.assertTrue(self.scrape()['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('accounts:metrics')).status_code, 200)
+
+class TestSlowQueries(TestCase):
+
+    def setUp(self):
+        import tempfile
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name + '/slowqueries.log'
+        # Every query counts as slow so the pages below log something
+        override = self.settings(SLOW_QUERY_LOG=self.path, SLOW_QUERY_SECONDS=0)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.client = self.client_class()
+        # Forget the shapes seen by earlier tests so their plans are logged again
+        from .slowqueries import _seen_shapes
+        _seen_shapes.clear()
+
+        self.user = User.objects.create_user(username="admin", password="thistest1")
+        self.user.groups.add(Group.objects.create(name="admin"))
+        Client.objects.create(forename="Parent", surname="Smith")
+        self.client.force_login(self.user)
+
+    def entries(self):
+        with open(self.path) as log:
+            return [json.loads(line) for line in log]
+
+    # Are slow queries logged with the view, the line in views.py and the plan once per shape?
+    def test_logged_with_call_site(self):
+        self.client.get(reverse('accounts:allclients'))
+        self.client.get(reverse('accounts:allclients'))
+
+        clients = [entry for entry in self.entries() if 'accounts_client' in entry['sql']
+                   and entry['view'] == 'accounts:allclients']
+        self.assertTrue(clients)
+        # The query is run in keysetPaginate, called from the view
+        self.assertTrue(all([frame['file'] for frame in entry['stack'][:2]] == ['accounts/pagination.py', 'accounts/views.py']
+                            for entry in clients))
+        by_shape = {}
+        for entry in clients:
+            by_shape.setdefault(entry['shape'], []).append(entry)
+        # Each shape is run by both requests but only explained the first time
+        for entries in by_shape.values():
+            self.assertEqual(len(entries), 2)
+            self.assertEqual(['plan' in entry for entry in entries], [True, False])
+        self.assertFalse([entry for entry in self.entries() if entry['sql'].startswith('EXPLAIN')])
+
+    # Does the page show the newest entries with the plan carried over from the first?
+    def test_page(self):
+        from .slowqueries import recentEntries
+        self.client.get(reverse('accounts:allclients'))
+        entries = recentEntries(limit=2)
+        self.assertEqual(len(entries), 2)
+        self.assertGreaterEqual(entries[0]['time'], entries[-1]['time'])
+
+        response = self.client.get(reverse('accounts:slowqueries'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['enabled'])
+        self.assertTrue(response.context['entries'])
+
+    # Is the plan still shown once the entry it was logged with has rolled out of the log?
+    def test_plan_kept(self):
+        from .slowqueries import recentEntries
+        self.client.get(reverse('accounts:allclients'))
+        open(self.path, 'w').close()
+        self.client.get(reverse('accounts:allclients'))
+
+        self.assertFalse([entry for entry in self.entries() if 'plan' in entry])
+        entries = [entry for entry in recentEntries() if 'accounts_client' in entry['sql']]
+        self.assertTrue(entries)
+        self.assertTrue(all(entry['plan'] for entry in entries))
+
+    # Is a query that fails logged without running EXPLAIN after it?
+    def test_failed_query(self):
+        from django.db import connection, DatabaseError
+        from .querycount import QueryRecorder
+        from .slowqueries import SlowQueryRecorder, recentEntries
+        with QueryRecorder() as recorder:
+            with connection.execute_wrapper(SlowQueryRecorder(threshold=0)):
+                with self.assertRaises(DatabaseError):
+                    with connection.cursor() as cursor:
+                        cursor.execute('SELECT missing FROM accounts_client')
+
+        self.assertEqual([query['sql'] for query in recorder.queries], ['SELECT missing FROM accounts_client'])
+        entry = recentEntries(limit=1)[0]
+        self.assertTrue(entry['failed'])
+        self.assertIsNone(entry['plan'])
+
+    # Does the log roll over to a new file when it gets too big?
+    def test_rotates(self):
+        import os
+        from .slowqueries import logger
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        with self.settings(SLOW_QUERY_LOG_BYTES=2000, SLOW_QUERY_LOG_BACKUPS=2):
+            for i in range(5):
+                self.client.get(reverse('accounts:allclients'))
+        self.assertTrue(os.path.exists(self.path + '.1'))
+        self.assertLessEqual(os.path.getsize(self.path), 4000)
@@ -0,0 +1,135 @@
+from bisect import bisect_right
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+
+from .addresses import addressLine, tuitionAddresses
+from .models import Lesson
+from .refdata import productMap, termMap, terms
+
+DAY = 'day'
+WEEK = 'week'
+TERM = 'term'
+VIEWS = [DAY, WEEK, TERM]
+
+
+def _dayStart(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+# Terms in start order with their start dates, for finding the term a day falls in
+def _termTimeline():
+    ordered = sorted(terms(), key=lambda term: (term.term_start_date, term.pk))
+    return [term.term_start_date for term in ordered], ordered
+
+
+# The term covering the day, or failing that the next one to start, or the last one
+def termFor(day):
+    starts, ordered = _termTimeline()
+    if not ordered:
+        return None
+    index = bisect_right(starts, day)
+    if index and ordered[index - 1].term_end_date >= day:
+        return ordered[index - 1]
+    return ordered[min(index, len(ordered) - 1)]
+
+
+# The days shown for a view of the day given, with the day to go to for the window
+# before and after it. Weeks run Monday to Sunday. A term view with no terms set up
+# shows the week instead.
+def window(view, day):
+    if view == TERM:
+        term = termFor(day)
+        if term is not None:
+            starts, ordered = _termTimeline()
+            index = ordered.index(term)
+            return {'view': TERM, 'first': term.term_start_date, 'last': term.term_end_date,
+                    'label': term.term_name,
+                    'previous': ordered[index - 1].term_start_date if index else None,
+                    'next': ordered[index + 1].term_start_date if index + 1 < len(ordered) else None}
+        view = WEEK
+
+    if view == DAY:
+        return {'view': DAY, 'first': day, 'last': day, 'label': day.strftime('%A %d %B %Y'),
+                'previous': day - timedelta(days=1), 'next': day + timedelta(days=1)}
+
+    first = day - timedelta(days=day.weekday())
+    return {'view': WEEK, 'first': first, 'last': first + timedelta(days=6),
+            'label': 'Week beginning ' + first.strftime('%d %B %Y'),
+            'previous': first - timedelta(days=7), 'next': first + timedelta(days=7)}
+
+
+# The window asked for and, with adjacent set, the ones either side so the page can keep
+# them ready for the previous and next buttons
+def windows(view, day, adjacent=False):
+    current = window(view, day)
+    shown = [current]
+    if adjacent:
+        if current['previous']:
+            shown.insert(0, window(view, current['previous']))
+        if current['next']:
+            shown.append(window(view, current['next']))
+    return shown
+
+
+# Every student's lessons in the windows, one query on the lesson_start range covering
+# them all and one for the tuition addresses in effect on each lesson day. Products and
+# terms come from the reference data cache. Rows are read as tuples rather than model
+# instances as a term and its neighbours can be tens of thousands of lessons. Each window
+# gets a list of days with the lessons on that day in start order, ready to show or send
+# as JSON.
+def windowLessons(shown):
+    start = _dayStart(min(current['first'] for current in shown))
+    end = _dayStart(max(current['last'] for current in shown) + timedelta(days=1))
+    lessons = list(Lesson.objects.filter(lesson_start__gte=start, lesson_start__lt=end)
+                                 .order_by('lesson_start', 'pk')
+                                 .values_list('pk', 'student_id', 'student__forename', 'student__surname',
+                                              'lesson_type_id', 'term_id', 'lesson_start', 'lesson_end'))
+
+    products = productMap()
+    term_names = {pk: term.term_name for pk, term in termMap().items()}
+    local = timezone.get_current_timezone()
+
+    by_day = {}
+    for pk, student_id, forename, surname, lesson_type_id, term_id, lesson_start, lesson_end in lessons:
+        local_start = lesson_start.astimezone(local)
+        product = products.get(lesson_type_id)
+        by_day.setdefault(local_start.date(), []).append({
+            'id': pk,
+            'start': local_start.strftime('%H:%M'),
+            'end': lesson_end.astimezone(local).strftime('%H:%M'),
+            'student': ' '.join(filter(None, (forename, surname))) if student_id else '',
+            'student_id': student_id,
+            'product': product.product_name if product else '',
+            'term': term_names.get(term_id, ''),
+        })
+
+    addresses = tuitionAddresses({(lesson['student_id'], day) for day, day_lessons in by_day.items()
+                                  for lesson in day_lessons if lesson['student_id'] is not None})
+    for day, day_lessons in by_day.items():
+        for lesson in day_lessons:
+            lesson['address'] = addressLine(addresses.get((lesson['student_id'], day)))
+
+    for current in shown:
+        days = []
+        day = current['first']
+        while day <= current['last']:
+            # A term view only lists the days that have lessons
+            if current['view'] != TERM or day in by_day:
+                days.append({'date': day, 'lessons': by_day.get(day, [])})
+            day += timedelta(days=1)
+        current['days'] = days
+
+    return shown
+
+
+# Window as JSON friendly values, dates as ISO strings
+def windowJson(current):
+    def isoformat(day):
+        return day.isoformat() if day else None
+
+    return {'view': current['view'], 'label': current['label'], 'first': isoformat(current['first']),
+            'last': isoformat(current['last']), 'previous': isoformat(current['previous']),
+            'next': isoformat(current['next']),
+            'days': [{'date': day['date'].isoformat(), 'label': day['date'].strftime('%A %d %B'),
+                      'lessons': day['lessons']} for day in current['days']]}
@@ -26,12 +26,16 @@ urlpatterns = [
     path('products&terms/addnewproduct/<int:product>', views.updateProduct, name='updateproduct'),
     path('products&terms/addnewterm', views.addTerms, name='addterm'),
     path('products&terms/addnewterm/<int:term>', views.updateTerm, name='updateterm'),
+    path('products&terms/term/<int:term>/conflicts', views.lessonConflicts, name='lessonconflicts'),
     path('yourinformation', views.clientView, name='clientview'),
     path('yourinvoices/', views.clientInvoices, name='clientinvoices'),
     path('yourinvoices/<int:invoice>', views.clientDetailedInvoice, name='clientdetailedinvoice'),
     path('yourinfo/<int:customer>', views.client, name='client'),
     path('yourchild/<int:student>', views.student, name='student'),
     path('yourchild/<int:student>/addlessons', views.addLessons, name='addlessons'),
+    path('yourchild/<int:student>/addseries', views.addLessonSeries, name='addseries'),
+    path('yourchild/series/<int:series>/update', views.updateLessonSeries, name='updateseries'),
+    path('yourchild/series/<int:series>/cancel', views.cancelLessonSeries, name='cancelseries'),
     path('yourchild/<int:lesson>/updatelesson', views.updateLesson, name='updatelesson'),
     path('yourchild/<int:lesson>/deletelesson', views.deleteLesson, name='deletelesson'),
     path('createinvoices/', views.accounts, name='accounts'),
@@ -39,8 +43,70 @@ urlpatterns = [
     path('invoices/', views.invoices, name='invoices'),
     path('invoices/<int:invoice>', views.invoicesDetailed, name='invoicesdetailed'),
     path('invoices/<int:invoice>/update', views.updateInvoices, name='updateinvoice'),
+    path('invoices/reconcile', views.reconcilePayments, name='reconcile'),
+    path('invoices/ageddebt', views.agedDebtReport, name='ageddebt'),
+    path('export/<str:export>', views.exportData, name='export'),
+    path('revenue/', views.revenueReport, name='revenue'),
+    path('timetable/', views.timetable, name='timetable'),
+    path('timetable/data', views.timetableData, name='timetabledata'),
+    path('metrics', views.metrics, name='metrics'),
+    path('slowqueries/', views.slowQueries, name='slowqueries'),
+    path('calendar/<str:token>.ics', views.calendarFeed, name='calendarfeed'),
+    path('jobs/', views.jobs, name='jobs'),
+    path('jobs/<int:job>', views.jobDetail, name='jobdetail'),
+    path('jobs/queue/<str:task>', views.queueJob, name='queuejob'),
 ]
 
+# Maximum number of queries each page should run. These include the session and user
+# lookups and the one query reading the reference version stamps (products, terms and
+# roles), the group check itself comes from the role cache once it is warm. None of them
+# should grow with the number of rows shown, the budget tests in tests.py check them
+# against a seeded dataset and QueryCountMiddleware logs any page that goes over.
+QUERY_BUDGETS = {
+    'home': 2,
+    'register': 2,
+    'login': 2,
+    'logout': 4,
+    'allclients': 4,
+    'addclient': 3,
+    'allstudents': 4,
+    'addstudent': 4,
+    'refdata': 4,
+    'addproduct': 3,
+    'updateproduct': 4,
+    'addterm': 3,
+    'updateterm': 4,
+    'lessonconflicts': 5,
+    'clientview': 8,
+    'clientinvoices': 5,
+    'clientdetailedinvoice': 7,
+    'client': 8,
+    'student': 7,
+    'addlessons': 5,
+    'addseries': 5,
+    'updateseries': 5,
+    'cancelseries': 4,
+    'updatelesson': 6,
+    'deletelesson': 4,
+    'accounts': 4,
+    'accountsdetailed': 6,
+    'invoices': 4,
+    'invoicesdetailed': 6,
+    'updateinvoice': 4,
+    'reconcile': 3,
+    'ageddebt': 6,
+    'export': 4,
+    'revenue': 5,
+    'timetable': 5,
+    'timetabledata': 5,
+    'calendarfeed': 7,
+    'metrics': 3,
+    'slowqueries': 3,
+    'jobs': 5,
+    'jobdetail': 4,
+    'queuejob': 3,
+}
+
 #app_name = 'polls'
 #urlpatterns = [
 #    path('', views.IndexView.as_view(), name='index'),
@@ -1,18 +1,50 @@
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.urls import reverse
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, StreamingHttpResponse, Http404, JsonResponse
 from django.forms.models import inlineformset_factory
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import Group
-from django.db.models import Q, Count
+from django.db.models import Q, Count, Avg, Max
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.core import signing
+from django.conf import settings
 
-from datetime import datetime
+import hmac
+import io
+from decimal import Decimal
 
-from .models import Client, Address, ContactDetails, Student, TuitionAddress, Products
+from .models import Client, Address, ContactDetails, Student, TuitionAddress, Products, AgedDebtSnapshot, normaliseEmail
 from .forms import *
 from .decorators import *
+from .pagination import keysetPaginate
+from .invoicing import invoiceLines, claimToken, claimLessons, ClaimError
+from .exports import EXPORTS, FORMATS
+from .series import createSeries, updateSeries, cancelSeries
+from .conflicts import termConflicts, REPORT_LIMIT
+from .addresses import invoiceAddresses
+from .pricing import priceLessons
+from .numbering import nextInvoiceNumber
+from .jobs import TASKS, enqueue
+from .reconcile import reconcileStatement
+from .ageddebt import agedDebtTotals, clientAgedDebt
+from .rollups import revenue
+from .timetable import windows, windowLessons, windowJson, WEEK
+from .metrics import metricsStore, renderMetrics
+from .slowqueries import recentEntries, slowQueryLog, slowQuerySeconds
+from .roles import hasRole
+from .calendars import feedToken, feedOwner, feedState, feedBody, POLL_SECONDS, STUDENT, CLIENT
+from . import refdata
+
+# Filter clients or students by the start of their forename or surname
+def nameSearch(queryset, search):
+    if search:
+        queryset = queryset.filter(Q(surname__istartswith=search) | Q(forename__istartswith=search))
+    return queryset
 
 # Basic home page to main.html which all other pages inherit from. Currently 
 # not used to show anything but can be used for pinned notices in future.
@@ -36,8 +68,10 @@ def home(request):
 @login_required(login_url='accounts:login')
 @allowedUsers(allowed_roles=['admin'])
 def allClients(request):
-    clients = Client.objects.all()
-    context = {'clients': clients}
+    search = request.GET.get('search', '').strip()
+    clients = keysetPaginate(nameSearch(Client.objects.select_related('balance'), search), ['pk'],
+                             after=request.GET.get('after'), before=request.GET.get('before'))
+    context = {'clients': clients, 'search': search}
 
     return render(request, 'accounts/allclients.html', context)
 
@@ -50,7 +84,8 @@ def client(request, customer):
     home = clients.address.all()
     contact = clients.contacts.all()
     students = clients.student_set.all()
-    lessons = Lesson.objects.filter(student__in=students).order_by('lesson_start')
+    lessons = Lesson.objects.filter(student__in=students).order_by('lesson_start') \
+                            .select_related('student', 'lesson_type', 'term', 'invoice_number')
 
 
     context = {'clients': clients, 'address': home, 
@@ -86,8 +121,10 @@ def addClient(request):
 @login_required(login_url='accounts:login')
 @allowedUsers(allowed_roles=['admin'])
 def allStudents(request):
-    students = Student.objects.all()
-    context = {'students': students}
+    search = request.GET.get('search', '').strip()
+    students = keysetPaginate(nameSearch(Student.objects.all(), search), ['pk'],
+                              after=request.GET.get('after'), before=request.GET.get('before'))
+    context = {'students': students, 'search': search}
 
     return render(request, 'accounts/allstudents.html', context)
 
@@ -118,9 +155,13 @@ def addStudent(request):
 def student(request, student):
     student = Student.objects.get(pk=student)
     tuition_address = student.address_student.all()
-    lessons = student.lesson_student.all().order_by('lesson_start')
+    lessons = student.lesson_student.all().order_by('lesson_start') \
+                     .select_related('student', 'lesson_type', 'term', 'invoice_number')
+    series = student.lesson_series.all().select_related('lesson_type', 'term')
+    calendar_url = request.build_absolute_uri(reverse('accounts:calendarfeed', args=[feedToken(STUDENT, student)]))
 
-    context = {'student': student, 'lessons': lessons, 'address': tuition_address}
+    context = {'student': student, 'lessons': lessons, 'address': tuition_address, 'series': series,
+               'calendar_url': calendar_url}
 
     return render(request, 'accounts/student.html', context)
 
@@ -142,6 +183,58 @@ def addLessons(request, student):
 
     return render(request, 'accounts/addlesson.html', context)
 
+# View to add weekly lessons for a student for a whole term in one go
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def addLessonSeries(request, student):
+    student_details = Student.objects.get(pk=student)
+    series_form = LessonSeriesForm(initial={'student': student_details})
+
+    if request.method == 'POST':
+        series_form = LessonSeriesForm(request.POST)
+
+        if series_form.is_valid():
+            created = createSeries(series_form.instance)
+            messages.info(request, str(created) + ' lessons added')
+            return redirect('accounts:student', student_details.pk)
+
+    context = {'student': student_details, 'series_form': series_form}
+
+    return render(request, 'accounts/addseries.html', context)
+
+# View to change a series. Every lesson in it not invoiced yet is made again to match
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def updateLessonSeries(request, series):
+    series_details = LessonSeries.objects.select_related('student').get(pk=series)
+    series_form = LessonSeriesForm(instance=series_details)
+
+    if request.method == 'POST':
+        series_form = LessonSeriesForm(request.POST, instance=series_details)
+
+        if series_form.is_valid():
+            updateSeries(series_form.instance)
+            return redirect('accounts:student', series_details.student_id)
+
+    context = {'student': series_details.student, 'series_form': series_form}
+
+    return render(request, 'accounts/addseries.html', context)
+
+# View to cancel a series, deleting every lesson in it not invoiced yet
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def cancelLessonSeries(request, series):
+    series_details = LessonSeries.objects.get(pk=series)
+    student_id = series_details.student_id
+
+    if request.method == 'POST':
+        cancelSeries(series_details)
+        return redirect('accounts:student', student_id)
+
+    context = {'student': student_id}
+
+    return render(request, 'accounts/deletelesson.html', context)
+
 # View to update the a lesson if required
 @login_required(login_url='accounts:login')
 @allowedUsers(allowed_roles=['admin'])
@@ -154,7 +247,7 @@ def updateLesson(request, lesson):
 
         if lesson_form.is_valid():
             lesson_form.save()
-            return redirect('accounts:student', lesson_details.student.pk)
+            return redirect('accounts:student', lesson_details.student_id)
 
     context = {'lesson_form': lesson_form}
 
@@ -165,7 +258,7 @@ def updateLesson(request, lesson):
 @allowedUsers(allowed_roles=['admin'])
 def deleteLesson(request, lesson):
     lesson_details = Lesson.objects.get(pk=lesson)
-    student_id = lesson_details.student.pk
+    student_id = lesson_details.student_id
 
     if request.method == 'POST':
         lesson_details.delete()
@@ -179,13 +272,24 @@ def deleteLesson(request, lesson):
 @login_required(login_url='accounts:login')
 @allowedUsers(allowed_roles=['admin'])
 def referenceData(request):
-    products = Products.objects.all()
-    terms = Term.objects.all()
+    products = refdata.products()
+    terms = refdata.terms()
 
     context = {'products': products, 'terms': terms }
 
     return render(request, 'accounts/referencedata.html', context)
 
+# View to list every pair of lessons in a term that clash
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def lessonConflicts(request, term):
+    term_details = Term.objects.get(pk=term)
+    conflicts = termConflicts(term_details, limit=REPORT_LIMIT)
+
+    context = {'term': term_details, 'conflicts': conflicts, 'limited': len(conflicts) >= REPORT_LIMIT}
+
+    return render(request, 'accounts/lessonconflicts.html', context)
+
 # View to add new products
 @login_required(login_url='accounts:login')
 @allowedUsers(allowed_roles=['admin'])
@@ -260,9 +364,11 @@ def updateTerm(request, term):
 @login_required(login_url='accounts:login')
 @allowedUsers(allowed_roles=['admin'])
 def accounts(request):
-    clients = Client.objects.all()
+    search = request.GET.get('search', '').strip()
+    clients = keysetPaginate(nameSearch(Client.objects.select_related('balance'), search), ['pk'],
+                             after=request.GET.get('after'), before=request.GET.get('before'))
 
-    context = {'clients': clients}
+    context = {'clients': clients, 'search': search}
 
     return render(request, 'accounts/accounts.html', context)
 
@@ -273,25 +379,19 @@ def accounts(request):
 def accountsDetailed(request, customer):
     clients = Client.objects.get(pk=customer)
     students = clients.student_set.all()
-    lessons = Lesson.objects.filter(student__in=students, invoiced=False)
+    lessons = Lesson.objects.filter(student__in=students, invoiced=False).select_related('lesson_type', 'term', 'student')
+    lesson_list = list(lessons)
 
-    now = datetime.now()
-
-    # Create invoice nu,ber from first 3 letters of surname and datetime now
-    invoice_id = clients.surname[0:3].upper() + now.strftime("%d%m%Y%H%M%S")
-
-    lesson_total = 0
-
-    for lesson in lessons:
-        lesson_total += lesson.lesson_type.price
+    # Each lesson is charged the price in effect on the day it took place
+    lesson_total = sum(priceLessons(lesson_list), Decimal(0))
 
     # Pre populates the invoice creation form with total amounts, and invoice number and client
     # to be linked too
-    create_invoice_form = CreateInvoiceForm(initial={'invoice_number': invoice_id,
-                                                     'total_amount': lesson_total,
+    create_invoice_form = CreateInvoiceForm(initial={'total_amount': lesson_total,
                                                      'client': customer,
                                                      'amount_paid': 0,
-                                                     'amount_outstanding': lesson_total})
+                                                     'amount_outstanding': lesson_total,
+                                                     'claim_token': claimToken(clients, lesson_list)})
 
     # If the amount is 0 or less we can't create a invoice so return back to accounts page
     if lesson_total <= 0:
@@ -302,24 +402,76 @@ def accountsDetailed(request, customer):
         create_invoice_form = CreateInvoiceForm(request.POST)
 
         if create_invoice_form.is_valid():
-            create_invoice_form.save()
-            # Once invoice created and save all related lessons need updating to be linked to new invoice
-            lessons.update(invoiced=True, invoice_number=create_invoice_form.instance)
+            # The number is only taken from the sequence once the invoice is really made
+            create_invoice_form.instance.invoice_number = nextInvoiceNumber(clients)
+            # Saves the invoice and links just the lessons that were shown, or nothing at all
+            try:
+                claimLessons(create_invoice_form.instance, create_invoice_form.cleaned_data['claim_token'])
+            except ClaimError as error:
+                messages.info(request, str(error))
+                return redirect('accounts:accountsdetailed', customer)
 
             return redirect('accounts:accounts')
 
     context = {'clients': clients, 'students': students, 
-               'lessons': lessons, 'total': lesson_total, 'create_invoice': create_invoice_form}
+               'lessons': lesson_list, 'total': lesson_total, 'create_invoice': create_invoice_form}
 
     return render(request, 'accounts/accountsdetailed.html', context)
 
+# View to list the background jobs, newest first, with timings for each kind of job
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def jobs(request):
+    jobs = keysetPaginate(Job.objects.all(), ['-pk'],
+                          after=request.GET.get('after'), before=request.GET.get('before'))
+
+    # One query for the counts and timings of every task
+    metrics = Job.objects.values('task').annotate(total=Count('pk'),
+                                                  failed=Count('pk', filter=Q(status=Job.FAILED)),
+                                                  waiting=Count('pk', filter=Q(status=Job.QUEUED)),
+                                                  average_run=Avg('run_seconds'), longest_run=Max('run_seconds'),
+                                                  average_wait=Avg('wait_seconds')).order_by('task')
+
+    context = {'jobs': jobs, 'metrics': metrics, 'tasks': sorted(TASKS)}
+
+    return render(request, 'accounts/jobs.html', context)
+
+# View to show how a background job went
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def jobDetail(request, job):
+    job = Job.objects.get(pk=job)
+
+    context = {'job': job}
+
+    return render(request, 'accounts/jobdetail.html', context)
+
+# Queue a job from the jobs page rather than running the work inside the request
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def queueJob(request, task):
+    if request.method != 'POST' or task not in TASKS:
+        return redirect('accounts:jobs')
+
+    job = enqueue(task)
+    messages.info(request, 'Queued ' + task)
+
+    return redirect('accounts:jobdetail', job.pk)
+
 # View to display all invoices
 @login_required(login_url='accounts:login')
 @allowedUsers(allowed_roles=['admin'])
 def invoices(request):
-    invoices = Invoices.objects.all().order_by('date_created')
+    search = request.GET.get('search', '').strip()
+    invoices = Invoices.objects.all().select_related('client')
 
-    context = {'invoices': invoices}
+    if search:
+        invoices = invoices.filter(invoice_number__istartswith=search)
+
+    invoices = keysetPaginate(invoices, ['date_created', 'pk'],
+                              after=request.GET.get('after'), before=request.GET.get('before'))
+
+    context = {'invoices': invoices, 'search': search}
 
     return render(request, 'accounts/invoices.html', context)
 
@@ -328,24 +480,13 @@ def invoices(request):
 @login_required(login_url='accounts:login')
 @allowedUsers(allowed_roles=['admin'])
 def invoicesDetailed(request, invoice):
-    invoice = Invoices.objects.get(pk=invoice)
-    client = Client.objects.get(pk=invoice.client.pk)
-    home = client.address.get(Q(effective_from_date__lte = invoice.date_created,
-                              effective_to_date__gte = invoice.date_created) | 
-                              Q(effective_from_date__lte = invoice.date_created,
-                              effective_to_date__isnull = True ))
-    lessons = invoice.invoice_no.all()
-
-    # Basically a group by statement but using list to make queryset output dictionary
-    lesson_count = list(lessons.values('lesson_type__product_name', 
-                                  'lesson_type__price').annotate(
-                                  total=Count('lesson_type')))
+    invoice = Invoices.objects.select_related('client').get(pk=invoice)
+    client = invoice.client
+    home = invoiceAddresses([invoice])[invoice.pk]
+    # Lines were saved when the invoice was created so no need to group the lessons again
+    lines = invoiceLines(invoice)
 
-    # Count total for lessons from group by queryset
-    for lesson in lesson_count:
-        lesson["total_price"] = lesson["total"] * lesson["lesson_type__price"]
-
-    context = {'invoice': invoice, 'client': client, 'home': home, 'lessons': lesson_count}
+    context = {'invoice': invoice, 'client': client, 'home': home, 'lines': lines}
 
     return render(request, 'accounts/invoicedetailed.html', context)
 
@@ -377,6 +518,170 @@ def updateInvoices(request, invoice):
 
     return render(request, 'accounts/updateinvoice.html', context)
 
+# View to upload a bank statement and record the payments on it against the invoices. The
+# report lists every line that couldn't be matched to exactly one invoice so they can be
+# keyed in through updateInvoices instead.
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def reconcilePayments(request):
+    statement_form = StatementForm()
+    result = None
+
+    if request.method == 'POST':
+        statement_form = StatementForm(request.POST, request.FILES)
+
+        if statement_form.is_valid():
+            source = io.TextIOWrapper(statement_form.cleaned_data['statement'].file, encoding='utf-8-sig')
+            result = reconcileStatement(source, apply=not statement_form.cleaned_data['check_only'])
+
+    context = {'statement_form': statement_form, 'result': result}
+
+    return render(request, 'accounts/reconcile.html', context)
+
+# View of outstanding invoice amounts by age for each client and in total. Today's is
+# worked out from the invoices, an earlier day is read from its stored snapshot.
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def agedDebtReport(request):
+    date_form = AgedDebtForm(request.GET)
+    day = date_form.cleaned_data['date'] if date_form.is_valid() else None
+    after, before = request.GET.get('after'), request.GET.get('before')
+
+    if day is None or day >= timezone.localdate():
+        day = None
+        totals = agedDebtTotals()
+        clients = keysetPaginate(clientAgedDebt(), ['client'], after=after, before=before)
+    else:
+        snapshot = AgedDebtSnapshot.objects.filter(date=day)
+        totals = snapshot.filter(client__isnull=True).first()
+        clients = keysetPaginate(snapshot.filter(client__isnull=False).select_related('client'), ['pk'],
+                                 after=after, before=before)
+
+    snapshot_dates = AgedDebtSnapshot.objects.filter(client__isnull=True) \
+                                             .order_by('-date').values_list('date', flat=True)[:10]
+
+    context = {'date_form': date_form, 'day': day, 'totals': totals, 'clients': clients,
+               'snapshot_dates': snapshot_dates}
+
+    return render(request, 'accounts/ageddebt.html', context)
+
+# View of lesson revenue by product, month or term, read from the rollups kept up to
+# date as lessons change so it doesn't depend on how many lessons there are
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def revenueReport(request):
+    revenue_form = RevenueForm(request.GET)
+    term, group = None, 'product'
+
+    if revenue_form.is_valid():
+        term = revenue_form.cleaned_data['term']
+        group = revenue_form.cleaned_data['group'] or group
+
+    rows = revenue(group, term.pk if term else None)
+    totals = {field: sum(row[field] for row in rows) for field in ('lessons', 'invoiced', 'uninvoiced', 'total')}
+
+    context = {'revenue_form': revenue_form, 'term': term, 'group': group, 'rows': rows, 'totals': totals}
+
+    return render(request, 'accounts/revenue.html', context)
+
+# The day, week or term asked for in the query string, defaulting to this week
+def _timetableRequest(request):
+    timetable_form = TimetableForm(request.GET)
+    view, day, adjacent = WEEK, timezone.localdate(), False
+
+    if timetable_form.is_valid():
+        view = timetable_form.cleaned_data['view'] or view
+        day = timetable_form.cleaned_data['date'] or day
+        adjacent = timetable_form.cleaned_data['adjacent']
+
+    return timetable_form, view, day, adjacent
+
+# Timetable of every student's lessons for a day, week or term. Only the lessons in the
+# window are read, by a range on lesson_start, so it stays quick however many terms of
+# lessons there are. The page moves between weeks using timetableData.
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def timetable(request):
+    timetable_form, view, day, adjacent = _timetableRequest(request)
+    current = windowLessons(windows(view, day))[0]
+
+    context = {'timetable_form': timetable_form, 'window': current}
+
+    return render(request, 'accounts/timetable.html', context)
+
+# The timetable as JSON for moving back and forward without reloading the page. With
+# adjacent=1 the windows either side come too, read in the same query.
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def timetableData(request):
+    timetable_form, view, day, adjacent = _timetableRequest(request)
+    shown = windowLessons(windows(view, day, adjacent))
+
+    return JsonResponse({'windows': [windowJson(current) for current in shown]})
+
+# iCalendar feed of a student's or a family's lessons for calendar apps to subscribe to.
+# There is no login, the signed token in the url says whose lessons to show. Apps poll
+# every few minutes so the fingerprint of the feed is checked first and a 304 sent if it
+# hasn't changed, otherwise the feed comes from the cache unless it needs rendering again.
+def calendarFeed(request, token):
+    try:
+        kind, pk, key = feedOwner(token)
+    except signing.BadSignature:
+        raise Http404('No such calendar')
+
+    state = feedState(kind, pk, key)
+    if state is None:
+        raise Http404('No such calendar')
+
+    response = get_conditional_response(request, etag=quote_etag(state['etag']))
+    if response is None:
+        response = HttpResponse(feedBody(state), content_type='text/calendar; charset=utf-8')
+        response['Content-Disposition'] = 'inline; filename="lessons.ics"'
+
+    response['ETag'] = quote_etag(state['etag'])
+    patch_cache_control(response, private=True, max_age=POLL_SECONDS)
+
+    return response
+
+# Request metrics for each page in the Prometheus text format. Scrapers can't log in so
+# they send METRICS_TOKEN as a bearer token, admin users can also view it logged in.
+def metrics(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not (token and hmac.compare_digest(authorization, 'Bearer ' + token)) and not hasRole(request.user, ['admin']):
+        return HttpResponseForbidden('Not allowed')
+
+    store = metricsStore()
+    body = renderMetrics(store.read() if store else [])
+
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# The latest queries from the slow query log, newest first
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def slowQueries(request):
+    context = {'entries': recentEntries(), 'enabled': bool(slowQueryLog()), 'threshold': slowQuerySeconds()}
+
+    return render(request, 'accounts/slowqueries.html', context)
+
+# View to stream lessons, invoices or clients as CSV or JSON lines for the accountants.
+# Rows are read in chunks and sent as they are written so any size of export uses the
+# same memory. Filters are passed in the query string, see ExportFilterForm.
+@login_required(login_url='accounts:login')
+@allowedUsers(allowed_roles=['admin'])
+def exportData(request, export):
+    export_format = request.GET.get('format', 'csv')
+    filter_form = ExportFilterForm(request.GET)
+
+    if export not in EXPORTS or export_format not in FORMATS or not filter_form.is_valid():
+        return HttpResponseBadRequest('Invalid export')
+
+    lines, content_type = FORMATS[export_format]
+    response = StreamingHttpResponse(lines(export, **filter_form.cleaned_data), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (export, export_format)
+
+    return response
+
 # View for new clients to register. Must have a client already set up by admin and matchineg email
 @authenticatedUser
 def registerPage(request): 
@@ -392,7 +697,7 @@ def registerPage(request):
             group = Group.objects.get(name='customer')
             user.groups.add(group)
 
-            check_email = ContactDetails.objects.get(email_address=email)
+            check_email = ContactDetails.objects.get(email_address=normaliseEmail(email))
 
             # Only gets here if email matches one we hold (would fail in form validation).
             # Update client user field to match new registration details so can access their
@@ -444,12 +749,18 @@ def clientView(request):
     clients = request.user.client
     home = clients.address.all()
     contact = clients.contacts.all()
-    students = clients.student_set.all()
-    lessons = Lesson.objects.filter(student__in=students)
+    students = list(clients.student_set.all())
+    lessons = Lesson.objects.filter(student__in=students).select_related('student', 'lesson_type', 'term')
+
+    # Calendar feed links for the whole family and for each child
+    for child in students:
+        child.calendar_url = request.build_absolute_uri(reverse('accounts:calendarfeed',
+                                                                args=[feedToken(STUDENT, child)]))
+    calendar_url = request.build_absolute_uri(reverse('accounts:calendarfeed', args=[feedToken(CLIENT, clients)]))
 
     context = {'clients': clients, 'address': home, 
                'contact': contact, 'students': students, 
-               'lessons': lessons, 'flag': client_only}
+               'lessons': lessons, 'flag': client_only, 'calendar_url': calendar_url}
 
     return render(request, 'accounts/clientview.html', context)
 
@@ -460,7 +771,7 @@ def clientInvoices(request):
     # Pass flag to only show customer nav bar
     client_only = True
     clients = request.user.client
-    invoices = clients.invoices.all()
+    invoices = clients.invoices.all().select_related('client')
 
     context = {'invoices': invoices, 'flag': client_only}
 
@@ -473,24 +784,14 @@ def clientDetailedInvoice(request, invoice):
     # Pass flag to only show customer nav bar
     client_only = True
     client_user = request.user.client
-    invoice = Invoices.objects.get(pk=invoice)
-    client = Client.objects.get(pk=invoice.client.pk)
+    invoice = Invoices.objects.select_related('client').get(pk=invoice)
+    client = invoice.client
     if client_user.pk == client.pk:   
-        home = client.address.get(Q(effective_from_date__lte = invoice.date_created,
-                                  effective_to_date__gte = invoice.date_created) | 
-                                  Q(effective_from_date__lte = invoice.date_created,
-                                  effective_to_date__isnull = True ))
-        lessons = invoice.invoice_no.all()
-
-        lesson_count = list(lessons.values('lesson_type__product_name', 
-                                           'lesson_type__price').annotate(
-                                           total=Count('lesson_type')))
-
-        for lesson in lesson_count:
-            lesson["total_price"] = lesson["total"] * lesson["lesson_type__price"]
+        home = invoiceAddresses([invoice])[invoice.pk]
+        lines = invoiceLines(invoice)
 
         context = {'invoice': invoice, 'client': client, 
-                   'home': home, 'lessons': lesson_count,
+                   'home': home, 'lines': lines,
                    'flag': client_only}
     else:
         return redirect('accounts:clientinvoices')
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'accounts.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -49,6 +50,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'accounts.middleware.QueryCountMiddleware',
+    'accounts.middleware.SlowQueryMiddleware',
 ]
 
 ROOT_URLCONF = 'bespoke_tuition.urls'
@@ -120,3 +123,16 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Per page request metrics served at /metrics, see accounts/metrics.py. The file is shared
+# by all the worker processes so should be on local disk, metrics are off when it isn't
+# set. Scrapers send the token as a bearer token, admin users can view the page logged in.
+METRICS_FILE = os.environ.get('METRICS_FILE')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Queries slower than SLOW_QUERY_SECONDS are written to SLOW_QUERY_LOG with their plan and
+# the code that ran them, the plans are also kept in SLOW_QUERY_LOG.plans, see
+# accounts/slowqueries.py. Off when the log isn't set.
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG')
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS', 0.1))